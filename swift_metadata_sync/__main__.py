@@ -1,11 +1,14 @@
 import argparse
+import eventlet
 import json
 import logging
 import os
+import signal
+import sys
 import traceback
 
 from container_crawler import ContainerCrawler
-from .metadata_sync import MetadataSync
+from .fan_out import create_handler
 
 
 def setup_logger(console=False, log_file=None, level='INFO'):
@@ -27,7 +30,62 @@ def setup_logger(console=False, log_file=None, level='INFO'):
 
 def load_config(conf_file):
     with open(conf_file, 'r') as f:
-        return json.load(f)
+        conf = json.load(f)
+    conf['bulk_process'] = True
+    return conf
+
+
+def install_signal_handlers(crawler, conf_file, shutdown_timeout):
+    """
+    SIGTERM and SIGINT stop the crawler once the rows that are being processed
+    are indexed and checkpointed. If that takes longer than shutdown_timeout
+    seconds, the process is terminated by SIGALRM; the checkpoints are written
+    atomically, so at most the interrupted rows are processed again. SIGHUP
+    reloads the configuration file before the next poll. SIGUSR1 profiles the
+    next polls.
+    """
+    logger = logging.getLogger('swift-metadata-sync')
+
+    def _stop(signum, frame):
+        logger.info('Received signal %d; stopping' % signum)
+        crawler.stop()
+        signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        signal.alarm(shutdown_timeout)
+
+    def _reload(signum, frame):
+        logger.info('Received SIGHUP; reloading %s' % conf_file)
+        crawler.request_reload(lambda: load_config(conf_file))
+
+    def _profile(signum, frame):
+        logger.info('Received SIGUSR1; profiling the next polls')
+        crawler.request_profile()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGHUP, _reload)
+    signal.signal(signal.SIGUSR1, _profile)
+
+
+def get_container_settings(conf, path):
+    account, _, container = path.partition('/')
+    for settings in conf.get('containers', []):
+        if settings.get('account') == account and \
+                settings.get('container') == container:
+            return settings
+    raise RuntimeError('Container %s is not configured' % path)
+
+
+def create_queue_indexer(conf):
+    """
+    Returns the indexer of the work queues, if a container mapping queues its
+    rows, or None otherwise.
+    """
+    if not any(settings.get('queue') for settings in conf['containers']):
+        return None
+    from .work_queue import QueueIndexer
+    return QueueIndexer(conf['status_dir'],
+                        bulk_size=conf.get('queue_bulk_size', 1000),
+                        interval=conf.get('queue_interval', 5))
 
 
 def parse_args():
@@ -43,6 +101,29 @@ def parse_args():
                         help='logging level; defaults to info')
     parser.add_argument('--console', action='store_true',
                         help='log messages to console')
+    parser.add_argument('--backfill', metavar='account/container', type=str,
+                        help='rebuild the index of the container from '
+                             'scratch, with parallel workers, and exit')
+    parser.add_argument('--workers', metavar='count', type=int, default=4,
+                        help='number of parallel workers for --backfill, '
+                             '--export, and --load; defaults to 4')
+    parser.add_argument('--export', metavar='account/container', type=str,
+                        help='write the documents of the container as '
+                             'Elasticsearch bulk files into --path, and exit')
+    parser.add_argument('--load', metavar='account/container', type=str,
+                        help='load the bulk files written by --export from '
+                             '--path into the index, and exit')
+    parser.add_argument('--path', metavar='dir', type=str,
+                        help='directory for the --export and --load files')
+    parser.add_argument('--reconcile', metavar='account/container', type=str,
+                        help='print the differences between the container '
+                             'and the index, and exit')
+    parser.add_argument('--repair', action='store_true',
+                        help='fix the differences found by --reconcile')
+    parser.add_argument('--migrate-routing', metavar='account/container',
+                        type=str,
+                        help='move the documents of the container to the '
+                             'shards of its configured routing, and exit')
     return parser.parse_args()
 
 
@@ -59,15 +140,65 @@ def main():
     logger = logging.getLogger('swift-metadata-sync')
     logger.info('Starting Swift Metadata Sync')
     try:
-        conf['bulk_process'] = True
-        crawler = ContainerCrawler(conf, MetadataSync, logger)
-        if args.once:
+        # The commands are imported as needed, to start quickly (e.g. when
+        # the daemon is run with --once)
+        if args.load:
+            from .export import Loader
+            Loader(conf['status_dir'], get_container_settings(conf, args.load),
+                   args.path, workers=args.workers).run()
+            return
+        if args.migrate_routing:
+            from .migrate import RoutingMigration
+            RoutingMigration(conf['status_dir'],
+                             get_container_settings(conf,
+                                                    args.migrate_routing),
+                             bulk_size=conf.get('backfill_bulk_size',
+                                                5000)).run()
+            return
+        crawler = ContainerCrawler(conf, create_handler, logger)
+        if args.backfill:
+            from .backfill import Backfill
+            Backfill(crawler, get_container_settings(conf, args.backfill),
+                     workers=args.workers,
+                     bulk_size=conf.get('backfill_bulk_size', 5000)).run()
+        elif args.export:
+            from .export import Exporter
+            Exporter(crawler, get_container_settings(conf, args.export),
+                     args.path, workers=args.workers,
+                     max_file_size=conf.get('export_file_size',
+                                            64 * 2**20)).run()
+        elif args.reconcile:
+            from .reconcile import Reconciler
+            Reconciler(crawler, get_container_settings(conf, args.reconcile),
+                       repair=args.repair, output=sys.stdout).run()
+        elif args.once:
             crawler.run_once()
+            queue_indexer = create_queue_indexer(conf)
+            if queue_indexer:
+                queue_indexer.run_once()
         else:
+            install_signal_handlers(crawler, args.config,
+                                    conf.get('shutdown_timeout', 30))
+            stats_server = None
+            if conf.get('stats_port'):
+                from .stats_server import StatsServer
+                stats_server = StatsServer(
+                    crawler, conf.get('stats_host', '127.0.0.1'),
+                    conf['stats_port'], conf.get('liveness_timeout', 300))
+                stats_server.start()
+            # The queues are indexed concurrently with the crawl
+            queue_indexer = create_queue_indexer(conf)
+            indexer_thread = None
+            if queue_indexer:
+                indexer_thread = eventlet.spawn(queue_indexer.run_always)
             crawler.run_always()
+            if indexer_thread:
+                indexer_thread.kill()
+            if stats_server:
+                stats_server.stop()
     except Exception as e:
         logger.error("Metadata Sync failed: %s" % repr(e))
-        logger.error(traceback.format_exc(e))
+        logger.error(traceback.format_exc())
         exit(1)
 
 
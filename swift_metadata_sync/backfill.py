@@ -0,0 +1,114 @@
+import elasticsearch
+import eventlet
+import logging
+import math
+
+from .metadata_sync import MetadataSync
+
+
+class Backfill(object):
+    """
+        Rebuilds the index of a container from scratch, e.g. after changing
+        the index in the container mapping.
+
+        The ROWID space of the local container database is split into ranges,
+        which are indexed by parallel workers. As the target index is assumed
+        to be empty, the staleness check (mget) is skipped and every live row
+        is indexed. Refreshes and replicas are disabled on the index for the
+        duration of the load. Once all of the rows up to the ROWID observed at
+        the start are indexed, the index settings are restored and the
+        checkpoint is set to that ROWID, so that the daemon continues
+        incrementally with the rows that were added in the meantime.
+    """
+
+    LOAD_SETTINGS = {'refresh_interval': '-1', 'number_of_replicas': 0}
+
+    def __init__(self, crawler, settings, workers=4, bulk_size=5000):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._crawler = crawler
+        self._settings = settings
+        self.workers = workers
+        self.bulk_size = bulk_size
+        self.items_chunk = crawler.items_chunk
+
+    @staticmethod
+    def split_rows(max_row, ranges):
+        """
+        Splits the rows up to max_row into at most the given number of
+        (start, end] ranges.
+        """
+        if max_row <= 0:
+            return []
+        step = int(math.ceil(float(max_row) / ranges))
+        return [(start, min(start + step, max_row))
+                for start in range(0, max_row, step)]
+
+    @staticmethod
+    def _get_index_settings(index_client, index):
+        response = index_client.get_settings(index=index)
+        current = {}
+        if response:
+            current = list(response.values())[0].get(
+                'settings', {}).get('index', {})
+        # Settings that were not set explicitly are restored to the default by
+        # setting them to None.
+        return dict([(key, current.get(key))
+                     for key in Backfill.LOAD_SETTINGS.keys()])
+
+    def _backfill_range(self, handler, broker, start, end):
+        indexed = 0
+        errors = []
+        while start < end:
+            rows = broker.get_items_since(start, self.items_chunk)
+            if not rows:
+                break
+            rows = [row for row in rows if row['ROWID'] <= end]
+            start = rows[-1]['ROWID'] if rows else end
+            ops = [handler._create_index_op(handler._get_document_id(row),
+                                            row, handler._swift_client)
+                   for row in rows if not row['deleted']]
+            if handler._rollover:
+                # The documents in the older indexes of the alias are
+                # replaced in their index
+                ops = handler._route_ops(ops)
+            errors += handler._bulk_index(ops, chunk_size=self.bulk_size)
+            indexed += len(ops)
+        return indexed, errors
+
+    def run(self):
+        handler = MetadataSync(self._crawler.status_dir, self._settings,
+                               concurrency=self.workers)
+        broker, broker_info = self._crawler.get_local_broker(
+            self._settings['account'], self._settings['container'])
+        max_row = max(broker.get_max_row(), 0)
+        ranges = self.split_rows(max_row, self.workers * 4)
+        self.logger.info('Backfilling %s/%s into %s: %d rows in %d ranges' % (
+            self._settings['account'], self._settings['container'],
+            handler._index, max_row, len(ranges)))
+
+        index_client = elasticsearch.client.IndicesClient(handler._es_conn)
+        saved_settings = self._get_index_settings(
+            index_client, handler._index)
+        index_client.put_settings(index=handler._index,
+                                  body={'index': self.LOAD_SETTINGS})
+        indexed = 0
+        errors = []
+        try:
+            pool = eventlet.GreenPool(self.workers)
+            for range_indexed, range_errors in pool.imap(
+                    lambda row_range: self._backfill_range(
+                        handler, broker, *row_range), ranges):
+                indexed += range_indexed
+                errors += range_errors
+        finally:
+            index_client.put_settings(index=handler._index,
+                                      body={'index': saved_settings})
+        # Leaves the checkpoint as is, as the next run of the daemon (or the
+        # backfill) must process these rows.
+        handler._check_errors(errors)
+
+        index_client.refresh(index=handler._index)
+        handler.save_last_row(max_row, broker_info['id'])
+        self.logger.info('Backfilled %d documents into %s' % (
+            indexed, handler._index))
+        return indexed
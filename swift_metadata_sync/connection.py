@@ -0,0 +1,102 @@
+import elasticsearch
+import gzip
+
+from elasticsearch.connection import Urllib3HttpConnection
+from elasticsearch.connection_pool import RoundRobinSelector
+
+from .utils import FastJSONSerializer
+
+# The clients shared by the handlers (which are created on every poll), by
+# cluster and connection options.
+_CLIENTS = {}
+
+# The timeout of the requests that discover the nodes of the cluster
+SNIFF_TIMEOUT = 1
+
+
+class _GzipRequestPool(object):
+    """
+        Wraps a urllib3 connection pool to compress the request bodies.
+    """
+
+    def __init__(self, pool, compress_level):
+        self._pool = pool
+        self._compress_level = compress_level
+
+    def urlopen(self, method, url, body=None, headers=None, **kwargs):
+        if body:
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+            body = gzip.compress(body, self._compress_level)
+            headers = dict(headers or {})
+            headers['content-encoding'] = 'gzip'
+        return self._pool.urlopen(method, url, body, headers=headers,
+                                  **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._pool, name)
+
+
+class CompressedHttpConnection(Urllib3HttpConnection):
+    """
+        Elasticsearch connection that gzip-compresses the request bodies and
+        accepts compressed responses (which are decoded by urllib3).
+        Elasticsearch always accepts compressed requests; the responses are
+        only compressed if http.compression is enabled on the cluster.
+
+        elasticsearch-py only supports compression starting with 6.x
+        (http_compress), which does not work with the 5.x clusters.
+    """
+
+    # The zlib default level, as the bulk bodies are large and the higher
+    # levels gain little for JSON.
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.headers['accept-encoding'] = 'gzip,deflate'
+        self.pool = _GzipRequestPool(self.pool, self.COMPRESS_LEVEL)
+
+
+def create_client(hosts, compress=True, fast_json=False, pool_size=1,
+                  timeout=10, sniff=False, sniff_interval=60, dead_timeout=60):
+    """
+    Creates an Elasticsearch client, which spreads the requests over the hosts
+    (round-robin) and does not use a host that failed for dead_timeout seconds
+    (doubled on every consecutive failure).
+
+    :param pool_size: the number of persistent connections to each host.
+    :param sniff: if True, the data nodes of the cluster are discovered from
+                  the hosts on start, every sniff_interval seconds and when a
+                  request fails. The nodes must be reachable on their
+                  published addresses.
+    """
+    options = {'maxsize': pool_size,
+               'timeout': timeout,
+               'dead_timeout': dead_timeout,
+               'selector_class': RoundRobinSelector}
+    if compress:
+        options['connection_class'] = CompressedHttpConnection
+    if fast_json:
+        options['serializer'] = FastJSONSerializer()
+    if sniff:
+        # Master-only nodes are skipped by the default host_info_callback
+        options.update({'sniff_on_start': True,
+                        'sniff_on_connection_fail': True,
+                        'sniffer_timeout': sniff_interval,
+                        'sniff_timeout': SNIFF_TIMEOUT})
+    return elasticsearch.Elasticsearch(hosts, **options)
+
+
+def get_client(hosts, **options):
+    """
+    Returns the client for the hosts and options (see create_client), which is
+    shared by all of the containers that use the same cluster and options, so
+    that they share the connections and the state of the nodes.
+    """
+    key = (repr(hosts), tuple(sorted(options.items())))
+    client = _CLIENTS.get(key)
+    if client is None:
+        client = create_client(hosts, **options)
+        _CLIENTS[key] = client
+    return client
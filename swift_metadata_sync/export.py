@@ -0,0 +1,250 @@
+import elasticsearch.helpers
+import eventlet
+import gzip
+import json
+import logging
+import os
+
+from swift.common.db import DatabaseConnectionError
+from swift.common.internal_client import UnexpectedResponse
+from swift.container.backend import ContainerBroker
+
+from .metadata_sync import MetadataSync
+
+
+MANIFEST = 'manifest.json'
+
+
+class BulkFileWriter(object):
+    """
+        Writes Elasticsearch bulk requests into gzip-compressed NDJSON files,
+        starting a new file once the current one exceeds max_file_size bytes
+        (uncompressed).
+    """
+
+    def __init__(self, path, max_file_size):
+        self.path = path
+        self.max_file_size = max_file_size
+        self.files = []
+        self._file = None
+
+    def _rotate(self):
+        self.close()
+        name = 'bulk-%05d.ndjson.gz' % len(self.files)
+        self._file = gzip.open(os.path.join(self.path, name), 'wb')
+        self.files.append({'name': name, 'documents': 0, 'bytes': 0})
+
+    def write(self, action, source):
+        if not self._file or self.files[-1]['bytes'] >= self.max_file_size:
+            self._rotate()
+        entry = '%s\n%s\n' % (json.dumps(action), json.dumps(source))
+        entry = entry.encode('utf-8')
+        self._file.write(entry)
+        self.files[-1]['documents'] += 1
+        self.files[-1]['bytes'] += len(entry)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+
+class Exporter(object):
+    """
+        Exports the documents of a container as Elasticsearch bulk requests,
+        without contacting the Elasticsearch cluster. Every live row in the
+        container database, up to the max ROWID at the start of the export, is
+        converted into a document with the object's metadata (as in the
+        daemon). The objects that are deleted during the export (the HEAD
+        returns 404) are skipped. The manifest records the container database
+        (its path and ID) and the ROWID high-water mark, which the Loader uses
+        as the checkpoint.
+    """
+
+    def __init__(self, crawler, settings, path, workers=4,
+                 max_file_size=64 * 2**20):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._crawler = crawler
+        self._settings = settings
+        self.path = path
+        self.workers = workers
+        self.max_file_size = max_file_size
+        self.items_chunk = crawler.items_chunk
+
+    def _iter_rows(self, broker, max_row):
+        start = 0
+        while start < max_row:
+            rows = broker.get_items_since(start, self.items_chunk)
+            if not rows:
+                return
+            for row in rows:
+                if row['ROWID'] > max_row:
+                    return
+                if not row['deleted']:
+                    yield row
+            start = rows[-1]['ROWID']
+
+    def run(self):
+        handler = MetadataSync(self._crawler.status_dir, self._settings,
+                               connect=False)
+        broker, broker_info = self._crawler.get_local_broker(
+            self._settings['account'], self._settings['container'])
+        max_row = max(broker.get_max_row(), 0)
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        def _create_op(row):
+            try:
+                return handler._create_index_op(
+                    handler._get_document_id(row), row, handler._swift_client)
+            except UnexpectedResponse as e:
+                # The object was deleted after its row was read: its
+                # tombstone row follows
+                if e.resp.status_int != 404:
+                    raise
+                return None
+
+        writer = BulkFileWriter(self.path, self.max_file_size)
+        pool = eventlet.GreenPool(self.workers)
+        skipped = 0
+        try:
+            for op in pool.imap(_create_op, self._iter_rows(broker, max_row)):
+                if op is None:
+                    skipped += 1
+                    continue
+                writer.write(*elasticsearch.helpers.expand_action(op))
+        finally:
+            writer.close()
+
+        manifest = {'account': self._settings['account'],
+                    'container': self._settings['container'],
+                    'index': handler._index,
+                    'db_path': broker.db_file,
+                    'db_id': broker_info['id'],
+                    'max_row': max_row,
+                    'files': writer.files}
+        # The manifest is written last (and atomically), which marks the
+        # export as complete.
+        manifest_path = os.path.join(self.path, MANIFEST)
+        with open(manifest_path + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.rename(manifest_path + '.tmp', manifest_path)
+        documents = sum([entry['documents'] for entry in writer.files])
+        self.logger.info('Exported %d documents from %s/%s into %d files '
+                         '(skipped %d deleted objects)' % (
+                             documents, self._settings['account'],
+                             self._settings['container'], len(writer.files),
+                             skipped))
+        return manifest
+
+
+class Loader(object):
+    """
+        Loads the bulk files produced by the Exporter into the container's
+        index, with the files sent in parallel. Once every file is loaded, the
+        checkpoint for the container database is set to the exported ROWID
+        high-water mark, if the exported database is on this node (the rows
+        of the other replicas are numbered independently).
+    """
+
+    def __init__(self, status_dir, settings, path, workers=4, bulk_size=1000):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._status_dir = status_dir
+        self._settings = settings
+        self.path = path
+        self.workers = workers
+        self.bulk_size = bulk_size
+
+    @staticmethod
+    def _send(handler, body):
+        response = handler._es_conn.bulk(
+            body='\n'.join(body) + '\n',
+            filter_path=['errors'] + handler.BULK_FILTER_PATH)
+        if not response.get('errors'):
+            return []
+        errors = []
+        for item in response['items']:
+            op_info = item['index']
+            if 200 <= op_info.get('status', 500) < 300:
+                continue
+            errors.append('%s: %s' % (op_info['_id'],
+                                      handler._extract_error(op_info)))
+        return errors
+
+    @staticmethod
+    def _route(handler, actions):
+        # The documents in the older indexes of a rollover alias are replaced
+        # in their index, rather than added to the current index.
+        ops = handler._route_ops([{'_op_type': 'index',
+                                   '_index': action['index']['_index'],
+                                   '_id': action['index']['_id']}
+                                  for action, _ in actions])
+        for (action, _), op in zip(actions, ops):
+            action['index']['_index'] = op['_index']
+
+    def _flush(self, handler, actions):
+        if handler._rollover:
+            self._route(handler, actions)
+        body = []
+        for action, source_line in actions:
+            body.append(json.dumps(action))
+            body.append(source_line)
+        return self._send(handler, body)
+
+    def _load_file(self, handler, name):
+        errors = []
+        actions = []
+        with gzip.open(os.path.join(self.path, name), 'rb') as f:
+            for action_line in f:
+                source_line = next(f).decode('utf-8')
+                action = json.loads(action_line.decode('utf-8'))
+                # The documents are loaded into the configured index, which
+                # allows for migrating to a new index.
+                action['index']['_index'] = handler._index
+                actions.append((action, source_line.rstrip('\n')))
+                if len(actions) >= self.bulk_size:
+                    errors += self._flush(handler, actions)
+                    actions = []
+        if actions:
+            errors += self._flush(handler, actions)
+        return errors
+
+    @staticmethod
+    def _is_local(manifest):
+        """
+        Returns True if the exported container database is on this node.
+        """
+        db_path = manifest.get('db_path')
+        if not db_path or not os.path.exists(db_path):
+            return False
+        try:
+            info = ContainerBroker(db_path).get_info()
+        except DatabaseConnectionError:
+            return False
+        return info['id'] == manifest['db_id']
+
+    def run(self):
+        with open(os.path.join(self.path, MANIFEST)) as f:
+            manifest = json.load(f)
+        handler = MetadataSync(self._status_dir, self._settings,
+                               concurrency=self.workers)
+
+        errors = []
+        pool = eventlet.GreenPool(self.workers)
+        for file_errors in pool.imap(
+                lambda entry: self._load_file(handler, entry['name']),
+                manifest['files']):
+            errors += file_errors
+        handler._check_errors(errors)
+
+        if self._is_local(manifest):
+            handler.save_last_row(manifest['max_row'], manifest['db_id'])
+        else:
+            self.logger.warning(
+                'The exported database %s is not on this node: the daemon '
+                'processes all of the rows of the container' %
+                manifest.get('db_path', manifest['db_id']))
+        self.logger.info('Loaded %d documents into %s' % (
+            sum([entry['documents'] for entry in manifest['files']]),
+            handler._index))
+        return manifest
@@ -0,0 +1,248 @@
+import eventlet
+import eventlet.event
+import logging
+import os.path
+import time
+
+from urllib.parse import quote
+
+from container_crawler.base_sync import BaseSync
+from .metadata_sync import MetadataSync
+from .work_queue import QueuedSync
+
+
+class SharedMetadataClient(object):
+    """
+        Wraps the internal client, so that the targets of a fan-out share the
+        HEAD request for an object. Concurrent requests for the same object
+        wait for the first one. If a request fails, the waiting targets issue
+        their own request.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._requests = {}
+
+    def get_object_metadata(self, account, container, obj, headers=None):
+        key = (account, container, obj)
+        request = self._requests.get(key)
+        if request is not None:
+            meta = request.wait()
+            if meta is not None:
+                return meta
+            # The request failed: retry (or wait for the target that retries)
+            return self.get_object_metadata(account, container, obj, headers)
+
+        request = eventlet.event.Event()
+        self._requests[key] = request
+        try:
+            meta = self._client.get_object_metadata(account, container, obj,
+                                                    headers=headers)
+        except BaseException:
+            del self._requests[key]
+            request.send(None)
+            raise
+        request.send(meta)
+        return meta
+
+
+class FanOutSync(BaseSync):
+    """
+        Indexes a container into several targets (indexes, possibly on
+        different clusters), configured with the "targets" list of the
+        container mapping. Every target is a dictionary of the settings that
+        override the container mapping (e.g. es_hosts, index, pipeline), with
+        an optional "name" (defaults to the index), which must be unique.
+
+        The rows are read once and handed to all of the targets, which are
+        processed concurrently and share the HEAD requests for the objects.
+        Every target has its own checkpoint (in the ".targets/<name>"
+        directory of the status directory). The crawler resumes from the
+        highest checkpoint, and the targets that are behind it (e.g. a new
+        target) catch up separately, from their own checkpoint, so that they
+        do not hold back the others. A target that fails, or does not
+        complete a batch of rows within "target_timeout" seconds (defaults to
+        120), is skipped for "target_retry_interval" seconds (defaults to 60),
+        and then catches up as well.
+    """
+
+    TARGETS_DIR = '.targets'
+    TARGET_TIMEOUT = 120
+    TARGET_RETRY_INTERVAL = 60
+
+    # Maps the status directories of the targets that failed to the time of
+    # the failure, across the handlers (which are created on every poll).
+    _failed_targets = {}
+
+    def __init__(self, status_dir, settings, per_account=False):
+        super().__init__(status_dir, settings, per_account)
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._timeout = settings.get('target_timeout', self.TARGET_TIMEOUT)
+        self._retry_interval = settings.get('target_retry_interval',
+                                            self.TARGET_RETRY_INTERVAL)
+        self._targets = []
+        self._target_dirs = {}
+        # The targets that are skipped on this poll
+        self._failed = set()
+        # The targets that are behind the checkpoint and catch up separately
+        self._lagging = set()
+        self._last_rows = {}
+        for name, target_settings in self.get_target_settings(settings):
+            target_dir = os.path.join(status_dir, self.TARGETS_DIR,
+                                      quote(name, safe=''))
+            self._target_dirs[name] = target_dir
+            failed_at = self._failed_targets.get(target_dir)
+            if failed_at and time.time() - failed_at < self._retry_interval:
+                # The checkpoint of the target is kept until it is retried
+                target = MetadataSync(target_dir, target_settings,
+                                      per_account, connect=False)
+                self._failed.add(name)
+                self._targets.append((name, target))
+                continue
+            try:
+                target = MetadataSync(target_dir, target_settings,
+                                      per_account)
+            except Exception as e:
+                self.logger.error('Failed to connect to the target %s: %r' % (
+                    name, e))
+                target = MetadataSync(target_dir, target_settings,
+                                      per_account, connect=False)
+                self._fail(name)
+            self._targets.append((name, target))
+        # The targets check whether the crawler is stopping through the
+        # fan-out, which the crawler gives its check once it is created
+        for _, target in self._targets:
+            target.is_stopping = lambda: self.is_stopping()
+        self._pool = eventlet.GreenPool(len(self._targets))
+
+    @staticmethod
+    def get_target_settings(settings):
+        """
+        Returns the list of (name, settings) tuples of the targets of a
+        container mapping.
+        """
+        base = dict((key, value) for key, value in settings.items()
+                    if key != 'targets')
+        targets = []
+        for target in settings['targets']:
+            target_settings = dict(base, **target)
+            targets.append((target.get('name', target_settings['index']),
+                            target_settings))
+        names = [name for name, _ in targets]
+        if len(set(names)) != len(names):
+            raise ValueError('The target names of %s/%s are not unique: %s' % (
+                settings['account'], settings['container'], names))
+        return targets
+
+    def _fail(self, name):
+        self._failed.add(name)
+        self._failed_targets[self._target_dirs[name]] = time.time()
+
+    def _skipped(self, name):
+        return name in self._failed or name in self._lagging
+
+    def get_last_row(self, db_id):
+        for name, target in self._targets:
+            self._last_rows[name] = target.get_last_row(db_id)
+        last_rows = [row for name, row in self._last_rows.items()
+                     if name not in self._failed]
+        if not last_rows:
+            self._lagging = set()
+            return min(self._last_rows.values())
+        last_row = max(last_rows)
+        self._lagging = set(name for name, row in self._last_rows.items()
+                            if name not in self._failed and row < last_row)
+        return last_row
+
+    def get_lagging(self, db_id):
+        return [TargetCatchUp(self, name, target)
+                for name, target in self._targets if name in self._lagging]
+
+    def _save_target_row(self, name, target, row_id, db_id):
+        # The crawler may resume before the checkpoint of a target, which is
+        # never moved back.
+        if row_id <= self._last_rows.get(name, 0):
+            return
+        target.save_last_row(row_id, db_id)
+        self._last_rows[name] = row_id
+
+    def save_last_row(self, row_id, db_id):
+        for name, target in self._targets:
+            if not self._skipped(name):
+                self._save_target_row(name, target, row_id, db_id)
+
+    def handle_empty_container(self, rows):
+        # The rows are only skipped if every target removed the documents
+        removed = [target.handle_empty_container(rows)
+                   for name, target in self._targets
+                   if not self._skipped(name)]
+        return bool(removed) and all(removed)
+
+    def _handle_target(self, name, target, rows, client):
+        rows = [row for row in rows
+                if row['ROWID'] > self._last_rows.get(name, 0)]
+        try:
+            with eventlet.Timeout(self._timeout):
+                target.handle_internal(rows, client)
+        except (Exception, eventlet.Timeout) as e:
+            self.logger.error('Failed to process %s/%s in the target %s: %r'
+                              % (self._account, self._container, name, e))
+            self._fail(name)
+            return False
+        self._failed_targets.pop(self._target_dirs[name], None)
+        return True
+
+    def handle(self, rows):
+        # The rows may be an iterator, which is consumed by every target
+        rows = list(rows)
+        if not rows:
+            return
+        client = SharedMetadataClient(self._swift_client)
+        for name, target in self._targets:
+            if not self._skipped(name):
+                self._pool.spawn_n(self._handle_target, name, target, rows,
+                                   client)
+        self._pool.waitall()
+        if len(self._failed) == len(self._targets):
+            raise RuntimeError('Failed to process the rows in all of the '
+                               'targets')
+
+
+class TargetCatchUp(object):
+    """
+        The handler of a target of a FanOutSync that is behind the checkpoint,
+        with which the crawler catches up the target on its own.
+    """
+
+    def __init__(self, fan_out, name, target):
+        self._fan_out = fan_out
+        self._name = name
+        self._target = target
+
+    def get_last_row(self, db_id):
+        return self._fan_out._last_rows[self._name]
+
+    def save_last_row(self, row_id, db_id):
+        self._fan_out._save_target_row(self._name, self._target, row_id,
+                                       db_id)
+
+    def handle(self, rows):
+        client = SharedMetadataClient(self._fan_out._swift_client)
+        if not self._fan_out._handle_target(self._name, self._target,
+                                            list(rows), client):
+            raise RuntimeError('Failed to catch up the target %s' %
+                               self._name)
+
+
+def create_handler(status_dir, settings, per_account=False):
+    """
+    Creates the handler for a container mapping: a FanOutSync if the mapping
+    lists "targets", a QueuedSync if it sets "queue", or a MetadataSync
+    otherwise.
+    """
+    if settings.get('targets'):
+        return FanOutSync(status_dir, settings, per_account)
+    if settings.get('queue'):
+        return QueuedSync(status_dir, settings, per_account)
+    # The containers without new rows do not connect to the cluster
+    return MetadataSync(status_dir, settings, per_account, lazy=True)
@@ -1,15 +1,21 @@
-from distutils.version import StrictVersion
 import elasticsearch
 import elasticsearch.helpers
-import email.utils
 import hashlib
 import json
 import logging
 import os
 import os.path
+import re
+import tempfile
+import time
+import weakref
 
 from swift.common.utils import decode_timestamps
 from container_crawler.base_sync import BaseSync
+from .connection import get_client
+from .projection import MetadataProjection
+from .utils import FAST_JSON, get_file_mode, json_loads, parse_http_date, \
+    parse_version, track_request
 
 
 class MetadataSync(BaseSync):
@@ -28,26 +34,181 @@ class MetadataSync(BaseSync):
         "x-trans-id": {"type": "string", "index": "not_analyzed"}
     }
     USER_META_PREFIX = 'x-object-meta-'
-
-    def __init__(self, status_dir, settings, per_account=False):
-        super().__init__(status_dir, settings)
-        # Note that the syntax changed in Python 3.0: you can just say super().__init__() instead of super(ChildB, self).__init__()
-        # super(MetadataSync, self).__init__(status_dir, settings, per_account)
+    # The mapped headers that are copied into the documents as is (the other
+    # fields are computed).
+    COPIED_HEADERS = frozenset(DOC_MAPPING.keys()) - frozenset([
+        'last-modified', 'x-swift-account', 'x-swift-container',
+        'x-swift-object', 'x-timestamp'])
+    # The responses only include the fields that are used to process them.
+    # The bulk helpers match the response items to the actions by position,
+    # so every item is kept (with its status), rather than only the errors.
+    BULK_FILTER_PATH = ['items.*._id', 'items.*.status', 'items.*.error',
+                        'items.*.result', 'items.*.found']
+    MGET_FILTER_PATH = ['docs._id', 'docs.found', 'docs._source', 'docs.error']
+    # The number of rows of an empty container past which its documents are
+    # removed with a delete-by-query, rather than one delete per row.
+    DELETE_BY_QUERY_THRESHOLD = 10000
+    # How often (in seconds) a delete-by-query task is checked for completion
+    TASK_POLL_INTERVAL = 5
+    # How often (in seconds) the rollover conditions of an alias are checked
+    ROLLOVER_INTERVAL = 300
+    # The persistent connections to each Elasticsearch host, which are shared
+    # by the containers of the cluster (e.g. the shards of a container that
+    # are processed concurrently).
+    ES_POOL_SIZE = 4
+    # The maximum number of documents looked up in a search of an alias
+    LOOKUP_SIZE = 1000
+    # The characters of the container names that are not allowed in the index
+    # names, and the maximum length (in bytes) of an index name
+    INVALID_INDEX_CHARS = re.compile(r'[\\/*?"<>|,#: ]')
+    MAX_INDEX_NAME = 255
+    # Maps the (hosts, alias) of the rollover aliases to the time of their
+    # next check, across the handlers (which are created on every poll).
+    _rollover_checks = {}
+    # Maps the (hosts, index, account, container) of the empty containers to
+    # their delete-by-query task that was still running when the crawler
+    # stopped waiting for it, across the handlers.
+    _delete_tasks = {}
+    # Maps the (hosts, alias) of the rollover aliases to their write index,
+    # as of their last check.
+    _write_indexes = {}
+    # The errors of creating the first index of an alias that was created
+    # concurrently (by another daemon)
+    INDEX_EXISTS_ERRORS = frozenset(['resource_already_exists_exception',
+                                     'index_already_exists_exception'])
+    # Maps the (shared) clients of the clusters to the (index, mapping
+    # version) of the mappings that were verified, so that every mapping is
+    # verified once, rather than by every handler.
+    _verified_mappings = weakref.WeakKeyDictionary()
+    # Maps the (shared) clients of the clusters to the version of their
+    # server, so that connecting to a verified index sends no requests.
+    _server_versions = weakref.WeakKeyDictionary()
+    # The bulk errors that cause the mapping to be verified again
+    MAPPING_ERRORS = frozenset(['mapper_parsing_exception',
+                                'strict_dynamic_mapping_exception'])
+
+    def __init__(self, status_dir, settings, per_account=False, connect=True,
+                 concurrency=1, lazy=False):
+        """
+        :param connect: if False, the handler does not connect to the
+                        Elasticsearch cluster, and can only be used to create
+                        documents (e.g. to export them).
+        :param lazy: if True, the handler connects to the cluster when it is
+                     first given rows to process, rather than when it is
+                     created, so that the containers without new rows do not
+                     require the cluster.
+        :param concurrency: the number of green threads that use the handler,
+                            which sets the minimum number of persistent
+                            connections to each Elasticsearch host.
+        """
+        super().__init__(status_dir, settings, per_account)
 
         self.logger = logging.getLogger('swift-metadata-sync')
-        es_hosts = settings['es_hosts']
-        self._es_conn = elasticsearch.Elasticsearch(es_hosts)
-        self._server_version = StrictVersion(
-            self._es_conn.info()['version']['number'])
-        self._index = settings['index']
+        self._index = self._get_index_name(settings['index'])
         self._parse_json = settings.get('parse_json', False)
+        # The metadata options of the container, if any are set
+        self._projection = MetadataProjection.from_settings(settings)
+        # The user metadata fields may be mapped up front (e.g. to index a
+        # field as a keyword or a date, rather than as the detected type).
+        self._doc_mapping = dict(self.DOC_MAPPING,
+                                 **settings.get('metadata_mapping', {}))
+        self._mapping_version = hashlib.sha256(json.dumps(
+            self._doc_mapping, sort_keys=True).encode('utf-8')).hexdigest()
         self._pipeline = settings.get('pipeline')
-        self._verify_mapping()
-
+        # With rollover, the index is an alias of the rollover-managed
+        # indexes (e.g. "<alias>-000001").
+        self._rollover = settings.get('rollover')
+        # The IDs of the documents that the handler wrote through the alias,
+        # which may not be searchable until the write index is refreshed
+        self._unrefreshed = set()
+        # The documents are routed to the shards by their ID by default. With
+        # "container" routing, all of the documents of the container are on
+        # the same shard, while "partition" routing spreads them over
+        # routing_partitions shards.
+        self._routing = settings.get('routing')
+        if self._routing not in (None, 'container', 'partition'):
+            raise ValueError('Unknown routing: %s' % self._routing)
+        self._routing_partitions = settings.get('routing_partitions', 8)
+        self._delete_by_query_threshold = settings.get(
+            'delete_by_query_threshold', self.DELETE_BY_QUERY_THRESHOLD)
+        self._delete_by_query_options = {
+            'slices': settings.get('delete_by_query_slices', 5),
+            'requests_per_second': settings.get('delete_by_query_rate', -1)}
+        self.debugLevel = 1
+        # The document IDs are hashes of "<account>/<container>/<name>". The
+        # hash of the constant prefix is computed once and copied for every
+        # name.
+        self._id_prefix_hash = hashlib.sha256(
+            ('%s/%s/' % (self._account, self._container)).encode('utf-8'))
+        # The routing keys are derived from the same hash, as the container
+        # names may include the commas that separate the routing values.
+        self._routing_key = self._id_prefix_hash.hexdigest()[:16]
         self.logger.debug('metadata_sync: init: settings: %s' % repr(settings))
+        self._es_conn = None
+        self._server_version = None
+        self._settings = settings
+        self._concurrency = concurrency
+        self._lazy = connect and lazy
+        if connect and not lazy:
+            self.connect()
+
+    def connect(self):
+        """
+        Connects to the Elasticsearch cluster of the container and verifies
+        the mapping (or the rollover alias) of the index.
+        """
+        settings = self._settings
+        concurrency = self._concurrency
+        es_hosts = settings['es_hosts']
+        # The client is shared with the other containers of the cluster
+        self._es_conn = get_client(
+            es_hosts,
+            compress=settings.get('es_compress', True),
+            fast_json=FAST_JSON,
+            pool_size=max(concurrency, settings.get('es_pool_size',
+                                                    self.ES_POOL_SIZE)),
+            timeout=settings.get('es_timeout', 10),
+            sniff=settings.get('es_sniff', False),
+            sniff_interval=settings.get('es_sniff_interval', 60),
+            dead_timeout=settings.get('es_dead_timeout', 60))
+        version = self._server_versions.get(self._es_conn)
+        if version is None:
+            version = parse_version(self._es_conn.info()['version']['number'])
+            self._server_versions[self._es_conn] = version
+        self._server_version = version
+        if self._rollover:
+            self._verify_rollover(es_hosts, settings.get(
+                'rollover_interval', self.ROLLOVER_INTERVAL))
+        else:
+            self._verify_mapping()
+        self._lazy = False
+
         self.logger.debug('metadata_sync: init: elasticsearch version: %s' % repr(self._server_version))
 
-        self.debugLevel = 1
+    def _get_index_name(self, index):
+        # Containers discovered in an account may be mapped to an index per
+        # container, with the "{container}" placeholder. Elasticsearch index
+        # names must be lowercase.
+        if not self._per_account or '{container}' not in index:
+            return index
+        name = self.INVALID_INDEX_CHARS.sub('_', self._container.lower())
+        if index.startswith('{container}'):
+            name = name.lstrip('_-+')
+        # The container names are case-sensitive
+        if name != self._container or name in ('', '.', '..') or len(
+                index.replace('{container}', name).encode('utf-8')) > \
+                self.MAX_INDEX_NAME:
+            # The names that had to be changed are suffixed with the hash of
+            # the container name, so that they do not collide.
+            digest = hashlib.sha1(
+                self._container.encode('utf-8')).hexdigest()[:8]
+            fixed = len(index.replace('{container}', '').encode('utf-8'))
+            size = (self.MAX_INDEX_NAME - fixed) // \
+                index.count('{container}') - len(digest) - 1
+            name = name.encode('utf-8')[:max(size, 0)].decode(
+                'utf-8', 'ignore').rstrip('.')
+            name = '%s-%s' % (name, digest) if name else digest
+        return index.replace('{container}', name)
 
     def get_last_row(self, db_id):
         if not os.path.exists(self._status_file):
@@ -68,45 +229,58 @@ class MetadataSync(BaseSync):
 
     def save_last_row(self, row_id, db_id):
         if not os.path.exists(self._status_account_dir):
-            os.mkdir(self._status_account_dir)
-        if not os.path.exists(self._status_file):
-            with open(self._status_file, 'w') as f:
-                json.dump({db_id: dict(last_row=row_id,
-                                       index=self._index)}, f)
-                return
-
-        with open(self._status_file, 'r+') as f:
-            try:
-                status = json.load(f)
-            except ValueError:
-                status = {}
-            status[db_id] = dict(last_row=row_id, index=self._index)
-            f.seek(0)
-            json.dump(status, f)
-            f.truncate()
-            return
+            os.makedirs(self._status_account_dir)
+        status = {}
+        if os.path.exists(self._status_file):
+            with open(self._status_file) as f:
+                try:
+                    status = json.load(f)
+                except ValueError:
+                    status = {}
+        status[db_id] = dict(last_row=row_id, index=self._index)
+
+        # The status is written to a temporary file, which then replaces the
+        # status file, so that the checkpoint is never left partially written
+        # if the daemon is stopped.
+        fd, tmp_path = tempfile.mkstemp(dir=self._status_account_dir,
+                                        prefix='.status-')
+        try:
+            # The status files keep the permissions of the files created
+            # with open(), for the tools that read them
+            os.fchmod(fd, get_file_mode())
+            with os.fdopen(fd, 'w') as f:
+                json.dump(status, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_path, self._status_file)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
 
     def handle(self, rows):
-        self.logger.debug("Handling rows: %s" % repr(rows))
         self.handle_internal(rows, self._swift_client)
 
     # container_crawler/__init__.py : submit_items -> handle
     def handle_internal(self, rows, internal_client):
-        self.logger.debug("Handling rows: %s" % repr(rows))
+        # NOTE: rows may be an iterator, which must only be consumed once.
+        # The arguments are passed to the logger, as opposed to formatting the
+        # message, to avoid building the representation of every row (and its
+        # metadata) when debug logging is disabled.
+        self.logger.debug('Handling rows: %r', rows)
         if not rows:
             return []
+        if self._lazy:
+            self.connect()
         errors = []
 
         bulk_delete_ops = []
         mget_map = {}
         for row in rows:
             if row['deleted']:
-                bulk_delete_ops.append({'_op_type': 'delete',
-                                        '_id': self._get_document_id(row),
-                                        '_index': self._index,
-                                        '_type': self.DOC_TYPE})
+                bulk_delete_ops.append(self._create_delete_op(
+                    self._get_document_id(row)))
                 continue
-            self.logger.debug('row: %s' % row)
+            self.logger.debug('row: %s', row)
             row_key = self._get_document_id(row)
             mget_map[row_key] = row
 
@@ -120,25 +294,68 @@ class MetadataSync(BaseSync):
 
         stale_rows, mget_errors = self._get_stale_rows(mget_map)
         errors += mget_errors
-        update_ops = [self._create_index_op(doc_id, row, internal_client)
-                      for doc_id, row in stale_rows]
-        _, update_failures = elasticsearch.helpers.bulk(
-            self._es_conn,
-            update_ops,
-            raise_on_error=False,
-            raise_on_exception=False
-        )
-        self.logger.debug("Index operations: %s" % repr(update_ops))
-
-        for op in update_failures:
-            op_info = op['index']
-            if 'exception' in op_info:
-                errors.append(op_info['exception'])
-            else:
-                errors.append("%s: %s" % (
-                    op_info['_id'], self._extract_error(op_info)))
+        update_ops = [self._create_index_op(doc_id, row, internal_client,
+                                            index)
+                      for doc_id, row, index in stale_rows]
+        errors += self._bulk_index(update_ops)
+        self.logger.debug('Index operations: %r', update_ops)
         self._check_errors(errors)
 
+    def handle_empty_container(self, rows):
+        """
+        Removes all of the documents of an empty container with a single
+        delete-by-query (sliced and throttled according to the settings),
+        rather than a delete for every tombstone row. Requires Elasticsearch
+        5.x or newer.
+        """
+        if not self._delete_by_query_threshold or \
+                rows < self._delete_by_query_threshold:
+            return False
+        if self._lazy:
+            self.connect()
+        if self._server_version is None or \
+                self._server_version < (5, 0):
+            return False
+        query = {'query': {'bool': {'filter': [
+            {'term': {'x-swift-account.keyword': self._account}},
+            {'term': {'x-swift-container.keyword': self._container}}]}}}
+        key = (repr(self._settings['es_hosts']), self._index, self._account,
+               self._container)
+        try:
+            with track_request('delete_by_query'):
+                task = self._delete_tasks.pop(key, None)
+                if task is None:
+                    task = self._es_conn.delete_by_query(
+                        index=self._index, doc_type=self.DOC_TYPE,
+                        body=query, conflicts='proceed', refresh=True,
+                        wait_for_completion=False,
+                        **dict(self._delete_by_query_options,
+                               **self._routing_params()))['task']
+                # The task may run for longer than a request timeout
+                status = self._es_conn.tasks.get(task_id=task)
+                while not status.get('completed'):
+                    if self.is_stopping():
+                        # The task is left running: the next poll waits for
+                        # it, rather than deleting the documents again.
+                        self._delete_tasks[key] = task
+                        return False
+                    time.sleep(self.TASK_POLL_INTERVAL)
+                    status = self._es_conn.tasks.get(task_id=task)
+        except elasticsearch.TransportError as e:
+            self.logger.error('Failed to delete the documents of %s/%s: %r' % (
+                self._account, self._container, e))
+            return False
+        response = status.get('response', {})
+        if status.get('error') or response.get('failures'):
+            self.logger.error('Failed to delete the documents of %s/%s: %s' % (
+                self._account, self._container,
+                status.get('error') or response['failures']))
+            return False
+        self.logger.info('Deleted %d documents of the empty container %s/%s'
+                         % (response.get('deleted', 0), self._account,
+                            self._container))
+        return True
+
     def _check_errors(self, errors):
         if not errors:
             return
@@ -147,23 +364,89 @@ class MetadataSync(BaseSync):
             self.logger.error(str(error))
         raise RuntimeError('Failed to process some entries')
 
-    def _bulk_delete(self, ops):
+    @staticmethod
+    def _is_rejected(op_info):
+        # A client error, other than a version conflict or a rejected
+        # request (429), fails again if the operation is retried
+        status = op_info.get('status')
+        return isinstance(status, int) and 400 <= status < 500 and \
+            status not in (409, 429)
+
+    def _bulk_index(self, ops, rejected=None, **kwargs):
+        """
+        Indexes the documents. With rejected set, the failures of the
+        operations that can not succeed if they are retried are added to it
+        as (_id, error), rather than reported as errors.
+        """
+        errors = []
+        if self._rollover:
+            ops = list(ops)
+            self._unrefreshed.update(op['_id'] for op in ops
+                                     if op.get('_index') == self._index)
+        with track_request('bulk'):
+            _, update_failures = elasticsearch.helpers.bulk(
+                self._es_conn,
+                ops,
+                raise_on_error=False,
+                raise_on_exception=False,
+                filter_path=self.BULK_FILTER_PATH,
+                **kwargs
+            )
+
+        for op in update_failures:
+            op_info = op['index']
+            error = op_info.get('error')
+            if isinstance(error, dict) and \
+                    error.get('type') in self.MAPPING_ERRORS:
+                # The mapping may have been changed (e.g. the index was
+                # recreated)
+                self._verified_mappings.get(self._es_conn, set()).discard(
+                    (self._index, self._mapping_version))
+            if rejected is not None and self._is_rejected(op_info):
+                rejected.append((op_info['_id'],
+                                 self._extract_error(op_info)))
+            elif 'exception' in op_info:
+                errors.append(op_info['exception'])
+            else:
+                errors.append("%s: %s" % (
+                    op_info['_id'], self._extract_error(op_info)))
+        return errors
+
+    def _bulk_delete(self, ops, ignore_conflicts=False, rejected=None):
+        """
+        Deletes the documents. With ignore_conflicts, the deletes whose
+        _version no longer matches the document are skipped, rather than
+        reported as errors. With rejected set, the failures of the deletes
+        that can not succeed if they are retried are added to it as (_id,
+        error).
+        """
         errors = []
-        success_count, delete_failures = elasticsearch.helpers.bulk(
-            self._es_conn, ops,
-            raise_on_error=False,
-            raise_on_exception=False
-        )
+        if self._rollover:
+            ops = self._route_ops(ops)
+            if not ops:
+                return errors
+        with track_request('bulk'):
+            success_count, delete_failures = elasticsearch.helpers.bulk(
+                self._es_conn, ops,
+                raise_on_error=False,
+                raise_on_exception=False,
+                filter_path=self.BULK_FILTER_PATH
+            )
 
         for op in delete_failures:
             op_info = op['delete']
+            if op_info['status'] == 409 and ignore_conflicts:
+                continue
             if op_info['status'] == 404:
                 if op_info.get('result') == 'not_found':
                     continue
                 # < 5.x Elasticsearch versions do not return "result"
                 if op_info.get('found') is False:
                     continue
-            if 'exception' in op_info:
+            if rejected is not None and self._is_rejected(op_info):
+                rejected.append((op_info['_id'],
+                                 self._extract_error(op_info)))
+            elif 'exception' in op_info:
                 errors.append(op_info['exception'])
             else:
                 errors.append("%s: %s" % (op_info['_id'],
@@ -181,11 +464,28 @@ class MetadataSync(BaseSync):
         stale_rows = []
 
         # print('_get_stale_rows: mget_map.keys:',list(mget_map.keys()))
-        results = self._es_conn.mget(body={'ids': list(mget_map.keys()) },
-                                     index=self._index,
-                                     refresh=True,
-                                     _source=['x-timestamp'])
-        docs = results['docs']
+        if self._rollover:
+            # The documents may be in any of the indexes of the alias
+            found = self._find_documents(list(mget_map.keys()),
+                                         ['x-timestamp'])
+            docs = [dict(found[doc_id], found=True) if doc_id in found
+                    else {'_id': doc_id, 'found': False}
+                    for doc_id in mget_map]
+        else:
+            if self._routing:
+                body = {'docs': [{'_id': doc_id,
+                                  '_routing': self._get_routing(doc_id)}
+                                 for doc_id in mget_map]}
+            else:
+                body = {'ids': list(mget_map.keys())}
+            with track_request('mget'):
+                results = self._es_conn.mget(
+                    body=body,
+                    index=self._index,
+                    refresh=True,
+                    _source=['x-timestamp'],
+                    filter_path=self.MGET_FILTER_PATH)
+            docs = results['docs']
         for doc in docs:
             row = mget_map.get(doc['_id'])
             if not row:
@@ -200,7 +500,8 @@ class MetadataSync(BaseSync):
             object_ts = int(float(object_date) * 1000)
             if not doc['found'] or object_ts > doc['_source'].get(
                     'x-timestamp', 0):
-                stale_rows.append((doc['_id'], row))
+                # Documents are updated in the index that has them
+                stale_rows.append((doc['_id'], row, doc.get('_index')))
                 continue
 
         # self.logger.debug("Stale rows: %s" % repr(stale_rows))
@@ -208,28 +509,163 @@ class MetadataSync(BaseSync):
 
         return stale_rows, errors
 
-    def _create_index_op(self, doc_id, row, internal_client):
+    def _create_index_op(self, doc_id, row, internal_client, index=None):
         swift_hdrs = {'X-Newest': True}
-        meta = internal_client.get_object_metadata(
-            self._account, self._container, row['name'], headers=swift_hdrs)
+        with track_request('head'):
+            meta = internal_client.get_object_metadata(
+                self._account, self._container, row['name'],
+                headers=swift_hdrs)
         op = {'_op_type': 'index',
-              '_index': self._index,
+              '_index': index or self._index,
               '_type': self.DOC_TYPE,
               '_source': self._create_es_doc(meta, self._account,
                                              self._container,
                                              # row['name'].decode('utf-8'),
                                              row['name'],
-                                             self._parse_json),
+                                             self._parse_json,
+                                             self._projection),
               '_id': doc_id}
         if self._pipeline:
             op['pipeline'] = self._pipeline
+        if self._routing:
+            op['_routing'] = self._get_routing(doc_id)
         return op
 
+    def _create_delete_op(self, doc_id):
+        op = {'_op_type': 'delete',
+              '_id': doc_id,
+              '_index': self._index,
+              '_type': self.DOC_TYPE}
+        if self._routing:
+            op['_routing'] = self._get_routing(doc_id)
+        return op
+
+    def _routing_params(self):
+        routing = self.get_container_routing()
+        return {'routing': routing} if routing else {}
+
+    def _get_routing(self, doc_id):
+        if self._routing == 'container':
+            return self._routing_key
+        if self._routing == 'partition':
+            return '%s-%d' % (self._routing_key,
+                              int(doc_id[:8], 16) % self._routing_partitions)
+        return None
+
+    def get_container_routing(self):
+        """
+        Returns the routing values of the documents of the container, which
+        limit the searches to their shards, or None for the default routing.
+        """
+        if self._routing == 'container':
+            return self._routing_key
+        if self._routing == 'partition':
+            return ','.join('%s-%d' % (self._routing_key, partition)
+                            for partition in range(self._routing_partitions))
+        return None
+
+    def _find_documents(self, ids, source=False):
+        """
+        Searches the rollover alias for the documents with the given IDs.
+        Returns the hits (with the backing index of every document) by ID.
+        """
+        found = {}
+        with track_request('search'):
+            # The search is not real-time, unlike the multi-get: the write
+            # index is only refreshed if the handler wrote any of the
+            # documents through the alias.
+            if not self._unrefreshed.isdisjoint(ids):
+                self._es_conn.indices.refresh(index=self._write_indexes.get(
+                    (repr(self._settings['es_hosts']), self._index),
+                    self._index))
+                self._unrefreshed.clear()
+            for start in range(0, len(ids), self.LOOKUP_SIZE):
+                chunk = ids[start:start + self.LOOKUP_SIZE]
+                results = self._es_conn.search(
+                    index=self._index, doc_type=self.DOC_TYPE,
+                    body={'query': {'ids': {'values': chunk}},
+                          'size': len(chunk), '_source': source},
+                    filter_path=['hits.hits._id', 'hits.hits._index',
+                                 'hits.hits._source'],
+                    **self._routing_params())
+                for hit in results.get('hits', {}).get('hits', []):
+                    found[hit['_id']] = hit
+        return found
+
+    def _route_ops(self, ops):
+        """
+        Sends the operations on the documents that are in the rollover alias
+        to their backing index. The deletes of documents that are not in the
+        alias are dropped, while the other operations go to the alias (that
+        is, to its current index).
+        """
+        ops = list(ops)
+        found = self._find_documents([op['_id'] for op in ops
+                                      if op['_index'] == self._index])
+        routed = []
+        for op in ops:
+            if op['_index'] == self._index:
+                if op['_id'] in found:
+                    op['_index'] = found[op['_id']]['_index']
+                elif op['_op_type'] == 'delete':
+                    continue
+            routed.append(op)
+        return routed
+
+    def _verify_rollover(self, es_hosts, interval):
+        """
+        Applies the document mapping as an index template for the indexes of
+        the rollover alias, creates the first index of the alias if it does
+        not exist, and rolls the alias over to a new index once it meets the
+        rollover conditions (e.g. max_age, max_docs, or max_size). The checks
+        are done every interval seconds.
+        """
+        if self._server_version < (5, 0):
+            raise RuntimeError('Rollover requires Elasticsearch 5.x')
+        key = (repr(es_hosts), self._index)
+        if self._rollover_checks.get(key, 0) > time.time():
+            return
+        index_client = elasticsearch.client.IndicesClient(self._es_conn)
+        pattern = '%s-*' % self._index
+        template = {'mappings': {self.DOC_TYPE: {'properties': dict(
+            [(k, self._update_string_mapping(v))
+             for k, v in self._doc_mapping.items()])}}}
+        if self._server_version >= (6, 0):
+            template['index_patterns'] = [pattern]
+        else:
+            template['template'] = pattern
+        index_client.put_template(name=self._index, body=template)
+        if not index_client.exists_alias(name=self._index):
+            try:
+                index_client.create(index='%s-000001' % self._index,
+                                    body={'aliases': {self._index: {}}})
+                self._write_indexes[key] = '%s-000001' % self._index
+            except elasticsearch.TransportError as e:
+                if e.status_code != 400 or \
+                        e.error not in self.INDEX_EXISTS_ERRORS:
+                    raise
+        else:
+            result = index_client.rollover(
+                alias=self._index, body={'conditions': self._rollover})
+            if result.get('rolled_over'):
+                self.logger.info('Rolled %s over to %s' % (
+                    self._index, result.get('new_index')))
+                self._write_indexes[key] = result.get('new_index')
+            elif result.get('old_index'):
+                self._write_indexes[key] = result['old_index']
+        self._rollover_checks[key] = time.time() + interval
+
     """
-        Verify document mapping for the elastic search index. Does not include
-        any user-defined fields.
+        Verify document mapping for the elastic search index. Only includes
+        the user-defined fields of the metadata_mapping setting. The mapping
+        is verified once per index and version of the mapping for the client
+        (that is, for the cluster), unless the documents fail to index with a
+        mapping error.
     """
     def _verify_mapping(self):
+        verified = self._verified_mappings.setdefault(self._es_conn, set())
+        if (self._index, self._mapping_version) in verified:
+            return
         index_client = elasticsearch.client.IndicesClient(self._es_conn)
         try:
             mapping = index_client.get_mapping(index=self._index,
@@ -242,65 +678,86 @@ class MetadataSync(BaseSync):
             mapping = {}
         if not mapping.get(self._index, None) or \
                 self.DOC_TYPE not in mapping[self._index]['mappings']:
-            missing_fields = self.DOC_MAPPING.keys()
+            missing_fields = self._doc_mapping.keys()
         else:
             current_mapping = mapping[self._index]['mappings'][
                 self.DOC_TYPE]['properties']
             # We are not going to force re-indexing, so won't be checking the
             # mapping format
-            missing_fields = [key for key in self.DOC_MAPPING.keys()
+            missing_fields = [key for key in self._doc_mapping.keys()
                               if key not in current_mapping]
         if missing_fields:
-            new_mapping = dict([(k, v) for k, v in self.DOC_MAPPING.items()
+            new_mapping = dict([(k, v) for k, v in self._doc_mapping.items()
                                 if k in missing_fields])
             # Elasticsearch 5.x deprecated the "string" type. We convert the
             # string fields into the appropriate 5.x types.
             # TODO: Once we remove  support for the 2.x clusters, we should
             # remove this code and create the new mappings for each field.
-            if self._server_version >= StrictVersion('5.0'):
+            if self._server_version >= (5, 0):
                 new_mapping = dict([(k, self._update_string_mapping(v))
                                     for k, v in new_mapping.items()])
             index_client.put_mapping(index=self._index, doc_type=self.DOC_TYPE,
                                      body={'properties': new_mapping})
+        verified.add((self._index, self._mapping_version))
 
     @staticmethod
-    def _create_es_doc(meta, account, container, key, parse_json=False):
-        def _parse_document(value):
-            try:
-                return json.loads(value.decode('utf-8'))
-            except ValueError:
-                return value.decode('utf-8')
-
-        es_doc = {}
-        # ElasticSearch only supports millisecond resolution
-        es_doc['x-timestamp'] = int(float(meta['x-timestamp']) * 1000)
-        # Convert Last-Modified header into a millis since epoch date
-        ts = email.utils.mktime_tz(
-            email.utils.parsedate_tz(meta['last-modified'])) * 1000
-        es_doc['last-modified'] = ts
-        es_doc['x-swift-object'] = key
-        es_doc['x-swift-account'] = account
-        es_doc['x-swift-container'] = container
-
-        # user_meta_keys = dict(
-        #     [(k.split(MetadataSync.USER_META_PREFIX, 1)[1].decode('utf-8'),
-        #       _parse_document(v) if parse_json else v.decode('utf-8'))
-        #      for k, v in meta.items()
-        #      if k.startswith(MetadataSync.USER_META_PREFIX)])
-
-        user_meta_keys = dict(
-            [(k.split(MetadataSync.USER_META_PREFIX, 1)[1],
-              _parse_document(v) if parse_json else v)
-             for k, v in meta.items()
-             if k.startswith(MetadataSync.USER_META_PREFIX)])
-
-        es_doc.update(user_meta_keys)
-        for field in MetadataSync.DOC_MAPPING.keys():
-            if field in es_doc:
-                continue
-            if field not in meta:
-                continue
-            es_doc[field] = meta[field]
+    def _parse_document(value):
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        try:
+            return json_loads(value)
+        except ValueError:
+            return value
+
+    @staticmethod
+    def _create_es_doc(meta, account, container, key, parse_json=False,
+                       projection=None):
+        prefix = MetadataSync.USER_META_PREFIX
+        prefix_len = len(prefix)
+        copied_headers = MetadataSync.COPIED_HEADERS
+
+        es_doc = {
+            # ElasticSearch only supports millisecond resolution
+            'x-timestamp': int(float(meta['x-timestamp']) * 1000),
+            # Convert Last-Modified header into a millis since epoch date
+            'last-modified': parse_http_date(meta['last-modified']),
+            'x-swift-object': key,
+            'x-swift-account': account,
+            'x-swift-container': container
+        }
+        # The headers are classified in a single pass. The user metadata
+        # overrides the other fields, while the mapped headers are only set if
+        # the field is not already set.
+        if projection:
+            return MetadataSync._project_es_doc(
+                es_doc, meta, parse_json, projection)
+        for header, value in meta.items():
+            if header.startswith(prefix):
+                if parse_json:
+                    value = MetadataSync._parse_document(value)
+                es_doc[header[prefix_len:]] = value
+            elif header in copied_headers and header not in es_doc:
+                es_doc[header] = value
+        return es_doc
+
+    @staticmethod
+    def _project_es_doc(es_doc, meta, parse_json, projection):
+        # The same classification, with the options of the container
+        prefix = MetadataSync.USER_META_PREFIX
+        prefix_len = len(prefix)
+        copied_headers = MetadataSync.COPIED_HEADERS - \
+            projection.exclude_fields
+        for header, value in meta.items():
+            if header.startswith(prefix):
+                key = header[prefix_len:]
+                if not projection.includes(key):
+                    continue
+                if parse_json:
+                    es_doc[key] = projection.parse(value)
+                else:
+                    es_doc[key] = projection.truncate(value)
+            elif header in copied_headers and header not in es_doc:
+                es_doc[header] = value
         return es_doc
 
     @staticmethod
@@ -338,11 +795,12 @@ class MetadataSync(BaseSync):
         }
 
     def _get_document_id(self, row):
-        unique_str = '/'.join([self._account,
-                      self._container,
-                      row['name']])
-        unique_str = unique_str.encode('utf-8')
-        if (self.debugLevel > 1): self.logger.debug('_get_document_id: unique_str: %s' % unique_str)
-        unique_id = hashlib.sha256(unique_str).hexdigest()
-        if (self.debugLevel > 1): self.logger.debug('_get_document_id: unique_id: %s' % repr(unique_id))
+        name = row['name']
+        if isinstance(name, str):
+            name = name.encode('utf-8')
+        id_hash = self._id_prefix_hash.copy()
+        id_hash.update(name)
+        unique_id = id_hash.hexdigest()
+        if self.debugLevel > 1:
+            self.logger.debug('_get_document_id: %r: %s', name, unique_id)
         return unique_id
@@ -0,0 +1,93 @@
+import elasticsearch.helpers
+import logging
+
+from .metadata_sync import MetadataSync
+
+
+class RoutingMigration(object):
+    """
+        Moves the documents of a container to the shards of the routing that
+        is configured for the container (e.g. after setting "routing" in the
+        container mapping).
+
+        The documents of the container are scanned across all of the shards.
+        Every document whose routing differs from the configured one is
+        indexed with the new routing and, once that succeeds, deleted with its
+        previous routing, so that the document is never missing from the
+        index. The delete is conditional on the version of the scanned
+        document, as the new copy replaces the document when both routings
+        map to the same shard. The daemon should not process the container
+        during the migration, as the documents it updates could be left on
+        their previous shard. Requires Elasticsearch 5.x or newer for the
+        keyword sub-fields.
+    """
+
+    def __init__(self, status_dir, settings, bulk_size=1000):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._status_dir = status_dir
+        self._settings = settings
+        self.bulk_size = bulk_size
+
+    def iter_moves(self, handler):
+        """
+        Yields the (index, delete) operations that move the documents that
+        are not on the shards of their routing.
+        """
+        query = {'query': {'bool': {'filter': [
+            {'term': {'x-swift-account.keyword': handler._account}},
+            {'term': {'x-swift-container.keyword': handler._container}}]}}}
+        for hit in elasticsearch.helpers.scan(
+                handler._es_conn, query=query, index=handler._index,
+                doc_type=handler.DOC_TYPE, size=self.bulk_size,
+                version=True):
+            routing = handler._get_routing(hit['_id'])
+            if hit.get('_routing') == routing:
+                continue
+            index_op = {'_op_type': 'index',
+                        '_index': hit['_index'],
+                        '_type': handler.DOC_TYPE,
+                        '_id': hit['_id'],
+                        '_source': hit['_source']}
+            if routing:
+                index_op['_routing'] = routing
+            delete_op = {'_op_type': 'delete',
+                         '_index': hit['_index'],
+                         '_type': handler.DOC_TYPE,
+                         '_id': hit['_id']}
+            if hit.get('_routing'):
+                delete_op['_routing'] = hit['_routing']
+            if '_version' in hit:
+                delete_op['_version'] = hit['_version']
+            yield index_op, delete_op
+
+    def _move(self, handler, moves):
+        errors = handler._bulk_index([index_op for index_op, _ in moves])
+        if errors:
+            # The previous copies are kept if the documents were not copied
+            return errors
+        # A conflict means that the copy replaced the document (or the
+        # document was updated since it was scanned), which is kept.
+        return handler._bulk_delete([delete_op for _, delete_op in moves],
+                                    ignore_conflicts=True)
+
+    def run(self):
+        handler = MetadataSync(self._status_dir, self._settings)
+        if handler._server_version < (5, 0):
+            raise RuntimeError('Routing migration requires Elasticsearch 5.x')
+        moved = 0
+        errors = []
+        moves = []
+        for move in self.iter_moves(handler):
+            moves.append(move)
+            if len(moves) >= self.bulk_size:
+                errors += self._move(handler, moves)
+                moved += len(moves)
+                moves = []
+        if moves:
+            errors += self._move(handler, moves)
+            moved += len(moves)
+        self.logger.info('Moved %d documents of %s/%s to the %s routing' % (
+            moved, self._settings['account'], self._settings['container'],
+            handler._routing or 'default'))
+        handler._check_errors(errors)
+        return moved
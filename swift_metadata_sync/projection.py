@@ -0,0 +1,110 @@
+import fnmatch
+import functools
+import re
+
+from .utils import json_loads
+
+
+class _OverLimit(Exception):
+    pass
+
+
+class MetadataProjection(object):
+    """
+        Selects and limits the metadata that is copied into the documents of a
+        container:
+
+        - metadata_include, metadata_exclude: lists of shell-style patterns
+          (e.g. "color", "x-*") of the user metadata keys (without the
+          x-object-meta- prefix) to copy, or to skip. The keys are copied if
+          they match an include pattern (or no include patterns are set) and
+          no exclude pattern.
+        - exclude_fields: the mapped headers (e.g. content-encoding) that are
+          not copied.
+        - metadata_max_size: the maximum number of characters of a metadata
+          value (or of a string in a parsed JSON value); longer values are
+          truncated.
+        - json_max_depth, json_max_fields: the maximum nesting of the objects,
+          and the maximum number of keys, of a parsed JSON value (with
+          parse_json). A value over the limits is indexed as a string.
+    """
+
+    # The distinct metadata keys whose matches are cached
+    MATCH_CACHE_SIZE = 1024
+
+    OPTIONS = ('metadata_include', 'metadata_exclude', 'exclude_fields',
+               'metadata_max_size', 'json_max_depth', 'json_max_fields')
+
+    def __init__(self, include=None, exclude=None, exclude_fields=None,
+                 max_size=None, json_max_depth=None, json_max_fields=None):
+        self._include = self._compile(include)
+        self._exclude = self._compile(exclude)
+        self.exclude_fields = frozenset(exclude_fields or [])
+        self.max_size = max_size
+        self.json_max_depth = json_max_depth
+        self.json_max_fields = json_max_fields
+        self.includes = functools.lru_cache(maxsize=self.MATCH_CACHE_SIZE)(
+            self._matches)
+
+    @classmethod
+    def from_settings(cls, settings):
+        """
+        Returns the projection of a container mapping, or None if the mapping
+        does not set any of the options.
+        """
+        if not any(settings.get(option) for option in cls.OPTIONS):
+            return None
+        return cls(settings.get('metadata_include'),
+                   settings.get('metadata_exclude'),
+                   settings.get('exclude_fields'),
+                   settings.get('metadata_max_size'),
+                   settings.get('json_max_depth'),
+                   settings.get('json_max_fields'))
+
+    @staticmethod
+    def _compile(patterns):
+        # The patterns are combined into a single expression
+        if not patterns:
+            return None
+        return re.compile('|'.join(fnmatch.translate(pattern.lower())
+                                   for pattern in patterns))
+
+    def _matches(self, key):
+        if self._include and not self._include.match(key):
+            return False
+        return not (self._exclude and self._exclude.match(key))
+
+    def truncate(self, value):
+        if self.max_size and isinstance(value, (str, bytes)) and \
+                len(value) > self.max_size:
+            return value[:self.max_size]
+        return value
+
+    def _limit(self, value, depth, fields):
+        if isinstance(value, dict):
+            if self.json_max_depth and depth > self.json_max_depth:
+                raise _OverLimit()
+            fields[0] += len(value)
+            if self.json_max_fields and fields[0] > self.json_max_fields:
+                raise _OverLimit()
+            return dict((key, self._limit(item, depth + 1, fields))
+                        for key, item in value.items())
+        if isinstance(value, list):
+            # The arrays do not nest the fields
+            return [self._limit(item, depth, fields) for item in value]
+        return self.truncate(value)
+
+    def parse(self, value):
+        """
+        Parses a JSON metadata value, within the limits.
+        """
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        try:
+            parsed = json_loads(value)
+        except ValueError:
+            return self.truncate(value)
+        try:
+            return self._limit(parsed, 1, [0])
+        except _OverLimit:
+            return self.truncate(value)
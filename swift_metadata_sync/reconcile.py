@@ -0,0 +1,159 @@
+import json
+import logging
+
+from swift.common.utils import Timestamp
+from .metadata_sync import MetadataSync
+
+
+class Reconciler(object):
+    """
+        Compares the objects in a container with the documents in the index
+        and reports (or repairs) the differences: objects that are missing
+        from the index, documents that are older than the object, and orphaned
+        documents for objects that no longer exist.
+
+        The object listing from the local container database and the index
+        documents for the container (fetched with search_after, sorted by the
+        object name) are merge-joined in a single pass, so memory use does not
+        depend on the size of the container. The document IDs are hashes of the
+        object names, which cannot be produced in order from the container
+        database; the documents are therefore joined on the object name from
+        which the ID is derived. Requires Elasticsearch 5.x or newer for the
+        keyword sub-fields.
+    """
+
+    MISSING = 'missing'
+    STALE = 'stale'
+    ORPHANED = 'orphaned'
+
+    def __init__(self, crawler, settings, repair=False, output=None,
+                 page_size=1000):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._crawler = crawler
+        self._settings = settings
+        self.repair = repair
+        self.output = output
+        self.page_size = page_size
+        self._index_ops = []
+        self._delete_ops = []
+        self._errors = []
+
+    def iter_container(self, broker):
+        """
+        Yields (name, timestamp in milliseconds) of the live objects in the
+        container, sorted by name.
+        """
+        marker = ''
+        while True:
+            objects = broker.list_objects_iter(
+                self.page_size, marker, None, None, None,
+                storage_policy_index=broker.storage_policy_index)
+            if not objects:
+                return
+            for entry in objects:
+                # The timestamp is the metadata timestamp, as with the row
+                # timestamps in MetadataSync._get_last_modified_date()
+                yield entry[0], int(float(Timestamp(entry[1])) * 1000)
+            marker = objects[-1][0]
+
+    def iter_index(self, handler):
+        """
+        Yields (name, document ID, x-timestamp) of the documents of the
+        container in the index, sorted by name.
+        """
+        body = {
+            'query': {'bool': {'filter': [
+                {'term': {'x-swift-account.keyword': handler._account}},
+                {'term': {'x-swift-container.keyword': handler._container}}
+            ]}},
+            'sort': [{'x-swift-object.keyword': 'asc'}],
+            'size': self.page_size,
+            '_source': ['x-swift-object', 'x-timestamp']
+        }
+        while True:
+            results = handler._es_conn.search(
+                index=handler._index, doc_type=handler.DOC_TYPE, body=body,
+                filter_path=['hits.hits._id', 'hits.hits._source',
+                             'hits.hits.sort'],
+                **handler._routing_params())
+            hits = results.get('hits', {}).get('hits', [])
+            if not hits:
+                return
+            for hit in hits:
+                yield (hit['_source']['x-swift-object'], hit['_id'],
+                       hit['_source'].get('x-timestamp', 0))
+            body['search_after'] = hits[-1]['sort']
+
+    def diff(self, container_entries, index_entries):
+        """
+        Merge-joins the two sorted iterators and yields (type, name, doc_id)
+        for every difference.
+        """
+        def _next(entries):
+            return next(entries, None)
+
+        container_entries = iter(container_entries)
+        index_entries = iter(index_entries)
+        obj = _next(container_entries)
+        doc = _next(index_entries)
+        while obj or doc:
+            if doc is None or (obj and obj[0] < doc[0]):
+                yield self.MISSING, obj[0], None
+                obj = _next(container_entries)
+            elif obj is None or doc[0] < obj[0]:
+                yield self.ORPHANED, doc[0], doc[1]
+                doc = _next(index_entries)
+            else:
+                if obj[1] > doc[2]:
+                    yield self.STALE, obj[0], doc[1]
+                obj = _next(container_entries)
+                doc = _next(index_entries)
+
+    def _flush(self, handler, force=False):
+        limit = 1 if force else self.page_size
+        if len(self._delete_ops) >= limit:
+            self._errors += handler._bulk_delete(self._delete_ops)
+            self._delete_ops = []
+        if len(self._index_ops) >= limit:
+            ops = [handler._create_index_op(doc_id, {'name': name},
+                                            handler._swift_client)
+                   for doc_id, name in self._index_ops]
+            if handler._rollover:
+                ops = handler._route_ops(ops)
+            self._errors += handler._bulk_index(ops)
+            self._index_ops = []
+
+    def _repair(self, handler, diff_type, name, doc_id):
+        if diff_type == self.ORPHANED:
+            self._delete_ops.append(handler._create_delete_op(doc_id))
+        else:
+            if not doc_id:
+                doc_id = handler._get_document_id({'name': name})
+            self._index_ops.append((doc_id, name))
+        self._flush(handler)
+
+    def run(self):
+        handler = MetadataSync(self._crawler.status_dir, self._settings)
+        if handler._server_version < (5, 0):
+            raise RuntimeError('Reconciliation requires Elasticsearch 5.x')
+        broker, _ = self._crawler.get_local_broker(
+            self._settings['account'], self._settings['container'])
+
+        counts = {self.MISSING: 0, self.STALE: 0, self.ORPHANED: 0}
+        for diff_type, name, doc_id in self.diff(
+                self.iter_container(broker), self.iter_index(handler)):
+            counts[diff_type] += 1
+            if self.output:
+                self.output.write(json.dumps(
+                    {'type': diff_type, 'name': name, 'id': doc_id}) + '\n')
+            if self.repair:
+                self._repair(handler, diff_type, name, doc_id)
+        if self.repair:
+            self._flush(handler, force=True)
+        self.logger.info(
+            'Reconciled %s/%s with %s: %d missing, %d stale, %d orphaned' % (
+                self._settings['account'], self._settings['container'],
+                handler._index, counts[self.MISSING], counts[self.STALE],
+                counts[self.ORPHANED]))
+        handler._check_errors(self._errors)
+        return counts
@@ -0,0 +1,146 @@
+import eventlet
+import eventlet.wsgi
+import json
+import logging
+import time
+
+from .utils import REQUESTS_IN_FLIGHT
+
+
+class StatsServer(object):
+    """
+        Serves the state of the daemon over HTTP:
+
+        - /health: liveness, 200 if the crawler completed a poll or saved a
+          checkpoint within liveness_timeout seconds (503 otherwise).
+        - /ready: readiness, 200 once the crawler completed its first poll.
+        - /stats: the per-container progress and the requests in flight, as
+          JSON.
+        - /metrics: the same, in the Prometheus text format.
+
+        The server runs in a green thread, so that it does not block the sync
+        loop (and is not blocked by it while the loop waits on I/O).
+    """
+
+    PREFIX = 'swift_metadata_sync_'
+    # (name, type, help, ContainerStats attribute)
+    CONTAINER_METRICS = [
+        ('checkpoint', 'gauge', 'Last checkpointed row', 'checkpoint'),
+        ('backlog_rows', 'gauge', 'Rows past the checkpoint', 'backlog'),
+        ('chunk_rows', 'gauge', 'Maximum rows processed on a poll',
+         'chunk_rows'),
+        ('rows_total', 'counter', 'Rows processed', 'rows'),
+        ('rows_per_second', 'gauge', 'Throughput of the last poll',
+         'rows_per_second'),
+        ('last_success_timestamp_seconds', 'gauge',
+         'Time of the last successful poll', 'last_success'),
+        ('last_failure_timestamp_seconds', 'gauge',
+         'Time of the last failed poll', 'last_failure'),
+    ]
+
+    def __init__(self, crawler, host='127.0.0.1', port=8090,
+                 liveness_timeout=300):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self.crawler = crawler
+        self.host = host
+        self.port = port
+        self.liveness_timeout = liveness_timeout
+        self._thread = None
+
+    def start(self):
+        sock = eventlet.listen((self.host, self.port))
+        self._thread = eventlet.spawn(
+            eventlet.wsgi.server, sock, self.app, max_size=16,
+            log_output=False)
+        self.logger.info('Serving the stats on %s:%d' % (self.host,
+                                                         self.port))
+
+    def stop(self):
+        if self._thread:
+            self._thread.kill()
+            self._thread = None
+
+    def get_stats(self, now=None):
+        now = now or time.time()
+        stats = self.crawler.stats.to_dict()
+        stats['alive'] = self.crawler.stats.is_alive(self.liveness_timeout,
+                                                     now)
+        stats['ready'] = self.crawler.stats.is_ready()
+        stats['requests_in_flight'] = dict(REQUESTS_IN_FLIGHT)
+        return stats
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+            '\n', '\\n')
+
+    def get_metrics(self, now=None):
+        stats = self.get_stats(now)
+        lines = []
+
+        def _metric(name, metric_type, help_text, samples):
+            lines.append('# HELP %s%s %s' % (self.PREFIX, name, help_text))
+            lines.append('# TYPE %s%s %s' % (self.PREFIX, name, metric_type))
+            for labels, value in samples:
+                series = self.PREFIX + name
+                if labels:
+                    series += '{%s}' % ','.join(
+                        '%s="%s"' % (key, self._escape(val))
+                        for key, val in labels)
+                lines.append('%s %s' % (series, value))
+
+        _metric('up', 'gauge', 'Whether the sync loop is alive',
+                [((), int(stats['alive']))])
+        _metric('ready', 'gauge', 'Whether the first poll completed',
+                [((), int(stats['ready']))])
+        _metric('polls_total', 'counter', 'Completed polls',
+                [((), stats['polls'])])
+        if stats['last_poll'] is not None:
+            _metric('last_poll_timestamp_seconds', 'gauge',
+                    'Time of the last completed poll',
+                    [((), stats['last_poll'])])
+        _metric('requests_in_flight', 'gauge',
+                'Requests to Swift and Elasticsearch in progress',
+                [((('type', request_type),), count) for request_type, count
+                 in sorted(stats['requests_in_flight'].items())])
+        containers = sorted(stats['containers'].items())
+        for name, metric_type, help_text, attr in self.CONTAINER_METRICS:
+            samples = []
+            for key, container_stats in containers:
+                if container_stats[attr] is None:
+                    continue
+                account, _, container = key.partition('/')
+                samples.append(((('account', account),
+                                 ('container', container)),
+                                container_stats[attr]))
+            _metric(name, metric_type, help_text, samples)
+        return '\n'.join(lines) + '\n'
+
+    def app(self, environ, start_response):
+        path = environ.get('PATH_INFO', '/')
+        if path == '/health':
+            alive = self.crawler.stats.is_alive(self.liveness_timeout)
+            return self._respond(start_response, 200 if alive else 503,
+                                 'OK\n' if alive else 'Stalled\n')
+        if path == '/ready':
+            ready = self.crawler.stats.is_ready()
+            return self._respond(start_response, 200 if ready else 503,
+                                 'OK\n' if ready else 'Starting\n')
+        if path == '/stats':
+            return self._respond(start_response, 200,
+                                 json.dumps(self.get_stats()),
+                                 'application/json')
+        if path == '/metrics':
+            return self._respond(start_response, 200, self.get_metrics(),
+                                 'text/plain; version=0.0.4')
+        return self._respond(start_response, 404, 'Not Found\n')
+
+    @staticmethod
+    def _respond(start_response, status, body,
+                 content_type='text/plain'):
+        reasons = {200: 'OK', 404: 'Not Found', 503: 'Service Unavailable'}
+        body = body.encode('utf-8')
+        start_response('%d %s' % (status, reasons[status]),
+                       [('Content-Type', content_type),
+                        ('Content-Length', str(len(body)))])
+        return [body]
@@ -0,0 +1,107 @@
+import calendar
+import collections
+import contextlib
+import email.utils
+import functools
+import json
+import os
+import re
+
+from elasticsearch.serializer import JSONSerializer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# orjson is used for the documents and the request bodies, if it is installed
+FAST_JSON = orjson is not None
+
+# The number of requests to Swift and Elasticsearch that are in progress, by
+# type, across the handlers of the process.
+REQUESTS_IN_FLIGHT = collections.Counter()
+
+MONTHS = dict((month, index + 1) for index, month in enumerate(
+    ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+     'Nov', 'Dec']))
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_http_date(value):
+    """
+    Returns the milliseconds since the epoch for an HTTP date. Swift sets
+    Last-Modified as an RFC 1123 date (e.g. "Sun, 06 Nov 1994 08:49:37 GMT"),
+    which is parsed from the fixed positions of its fields; other formats are
+    parsed with email.utils. Objects that are uploaded together share their
+    dates, which are cached.
+    """
+    if len(value) == 29 and value[3] == ',' and value.endswith(' GMT'):
+        try:
+            return calendar.timegm((
+                int(value[12:16]), MONTHS[value[8:11]], int(value[5:7]),
+                int(value[17:19]), int(value[20:22]),
+                int(value[23:25]))) * 1000
+        except (KeyError, ValueError):
+            pass
+    return email.utils.mktime_tz(email.utils.parsedate_tz(value)) * 1000
+
+
+def parse_version(version):
+    """
+    Returns the tuple of the numbers of a version (e.g. (5, 6, 16) for
+    "5.6.16"), which compares like the versions. Replaces distutils'
+    StrictVersion, whose import (through setuptools) is slower than the rest
+    of the startup of the daemon, and which does not accept the pre-release
+    versions (e.g. "7.0.0-alpha1").
+    """
+    return tuple(int(number) for number in
+                 re.findall(r'\d+', version.split('-')[0]))
+
+
+def get_file_mode():
+    """
+    Returns the mode that open() gives to the files it creates (0666 without
+    the bits of the umask, e.g. 0644), for the files that are created with
+    mkstemp (0600).
+    """
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+@contextlib.contextmanager
+def track_request(request_type):
+    REQUESTS_IN_FLIGHT[request_type] += 1
+    try:
+        yield
+    finally:
+        REQUESTS_IN_FLIGHT[request_type] -= 1
+
+
+if FAST_JSON:
+    json_loads = orjson.loads
+else:
+    json_loads = json.loads
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+        Elasticsearch serializer that uses orjson. The values that orjson does
+        not support (e.g. integers over 64 bits) are serialized with the json
+        module.
+    """
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            return super().loads(s)
+
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+        try:
+            return orjson.dumps(data, default=self.default).decode('utf-8')
+        except orjson.JSONEncodeError:
+            return super().dumps(data)
@@ -0,0 +1,251 @@
+import json
+import logging
+import os
+import os.path
+import sqlite3
+import time
+
+from urllib.parse import quote
+
+from .metadata_sync import MetadataSync
+from .utils import json_loads
+
+
+QUEUE_DIR = '.queue'
+
+
+def get_queue_path(status_dir, account, container):
+    return os.path.join(status_dir, QUEUE_DIR, quote(account, safe=''),
+                        quote(container, safe='') + '.db')
+
+
+class WorkQueue(object):
+    """
+        Durable FIFO of the Elasticsearch operations of a container, stored in
+        a SQLite database. The settings of the container are stored with the
+        operations, so that the queue can be drained on its own. The
+        operations that Elasticsearch rejects are kept in a separate table
+        (the dead letters), rather than retried.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path)
+        # The crawler adds to the queue while the indexer reads from it
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=FULL')
+        with self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS ops ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS meta ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS dead ('
+                'id INTEGER PRIMARY KEY AUTOINCREMENT, op TEXT NOT NULL, '
+                'error TEXT NOT NULL)')
+
+    def close(self):
+        self._conn.close()
+
+    def set_settings(self, settings, per_account=False):
+        # The settings are only written (and synced) when they change, rather
+        # than by every handler of the container
+        if self.get_settings() == (settings, per_account):
+            return
+        with self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                ('settings', json.dumps({'settings': settings,
+                                         'per_account': per_account})))
+
+    def get_settings(self):
+        """
+        Returns the (settings, per_account) of the container, or (None, False)
+        if they were not set.
+        """
+        row = self._conn.execute(
+            'SELECT value FROM meta WHERE key = ?', ('settings',)).fetchone()
+        if not row:
+            return None, False
+        value = json_loads(row[0])
+        return value['settings'], value['per_account']
+
+    def put(self, ops):
+        # All of the operations of the rows are added, or none of them
+        with self._conn:
+            self._conn.executemany('INSERT INTO ops (op) VALUES (?)',
+                                   [(json.dumps(op),) for op in ops])
+
+    def get(self, count):
+        """
+        Returns the list of (id, operation) of the oldest count operations.
+        """
+        return [(op_id, json_loads(op)) for op_id, op in self._conn.execute(
+            'SELECT id, op FROM ops ORDER BY id LIMIT ?', (count,))]
+
+    def remove(self, last_id, dead=()):
+        """
+        Removes the operations up to last_id (inclusive), and adds the list of
+        (operation, error) of the rejected ones to the dead letters.
+        """
+        with self._conn:
+            self._conn.execute('DELETE FROM ops WHERE id <= ?', (last_id,))
+            self._conn.executemany(
+                'INSERT INTO dead (op, error) VALUES (?, ?)',
+                [(json.dumps(op), str(error)) for op, error in dead])
+
+    def get_dead(self, count):
+        """
+        Returns the list of (operation, error) of the oldest count dead
+        letters.
+        """
+        return [(json_loads(op), error) for op, error in self._conn.execute(
+            'SELECT op, error FROM dead ORDER BY id LIMIT ?', (count,))]
+
+    def __len__(self):
+        return self._conn.execute('SELECT COUNT(*) FROM ops').fetchone()[0]
+
+
+class QueuedSync(MetadataSync):
+    """
+        Adds the operations of the rows to the work queue of the container
+        (in the ".queue" directory of the status directory), rather than
+        sending them to Elasticsearch, so that the crawler keeps reading the
+        container while the cluster is slow or unavailable. The queue is
+        drained by the QueueIndexer.
+
+        The objects are read (HEAD) when their rows are queued, without
+        checking the index for the current documents, which does not require
+        the cluster. The queue is closed with the handler.
+    """
+
+    def __init__(self, status_dir, settings, per_account=False):
+        super().__init__(status_dir, settings, per_account, connect=False)
+        self._queue = WorkQueue(get_queue_path(status_dir, self._account,
+                                               self._container))
+        self._queue.set_settings(settings, per_account)
+
+    def handle(self, rows):
+        ops = []
+        for row in rows:
+            doc_id = self._get_document_id(row)
+            if row['deleted']:
+                ops.append(self._create_delete_op(doc_id))
+            else:
+                ops.append(self._create_index_op(doc_id, row,
+                                                 self._swift_client))
+        if ops:
+            self._queue.put(ops)
+
+    def handle_empty_container(self, rows):
+        # The documents are removed through the queue
+        return False
+
+    def close(self):
+        self._queue.close()
+
+
+class QueueIndexer(object):
+    """
+        Drains the work queues of the containers into Elasticsearch, in
+        batches of bulk_size operations, which are removed from a queue once
+        they are indexed. A queue that fails (e.g. while its cluster is
+        unavailable) is retried on the next pass, every interval seconds. The
+        operations that fail with a client error (other than 409 or 429) are
+        moved to the dead letters of the queue, so that they do not block it.
+    """
+
+    def __init__(self, status_dir, bulk_size=1000, interval=5):
+        self.logger = logging.getLogger('swift-metadata-sync')
+        self._status_dir = status_dir
+        self.bulk_size = bulk_size
+        self.interval = interval
+
+    def iter_queues(self):
+        for root, _, files in os.walk(os.path.join(self._status_dir,
+                                                   QUEUE_DIR)):
+            for name in sorted(files):
+                if name.endswith('.db'):
+                    yield os.path.join(root, name)
+
+    @staticmethod
+    def _merge(ops):
+        # A document that was queued more than once (e.g. updated on several
+        # polls) only needs its last operation.
+        latest = {}
+        for op in ops:
+            latest.pop(op['_id'], None)
+            latest[op['_id']] = op
+        return list(latest.values())
+
+    def _index(self, handler, ops):
+        """
+        Indexes the operations. Returns the list of (operation, error) of the
+        operations that were rejected.
+        """
+        ops = self._merge(ops)
+        deletes = [op for op in ops if op['_op_type'] == 'delete']
+        updates = [op for op in ops if op['_op_type'] != 'delete']
+        errors = []
+        rejected = []
+        if deletes:
+            errors += handler._bulk_delete(deletes, rejected=rejected)
+        if updates:
+            if handler._rollover:
+                updates = handler._route_ops(updates)
+            errors += handler._bulk_index(updates, rejected=rejected)
+        handler._check_errors(errors)
+        ops_by_id = dict((op['_id'], op) for op in ops)
+        return [(ops_by_id[doc_id], error) for doc_id, error in rejected]
+
+    def drain(self, path):
+        """
+        Indexes the operations of a queue. Returns the number of operations
+        that were removed from the queue.
+        """
+        queue = WorkQueue(path)
+        try:
+            settings, per_account = queue.get_settings()
+            if settings is None:
+                return 0
+            handler = None
+            drained = 0
+            while True:
+                entries = queue.get(self.bulk_size)
+                if not entries:
+                    break
+                if handler is None:
+                    handler = MetadataSync(self._status_dir, settings,
+                                           per_account)
+                dead = self._index(handler, [op for _, op in entries])
+                for op, error in dead:
+                    self.logger.error(
+                        'Moved the rejected operation on %s of %s/%s to the '
+                        'dead letters: %s' % (op['_id'], settings['account'],
+                                              settings['container'], error))
+                queue.remove(entries[-1][0], dead)
+                drained += len(entries)
+            if drained:
+                self.logger.info('Indexed %d queued operations of %s/%s' % (
+                    drained, settings['account'], settings['container']))
+            return drained
+        finally:
+            queue.close()
+
+    def run_once(self):
+        drained = 0
+        for path in self.iter_queues():
+            try:
+                drained += self.drain(path)
+            except Exception as e:
+                self.logger.error('Failed to index the queue %s: %r' % (
+                    path, e))
+        return drained
+
+    def run_always(self):
+        while True:
+            if not self.run_once():
+                time.sleep(self.interval)
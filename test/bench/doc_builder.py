@@ -0,0 +1,114 @@
+"""
+Measures the CPU time to build and serialize a document for an object, with
+the previous document builder and the current one.
+
+The object metadata is modeled on the response to a HEAD request to Swift,
+with the given number of user metadata keys; the Last-Modified dates repeat,
+as with objects that are uploaded together:
+
+    python test/bench/doc_builder.py --documents 20000 --user-meta 8
+"""
+
+import argparse
+import email.utils
+import hashlib
+import json
+import time
+
+from elasticsearch.serializer import JSONSerializer
+
+from swift_metadata_sync.metadata_sync import MetadataSync
+from swift_metadata_sync.utils import FAST_JSON, FastJSONSerializer
+
+
+def legacy_create_es_doc(meta, account, container, key, parse_json=False):
+    """
+    The document builder before the single pass over the headers and the
+    RFC 1123 date parser.
+    """
+    def _parse_document(value):
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+
+    es_doc = {}
+    es_doc['x-timestamp'] = int(float(meta['x-timestamp']) * 1000)
+    ts = email.utils.mktime_tz(
+        email.utils.parsedate_tz(meta['last-modified'])) * 1000
+    es_doc['last-modified'] = ts
+    es_doc['x-swift-object'] = key
+    es_doc['x-swift-account'] = account
+    es_doc['x-swift-container'] = container
+
+    user_meta_keys = dict(
+        [(k.split(MetadataSync.USER_META_PREFIX, 1)[1],
+          _parse_document(v) if parse_json else v)
+         for k, v in meta.items()
+         if k.startswith(MetadataSync.USER_META_PREFIX)])
+
+    es_doc.update(user_meta_keys)
+    for field in MetadataSync.DOC_MAPPING.keys():
+        if field in es_doc:
+            continue
+        if field not in meta:
+            continue
+        es_doc[field] = meta[field]
+    return es_doc
+
+
+def make_meta(count, user_meta):
+    objects = []
+    for i in range(count):
+        timestamp = 1500000000 + i // 50
+        meta = {'content-length': str(1024 * i),
+                'content-type': 'application/octet-stream',
+                'etag': hashlib.md5(str(i).encode('utf-8')).hexdigest(),
+                'last-modified': email.utils.formatdate(timestamp,
+                                                        usegmt=True),
+                'x-timestamp': '%d.%05d' % (timestamp, i % 100000),
+                'x-trans-id': 'tx%021x-%010x' % (i, timestamp),
+                'x-openstack-request-id': 'tx%021x-%010x' % (i, timestamp),
+                'accept-ranges': 'bytes',
+                'date': email.utils.formatdate(timestamp, usegmt=True),
+                'x-backend-timestamp': '%d.%05d' % (timestamp, i % 100000),
+                'x-backend-data-timestamp': '%d.%05d' % (timestamp,
+                                                         i % 100000),
+                'x-backend-durable-timestamp': '%d.%05d' % (timestamp,
+                                                            i % 100000)}
+        for key in range(user_meta):
+            meta['x-object-meta-key-%d' % key] = 'value-%d-%d' % (key, i)
+        meta['x-object-meta-json'] = '{"id": %d, "tags": ["a", "b"]}' % i
+        objects.append(('path/to/object-%d' % i, meta))
+    return objects
+
+
+def measure(objects, builder, serializer, parse_json):
+    start = time.time()
+    for name, meta in objects:
+        serializer.dumps(builder(meta, 'AUTH_account', 'container', name,
+                                 parse_json))
+    return (time.time() - start) / len(objects) * 10**6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=20000)
+    parser.add_argument('--user-meta', type=int, default=8)
+    args = parser.parse_args()
+
+    objects = make_meta(args.documents, args.user_meta)
+    fast_serializer = FastJSONSerializer() if FAST_JSON else JSONSerializer()
+    print('%-10s %12s %12s' % ('', 'us/doc', 'parse_json'))
+    for label, builder, serializer in (
+            ('before', legacy_create_es_doc, JSONSerializer()),
+            ('after', MetadataSync._create_es_doc, fast_serializer)):
+        print('%-10s %12.2f %12.2f' % (
+            label, measure(objects, builder, serializer, False),
+            measure(objects, builder, serializer, True)))
+    if not FAST_JSON:
+        print('orjson is not installed; using the json module')
+
+
+if __name__ == '__main__':
+    main()
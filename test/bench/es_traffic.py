@@ -0,0 +1,140 @@
+"""
+Estimates the bytes sent to and received from Elasticsearch per indexed
+document, with and without request compression and response filtering.
+
+The bulk requests are built from the documents the daemon creates for the
+objects (with the given number of user metadata keys), and the responses are
+modeled on the Elasticsearch 5.x bulk and mget responses. No cluster is
+required:
+
+    python test/bench/es_traffic.py --documents 1000 --user-meta 5
+"""
+
+import argparse
+import email.utils
+import gzip
+import hashlib
+import json
+
+import elasticsearch.helpers
+
+from swift_metadata_sync.connection import CompressedHttpConnection
+from swift_metadata_sync.metadata_sync import MetadataSync
+
+
+def make_ops(count, user_meta):
+    ops = []
+    for i in range(count):
+        meta = {'x-timestamp': '1500000000.%05d' % i,
+                'last-modified': email.utils.formatdate(1500000000,
+                                                        usegmt=True),
+                'content-length': str(1024 * i),
+                'content-type': 'application/octet-stream',
+                'etag': hashlib.md5(str(i).encode('utf-8')).hexdigest()}
+        for key in range(user_meta):
+            meta['x-object-meta-key-%d' % key] = 'value-%d-%d' % (key, i)
+        ops.append({'_op_type': 'index',
+                    '_index': 'index',
+                    '_type': MetadataSync.DOC_TYPE,
+                    '_id': hashlib.sha256(
+                        str(i).encode('utf-8')).hexdigest(),
+                    '_source': MetadataSync._create_es_doc(
+                        meta, 'AUTH_account', 'container',
+                        'path/to/object-%d' % i)})
+    return ops
+
+
+def bulk_body(ops):
+    lines = []
+    for op in ops:
+        action, source = elasticsearch.helpers.expand_action(op)
+        lines.append(json.dumps(action))
+        lines.append(json.dumps(source))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def bulk_response(ops):
+    # The response of Elasticsearch 5.x for the created documents
+    return {'took': 30, 'errors': False, 'items': [
+        {'index': {'_index': op['_index'], '_type': op['_type'],
+                   '_id': op['_id'], '_version': 1, 'result': 'created',
+                   '_shards': {'total': 2, 'successful': 2, 'failed': 0},
+                   'created': True, 'status': 201}} for op in ops]}
+
+
+def mget_response(ops):
+    return {'docs': [
+        {'_index': op['_index'], '_type': op['_type'], '_id': op['_id'],
+         '_version': 1, 'found': True,
+         '_source': {'x-timestamp': op['_source']['x-timestamp']}}
+        for op in ops]}
+
+
+def filter_response(response, filter_path):
+    """
+    Applies the "<list>.<field>" and "<list>.*.<field>" filters to the
+    response, as Elasticsearch does for filter_path.
+    """
+    filtered = {}
+    for path in filter_path:
+        parts = path.split('.')
+        for index, entry in enumerate(response.get(parts[0], [])):
+            target = filtered.setdefault(parts[0], [{} for _ in
+                                                    response[parts[0]]])
+            target = target[index]
+            if parts[1] == '*':
+                op_type = list(entry.keys())[0]
+                entry = entry[op_type]
+                target = target.setdefault(op_type, {})
+            if parts[-1] in entry:
+                target[parts[-1]] = entry[parts[-1]]
+    return filtered
+
+
+def size(data, compress):
+    if not isinstance(data, bytes):
+        data = json.dumps(data).encode('utf-8')
+    if compress:
+        return len(gzip.compress(data,
+                                 CompressedHttpConnection.COMPRESS_LEVEL))
+    return len(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--user-meta', type=int, default=5)
+    args = parser.parse_args()
+
+    ops = make_ops(args.documents, args.user_meta)
+    body = bulk_body(ops)
+    bulk = bulk_response(ops)
+    mget = mget_response(ops)
+    mget_request = {'ids': [op['_id'] for op in ops]}
+
+    rows = []
+    for label, compress, filtered in (('before', False, False),
+                                      ('filter', False, True),
+                                      ('gzip', True, False),
+                                      ('after', True, True)):
+        bulk_resp = bulk
+        mget_resp = mget
+        if filtered:
+            bulk_resp = filter_response(bulk, MetadataSync.BULK_FILTER_PATH)
+            mget_resp = filter_response(mget, MetadataSync.MGET_FILTER_PATH)
+        sent = size(body, compress) + size(mget_request, compress)
+        # The responses are compressed if http.compression is enabled on the
+        # cluster (the default with 5.x)
+        received = size(bulk_resp, compress) + size(mget_resp, compress)
+        rows.append((label, float(sent) / len(ops),
+                     float(received) / len(ops)))
+
+    print('%-8s %12s %12s %12s' % (
+        '', 'sent/doc', 'received/doc', 'total/doc'))
+    for label, sent, received in rows:
+        print('%-8s %12.1f %12.1f %12.1f' % (label, sent, received,
+                                             sent + received))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""
+Measures the startup of the daemon: the time to import the modules of the
+daemon in a new interpreter, with the slowest imports, and the time to create
+the handlers of the containers (which do not connect to Elasticsearch until
+they have rows to process):
+
+    python test/bench/startup.py --runs 5 --handlers 200
+
+Creating the handlers requires the Swift configuration of the node (for the
+internal client).
+"""
+
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def import_times(module, runs):
+    """
+    Returns the wall-clock times of importing the module in new interpreters
+    and the cumulative times (in microseconds) of the imported modules, from
+    the last run.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    times = []
+    modules = {}
+    for _ in range(runs):
+        start = time.time()
+        result = subprocess.run(
+            [sys.executable, '-W', 'ignore', '-X', 'importtime', '-c',
+             'import %s' % module],
+            env=env, stderr=subprocess.PIPE, universal_newlines=True,
+            check=True)
+        times.append(time.time() - start)
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\s*)(\S+)', line)
+        if match:
+            modules[match.group(3)] = (int(match.group(1)),
+                                       len(match.group(2)))
+    return times, modules
+
+
+def handler_time(count):
+    from swift_metadata_sync.fan_out import create_handler
+
+    status_dir = tempfile.mkdtemp()
+    try:
+        start = time.time()
+        for i in range(count):
+            create_handler(status_dir, {'account': 'AUTH_bench',
+                                        'container': 'container-%d' % i,
+                                        'es_hosts': 'localhost',
+                                        'index': 'bench'})
+        return (time.time() - start) / count
+    finally:
+        shutil.rmtree(status_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', default='swift_metadata_sync.__main__')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10)
+    parser.add_argument('--handlers', type=int, default=0)
+    args = parser.parse_args()
+
+    times, modules = import_times(args.module, args.runs)
+    print('import %s: %.1f ms (min %.1f ms)' % (
+        args.module, sorted(times)[len(times) // 2] * 1000,
+        min(times) * 1000))
+    # The slowest imports of the module
+    top_level = sorted(((us, name) for name, (us, indent) in modules.items()
+                        if indent == 2), reverse=True)
+    for us, name in top_level[:args.top]:
+        print('  %-40s %8.1f ms' % (name, us / 1000.0))
+    if args.handlers:
+        try:
+            print('handler: %.2f ms' % (handler_time(args.handlers) * 1000))
+        except Exception as e:
+            print('Failed to create the handlers: %r' % e)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,38 +1,173 @@
 import eventlet
 eventlet.patcher.monkey_patch(all=True)
 
+import collections
+import functools
+import json
 import os.path
 import time
 import traceback
 
 from swift.common.db import DatabaseConnectionError
+from swift.common.internal_client import InternalClient
 from swift.common.ring import Ring
 from swift.common.ring.utils import is_local_device
-from swift.common.utils import whataremyips, hash_path, storage_directory
+from swift.common.utils import whataremyips, hash_path, storage_directory, \
+    ShardRange, Timestamp
+from swift.common.wsgi import ConfigString
 from swift.container.backend import DATADIR, ContainerBroker
 
+from .base_sync import BaseSync
+from .discovery import AccountDiscovery
+from .profiler import CycleProfiler
+from .scheduler import ContainerScheduler
+from .stats import CrawlerStats
+from .watcher import DBWatcher
+
+
+@functools.lru_cache(maxsize=1)
+def get_local_ips():
+    """
+    Returns the IP addresses of the node, which are looked up once per
+    process.
+    """
+    return whataremyips('0.0.0.0')
+
 
 class ContainerCrawler(object):
+    # How often (in seconds) a sleeping crawler checks whether it was stopped
+    # or asked to reload its configuration.
+    WAKE_INTERVAL = 1
+    # The number of open container brokers that are kept between polls
+    BROKER_CACHE_SIZE = 1024
+    # The sharding states of the containers that have shard ranges
+    SHARDED_STATES = frozenset(['sharding', 'sharded'])
+
     def __init__(self, conf, handler_class, logger=None):
         self.logger = logger
-        self.conf = conf
-        self.root = conf['devices']
         self.bulk = conf.get('bulk_process', False)
         self.interval = 10
         self.swift_dir = '/etc/swift'
         self.container_ring = Ring(self.swift_dir, ring_name='container')
+        self._ring_path = os.path.join(self.swift_dir, 'container.ring.gz')
+        self._ring_mtime = self._get_ring_mtime()
+        # Maps the containers to their partition, number of replicas and the
+        # list of (node index, node, database path) of their local replicas,
+        # until the ring changes.
+        self._local_nodes = {}
+        # Maps the paths of the databases to the signature of their directory
+        # and their (open) broker, in least recently used order.
+        self._brokers = collections.OrderedDict()
+        self.broker_cache_size = conf.get('broker_cache_size',
+                                          self.BROKER_CACHE_SIZE)
 
-        self.status_dir = conf['status_dir']
-        self.myips = whataremyips('0.0.0.0')
-        self.items_chunk = conf['items_chunk']
-        self.poll_interval = conf.get('poll_interval', 5)
         self.handler_class = handler_class
+        self.stats = CrawlerStats()
+        self.scheduler = None
+        # Set by stop(), request_reload() and request_profile(), which may be
+        # called from signal handlers.
+        self._stopping = False
+        self._load_conf = None
+        self._profile_cycles = 0
+        self._configure(conf)
+        self.watcher = None
+        if conf.get('watch_dbs', False):
+            self.watcher = DBWatcher.create()
+            if not self.watcher:
+                self.log('warning', 'inotify is not available; polling the '
+                         'container databases instead')
+        # Account settings (with "per_account") are expanded into the local
+        # containers of the account.
+        self.discovery = {}
+        self._swift_client = None
+        self._containers = []
+        # Maps the containers whose root database is not on the node to the
+        # expiration time and the list of their shard ranges.
+        self._shard_ranges = {}
 
         if not self.bulk:
             self._init_workers(conf)
 
         self.log('debug', 'Created the Container Crawler instance')
 
+    @property
+    def myips(self):
+        # Only looked up when the local containers are needed
+        return get_local_ips()
+
+    def _configure(self, conf):
+        """
+        Sets the options that can be changed by reloading the configuration.
+        """
+        previous = getattr(self, 'conf', {})
+        self.conf = conf
+        self.root = conf['devices']
+        self.status_dir = conf['status_dir']
+        self.items_chunk = conf['items_chunk']
+        # Rows are read from the container DB in sub-batches of at most
+        # items_batch rows, which bounds the memory used per container.
+        self.items_batch = min(conf.get('items_batch', self.items_chunk),
+                               self.items_chunk)
+        self.poll_interval = conf.get('poll_interval', 5)
+        self.discovery_batch = conf.get('discovery_batch', 1000)
+        self.shard_workers = conf.get('shard_workers', 4)
+        self.shard_ranges_interval = conf.get('shard_ranges_interval', 300)
+        scheduler = ContainerScheduler(
+            self.items_chunk, self.poll_interval,
+            max_chunks=conf.get('max_chunks_per_poll', 4),
+            max_idle_interval=conf.get('max_idle_interval', 30))
+        if self.scheduler:
+            scheduler.states = self.scheduler.states
+        self.scheduler = scheduler
+        # Maps the paths of the databases that had no new rows on the last
+        # poll to their file signature and the container settings.
+        self._idle_dbs = {}
+        self.profiler = CycleProfiler(
+            conf.get('profile_dir',
+                     os.path.join(self.status_dir, '.profiles')),
+            keep=conf.get('profile_keep', 10),
+            top=conf.get('profile_top', 30), log=self.log)
+        # Reloading the configuration only profiles again if the profiling
+        # options changed
+        profiling = (conf.get('profile', False), conf.get('profile_cycles'))
+        if profiling[0] and profiling != (previous.get('profile', False),
+                                          previous.get('profile_cycles')):
+            self.request_profile()
+
+    def stop(self):
+        """
+        Stops the crawler: the sub-batch of rows that is being processed is
+        completed and checkpointed, but no further rows are read, and
+        run_always() returns. Safe to call from a signal handler.
+        """
+        self._stopping = True
+
+    def request_reload(self, load_conf):
+        """
+        Reloads the configuration returned by load_conf() before the next
+        poll. Safe to call from a signal handler.
+        """
+        self._load_conf = load_conf
+
+    def request_profile(self, cycles=None):
+        """
+        Profiles the next cycles polls (defaults to the profile_cycles
+        option). Safe to call from a signal handler.
+        """
+        self._profile_cycles = cycles or self.conf.get('profile_cycles', 3)
+
+    def reload(self):
+        load_conf, self._load_conf = self._load_conf, None
+        try:
+            conf = load_conf()
+        except Exception as e:
+            self.log('error', 'Failed to reload the configuration: %r' % e)
+            return
+        # The threading options (bulk_process, workers) and watch_dbs require
+        # a restart.
+        self._configure(conf)
+        self.log('info', 'Reloaded the configuration')
+
     def _init_workers(self, conf):
         self.workers = conf.get('workers', 10)
         self.pool = eventlet.GreenPool(self.workers)
@@ -77,13 +212,274 @@ class ContainerCrawler(object):
             return
         getattr(self.logger, level)(message)
 
-    def get_broker(self, account, container, part, node):
+    def is_local_container(self, account, container):
+        _, container_nodes = self.container_ring.get_nodes(account, container)
+        return any(is_local_device(self.myips, None, node['ip'], node['port'])
+                   for node in container_nodes)
+
+    def _list_containers(self, account, marker):
+        return (container['name'] for container in
+                self._get_swift_client().iter_containers(account,
+                                                         marker=marker))
+
+    def _get_discovery(self, settings):
+        discovery = self.discovery.get(settings['account'])
+        if not discovery or discovery.settings != settings:
+            discovery = AccountDiscovery(
+                settings, self._list_containers, self.is_local_container,
+                self.discovery_batch)
+            self.discovery[settings['account']] = discovery
+        return discovery
+
+    def get_containers(self):
+        """
+        Returns the settings of all of the containers to process, including the
+        containers discovered in the accounts configured with "per_account".
+        """
+        containers = []
+        for settings in self.conf['containers']:
+            if not settings.get('per_account'):
+                containers.append(settings)
+                continue
+            discovery = self._get_discovery(settings)
+            try:
+                containers.extend(discovery.discover())
+            except Exception as e:
+                self.log('error', 'Failed to list the containers in %s: %r' % (
+                    settings['account'], e))
+                containers.extend(discovery.containers.values())
+        return containers
+
+    def _create_handler(self, settings):
+        if settings.get('per_account'):
+            handler = self.handler_class(self.status_dir, settings,
+                                         per_account=True)
+        else:
+            handler = self.handler_class(self.status_dir, settings)
+        handler.is_stopping = lambda: self._stopping
+        return handler
+
+    def get_db_path(self, account, container, part, node):
         db_hash = hash_path(account, container)
         db_dir = storage_directory(DATADIR, part, db_hash)
-        db_path = os.path.join(self.root, node['device'], db_dir,
-                               db_hash + '.db')
+        return os.path.join(self.root, node['device'], db_dir,
+                            db_hash + '.db')
+
+    def get_broker(self, account, container, part, node):
+        db_path = self.get_db_path(account, container, part, node)
         return ContainerBroker(db_path, account=account, container=container)
 
+    def _get_ring_mtime(self):
+        try:
+            return os.path.getmtime(self._ring_path)
+        except OSError:
+            return None
+
+    def _check_ring(self):
+        """
+        Reloads the container ring if its file changed, which clears the
+        cached local nodes and brokers of the containers. Called once per
+        poll.
+        """
+        mtime = self._get_ring_mtime()
+        if mtime is None or mtime == self._ring_mtime:
+            return
+        try:
+            self.container_ring = Ring(self.swift_dir, ring_name='container')
+        except Exception as e:
+            # Retried on the next poll
+            self.log('error', 'Failed to reload the container ring: %r' % e)
+            return
+        self.log('info', 'Reloaded the container ring')
+        self._ring_mtime = mtime
+        self._local_nodes.clear()
+        self._brokers.clear()
+
+    def get_local_nodes(self, account, container):
+        """
+        Returns the partition of the container, the number of its replicas and
+        the list of (node index, node, database path) tuples of the replicas
+        that are on this node. Cached until the container ring changes.
+        """
+        key = (account, container)
+        local_nodes = self._local_nodes.get(key)
+        if local_nodes is None:
+            part, nodes = self.container_ring.get_nodes(account, container)
+            local_nodes = (part, len(nodes), [
+                (index, node,
+                 self.get_db_path(account, container, part, node))
+                for index, node in enumerate(nodes)
+                if is_local_device(self.myips, None, node['ip'],
+                                   node['port'])])
+            self._local_nodes[key] = local_nodes
+        return local_nodes
+
+    def _get_cached_broker(self, account, container, part, node, db_path):
+        """
+        Returns the open broker of a database, which is reused across the
+        polls while the files in the directory of the database do not change
+        (e.g. the database is replaced by the replicator, or sharded).
+        """
+        try:
+            st = os.stat(os.path.dirname(db_path))
+        except OSError:
+            return self.get_broker(account, container, part, node)
+        signature = (st.st_ino, st.st_mtime_ns)
+        cached = self._brokers.get(db_path)
+        if cached and cached[0] == signature:
+            self._brokers.move_to_end(db_path)
+            return cached[1]
+        broker = self.get_broker(account, container, part, node)
+        self._brokers[db_path] = (signature, broker)
+        self._brokers.move_to_end(db_path)
+        while len(self._brokers) > self.broker_cache_size:
+            self._brokers.popitem(last=False)
+        return broker
+
+    def get_local_brokers(self, account, container):
+        """
+        Returns the list of (node index, broker) tuples for the replicas of the
+        container database that are on this node.
+        """
+        part, _, local_nodes = self.get_local_nodes(account, container)
+        return [(index, self.get_broker(account, container, part, node))
+                for index, node, _ in local_nodes]
+
+    def get_local_broker(self, account, container):
+        """
+        Returns the most up-to-date local replica of the container database
+        (the one with the most rows) that can be opened, along with its info.
+        """
+        replicas = []
+        for _, broker in self.get_local_brokers(account, container):
+            try:
+                info = broker.get_info()
+            except DatabaseConnectionError:
+                continue
+            replicas.append((info['max_row'], info['id'], broker, info))
+        if not replicas:
+            raise RuntimeError('No local database for %s/%s' % (
+                account, container))
+        _, _, broker, info = max(replicas, key=lambda replica: replica[:2])
+        return broker, info
+
+    def _open_replicas(self, handler, account, container, part, local_nodes):
+        """
+        Opens the local replicas of a container database. Returns the list of
+        (node index, database path, broker, info, signature, behind) of the
+        replicas that can be read, in the order they should be crawled.
+
+        The replicas get the same updates, but number their rows
+        independently and each has its own checkpoint, so switching replicas
+        reads the rows again. The handler keeps crawling the replica it has
+        the most recent checkpoint for (the fewest rows past it), unless that
+        replica is behind: it has fewer rows or an older put timestamp than
+        another local replica. The replicas the handler has no checkpoint for
+        follow (the most rows first), and the replicas that are behind come
+        last. Ties are broken by the database ID.
+        """
+        replicas = []
+        for index, node, db_path in local_nodes:
+            broker = self._get_cached_broker(account, container, part, node,
+                                             db_path)
+            try:
+                info = broker.get_info()
+            except DatabaseConnectionError as e:
+                self._brokers.pop(db_path, None)
+                self.log('warning', 'Failed to open %s: %r' % (db_path, e))
+                continue
+            # The signature is taken after get_info(), which merges the
+            # pending updates into the database.
+            replicas.append((index, db_path, broker, info,
+                             self._get_db_signature(db_path)))
+        if len(replicas) < 2:
+            return [replica + (False,) for replica in replicas]
+
+        max_row = max(replica[3]['max_row'] for replica in replicas)
+        put_timestamp = max(Timestamp(replica[3].get('put_timestamp') or 0)
+                            for replica in replicas)
+        ranked = []
+        for replica in replicas:
+            info = replica[3]
+            behind = info['max_row'] < max_row or \
+                Timestamp(info.get('put_timestamp') or 0) < put_timestamp
+            last_row = handler.get_last_row(info['id'])
+            if last_row:
+                rank = (behind, 0, info['max_row'] - last_row)
+            else:
+                rank = (behind, 1, -info['max_row'])
+            ranked.append((rank + (info['id'],), replica + (behind,)))
+        ranked.sort(key=lambda entry: entry[0])
+        return [replica for _, replica in ranked]
+
+    @staticmethod
+    def _get_db_signature(db_path):
+        """
+        Returns the inode, size, and modification time of the database and its
+        pending file. Any update to the container changes the signature.
+        """
+        signature = []
+        for path in (db_path, db_path + '.pending'):
+            try:
+                st = os.stat(path)
+            except OSError:
+                signature.append(None)
+                continue
+            signature.append((st.st_ino, st.st_size, st.st_mtime))
+        return tuple(signature)
+
+    def _is_idle(self, db_path, settings):
+        """
+        Checks whether the database did not change since the last poll, which
+        had no rows to process. Idle containers are skipped before creating a
+        handler or opening the database.
+        """
+        if db_path not in self._idle_dbs:
+            return False
+        signature, idle_settings = self._idle_dbs[db_path]
+        if idle_settings != settings or signature[0] is None:
+            return False
+        return signature == self._get_db_signature(db_path)
+
+    def _skip_empty_container(self, handler, broker, last_row):
+        """
+        Lets the handler remove the entries of a container that has no objects
+        at once, as opposed to handling all of its tombstone rows. Returns the
+        row to resume from.
+        """
+        max_row = broker.get_max_row()
+        if max_row <= last_row:
+            return last_row
+        # The object count is checked after reading the last row, so that the
+        # objects created in the meantime are in later rows.
+        if broker.get_info()['object_count'] != 0:
+            return last_row
+        if not handler.handle_empty_container(max_row - last_row):
+            return last_row
+        return max_row
+
+    def iter_items(self, broker, start, chunks=1):
+        """
+        Yields the rows after the start ROWID in lists of at most items_batch
+        rows, up to chunks * items_chunk rows in total.
+
+        Every sub-batch is a separate short query, as opposed to holding a
+        cursor open across the batches: an open read transaction would block
+        the container server from merging updates into the database while the
+        rows are being handled.
+        """
+        remaining = self.items_chunk * chunks
+        while remaining > 0 and not self._stopping:
+            count = min(self.items_batch, remaining)
+            items = broker.get_items_since(start, count)
+            if not items:
+                return
+            yield items
+            if len(items) < count:
+                return
+            remaining -= len(items)
+            start = items[-1]['ROWID']
+
     def dump(self, obj):
         for attr in dir(obj):
             print("obj.%s = %r" % (attr, getattr(obj, attr)))
@@ -106,61 +502,366 @@ class ContainerCrawler(object):
 
     # run_once -> handle_container -> process_items
     def process_items(self, handler, rows, nodes_count, node_id):
+        # The node_id may be the set of the indices of all of the local
+        # replicas, which own the rows of each of their slices.
+        if isinstance(node_id, int):
+            node_id = (node_id,)
         owned_rows = filter(
-            lambda row: row['ROWID'] % nodes_count == node_id, rows)
+            lambda row: row['ROWID'] % nodes_count in node_id, rows)
         self.submit_items(handler, owned_rows)
 
         verified_rows = filter(
-            lambda row: row['ROWID'] % nodes_count != node_id, rows)
+            lambda row: row['ROWID'] % nodes_count not in node_id, rows)
         self.submit_items(handler, verified_rows)
 
+    def _get_swift_client(self):
+        if not self._swift_client:
+            self._swift_client = InternalClient(
+                ConfigString(BaseSync.INTERNAL_CLIENT_CONFIG),
+                'Container crawler', 3)
+        return self._swift_client
+
+    def get_shard_ranges(self, settings, broker=None):
+        """
+        Returns the shard ranges of a sharded container (an empty list if the
+        container is not sharded), from the local replica of the root
+        container database or, without a local replica, from Swift. The shard
+        ranges that are retrieved from Swift are cached for
+        shard_ranges_interval seconds. Swift is only asked for the shard
+        ranges if a HEAD of the container reports that it is sharding or
+        sharded.
+        """
+        if broker is not None:
+            return broker.get_shard_ranges()
+        key = self.scheduler.key(settings)
+        expires, shard_ranges = self._shard_ranges.get(key, (0, None))
+        if expires > time.time():
+            return shard_ranges
+        client = self._get_swift_client()
+        path = client.make_path(settings['account'], settings['container'])
+        try:
+            shard_ranges = []
+            resp = client.make_request('HEAD', path, {}, (2,))
+            if resp.headers.get('X-Backend-Sharding-State') in \
+                    self.SHARDED_STATES:
+                resp = client.make_request(
+                    'GET', path, {'X-Backend-Record-Type': 'shard'}, (2,),
+                    params={'format': 'json'})
+                # Unsharded containers return the object listing
+                if resp.headers.get('X-Backend-Record-Type') == 'shard':
+                    shard_ranges = [ShardRange.from_dict(shard_range)
+                                    for shard_range in json.loads(resp.body)]
+        except Exception as e:
+            self.log('error', 'Failed to get the shard ranges of %s: %r' % (
+                key, e))
+            shard_ranges = []
+        self._shard_ranges[key] = (
+            time.time() + self.shard_ranges_interval, shard_ranges)
+        return shard_ranges
+
+    def _crawl_db(self, handler, broker, broker_info, settings, chunks,
+                  nodes_count, node_id, root=True):
+        """
+        Processes up to chunks chunks of rows of a container database (the
+        root database or a shard), checkpointed by the ID of the database.
+        Returns a tuple of the number of processed rows and the number of
+        rows that remain to be processed.
+        """
+        last_row = handler.get_last_row(broker_info['id'])
+        if not last_row:
+            last_row = 0
+        processed = 0
+        if root:
+            self.stats.get(settings).checkpoint = last_row
+            if broker_info.get('object_count') == 0:
+                skipped_to = self._skip_empty_container(handler, broker,
+                                                        last_row)
+                if skipped_to != last_row:
+                    handler.save_last_row(skipped_to, broker_info['id'])
+                    self.stats.set_checkpoint(settings, skipped_to)
+                    # The skipped rows are not processed, which would keep
+                    # the scheduler from considering the container idle.
+                    self.stats.get(settings).skipped_rows += \
+                        skipped_to - last_row
+                    last_row = skipped_to
+        # The checkpoint is saved after every sub-batch, so that a failure only
+        # requires re-processing the failed sub-batch.
+        for items in self.iter_items(broker, last_row, chunks):
+            self.process_items(handler, items, nodes_count, node_id)
+            last_row = items[-1]['ROWID']
+            handler.save_last_row(last_row, broker_info['id'])
+            if root:
+                self.stats.set_checkpoint(settings, last_row)
+            else:
+                self.stats.record_activity()
+            processed += len(items)
+        backlog = max(0, broker.get_max_row() - last_row)
+        # The parts of the handler that are behind (e.g. a target that is
+        # retried) catch up to the checkpoint, rather than moving it back.
+        for lagging in handler.get_lagging(broker_info['id']):
+            if self._stopping:
+                break
+            lagging_processed, lagging_backlog = self._catch_up(
+                lagging, broker, broker_info['id'], chunks, nodes_count,
+                node_id, last_row)
+            processed += lagging_processed
+            backlog += lagging_backlog
+        return processed, backlog
+
+    def _catch_up(self, handler, broker, db_id, chunks, nodes_count, node_id,
+                  end_row):
+        """
+        Processes up to chunks chunks of rows, up to the end_row ROWID, with
+        a handler that is behind the checkpoint. Returns a tuple of the number
+        of processed rows and the number of rows the handler is still behind.
+        """
+        last_row = handler.get_last_row(db_id) or 0
+        processed = 0
+        try:
+            for items in self.iter_items(broker, last_row, chunks):
+                items = [item for item in items if item['ROWID'] <= end_row]
+                if not items:
+                    break
+                self.process_items(handler, items, nodes_count, node_id)
+                last_row = items[-1]['ROWID']
+                handler.save_last_row(last_row, db_id)
+                processed += len(items)
+                if last_row >= end_row:
+                    break
+        except Exception as e:
+            # The handler is retried on a later poll
+            self.log('error', 'Failed to catch up %s from row %d: %r' % (
+                db_id, last_row, e))
+        return processed, max(0, end_row - last_row)
+
+    def _crawl_shard(self, handler, settings, chunks, shard_range):
+        part, nodes_count, local_nodes = self.get_local_nodes(
+            shard_range.account, shard_range.container)
+        owned = frozenset(index for index, _, _ in local_nodes)
+        for _, db_path, broker, broker_info, _, _ in self._open_replicas(
+                handler, shard_range.account, shard_range.container, part,
+                local_nodes):
+            try:
+                return self._crawl_db(handler, broker, broker_info, settings,
+                                      chunks, nodes_count, owned,
+                                      root=False)
+            except DatabaseConnectionError:
+                # The shard database was moved: fail over to the next replica
+                self._brokers.pop(db_path, None)
+                continue
+        return 0, 0
+
+    def _crawl_shards(self, settings, shard_ranges, chunks):
+        """
+        Processes the local shard databases of a sharded container in
+        parallel, with up to shard_workers handlers. Every shard database has
+        its own checkpoint, keyed by its ID, so that moving the objects
+        between the shards (cleaving or shrinking) only requires processing
+        the moved rows in their new shard.
+        """
+        handlers = []
+        failures = []
+
+        def _crawl(shard_range):
+            handler = handlers.pop() if handlers else \
+                self._create_handler(settings)
+            try:
+                return self._crawl_shard(handler, settings, chunks,
+                                         shard_range)
+            except Exception as e:
+                self.log('error', 'Failed to process the shard %s: %r' % (
+                    shard_range.name, e))
+                failures.append(shard_range.name)
+                return 0, 0
+            finally:
+                handlers.append(handler)
+
+        pool = eventlet.GreenPool(self.shard_workers)
+        processed, backlog = 0, 0
+        for shard_processed, shard_backlog in pool.imap(_crawl,
+                                                        shard_ranges):
+            processed += shard_processed
+            backlog += shard_backlog
+        for handler in handlers:
+            handler.close()
+        if failures:
+            raise RuntimeError('Failed to process %d shards of %s' % (
+                len(failures), self.scheduler.key(settings)))
+        return processed, backlog
+
     # run_once -> handle_container
-    def handle_container(self, settings):
-        part, container_nodes = self.container_ring.get_nodes(
+    def handle_container(self, settings, chunks=1):
+        """
+        Processes up to the specified number of chunks of rows from the local
+        container DB and, if the container is sharded, from each of its local
+        shard DBs. Returns a tuple of the number of processed rows and the
+        number of rows that remain to be processed.
+        """
+        part, nodes_count, local_nodes = self.get_local_nodes(
             settings['account'], settings['container'])
-        nodes_count = len(container_nodes)
-        handler = self.handler_class(self.status_dir, settings)
 
-        for index, node in enumerate(container_nodes):
-            if not is_local_device(self.myips, None, node['ip'],
-                                   node['port']):
-                continue
-            broker = self.get_broker(settings['account'],
-                                     settings['container'],
-                                     part, node)
-            broker_info = broker.get_info()
-            last_row = handler.get_last_row(broker_info['id'])
-            if not last_row:
-                last_row = 0
+        if self.watcher:
+            for _, _, db_path in local_nodes:
+                self.watcher.watch(os.path.dirname(db_path),
+                                   self.scheduler.key(settings))
+        # A replica may get new rows (e.g. from the replicator) while the one
+        # that was crawled does not change.
+        if local_nodes and all(self._is_idle(db_path, settings)
+                               for _, _, db_path in local_nodes):
+            return 0, 0
+        handler = self._create_handler(settings) if local_nodes else None
+        try:
+            return self._crawl_container(handler, settings, chunks, part,
+                                         nodes_count, local_nodes)
+        finally:
+            # The handler is created on every poll of the container
+            if handler is not None:
+                handler.close()
+
+    def _crawl_container(self, handler, settings, chunks, part, nodes_count,
+                         local_nodes):
+        """
+        Crawls the local replicas of the container and its local shards with
+        the handler (None if the root is not on this node).
+        """
+        processed, backlog = 0, 0
+        root_broker = None
+        replicas = self._open_replicas(handler, settings['account'],
+                                       settings['container'], part,
+                                       local_nodes)
+        # The rows of the slices of all of the local replicas are handled
+        # first, rather than only the slice of the replica that is crawled.
+        owned = frozenset(index for index, _, _ in local_nodes)
+        for i, (_, db_path, broker, broker_info, signature, behind) in \
+                enumerate(replicas):
             try:
-                items = broker.get_items_since(last_row, self.items_chunk)
-            except DatabaseConnectionError:
+                processed, backlog = self._crawl_db(
+                    handler, broker, broker_info, settings, chunks,
+                    nodes_count, owned)
+                shard_ranges = self.get_shard_ranges(settings, broker)
+            except DatabaseConnectionError as e:
+                # The rows checkpointed so far are kept; the next replica
+                # resumes from its own checkpoint.
+                self._brokers.pop(db_path, None)
+                self.log('warning', 'Failed to read %s, trying the next local '
+                         'replica: %r' % (db_path, e))
                 continue
-            if items:
-                self.process_items(handler, items, nodes_count, index)
-                handler.save_last_row(items[-1]['ROWID'], broker_info['id'])
-            return
+            root_broker = broker
+            # The shards are updated without changing the root database, so
+            # the root of a sharded container is never considered idle.
+            if processed or backlog or shard_ranges:
+                for _, _, idle_path in local_nodes:
+                    self._idle_dbs.pop(idle_path, None)
+            else:
+                self._idle_dbs[db_path] = (signature, settings)
+                # No other replica is ahead of the crawled one
+                if not behind:
+                    for _, idle_path, _, _, idle_signature, _ in \
+                            replicas[i + 1:]:
+                        self._idle_dbs[idle_path] = (idle_signature, settings)
+            break
+
+        if root_broker is None:
+            # The shards may be on this node, even if the root is not
+            shard_ranges = self.get_shard_ranges(settings)
+        if shard_ranges and not self._stopping:
+            shard_processed, shard_backlog = self._crawl_shards(
+                settings, shard_ranges, chunks)
+            processed += shard_processed
+            backlog += shard_backlog
+        return processed, backlog
 
     def run_always(self):
-        # Since we don't support reloading, the daemon should quit if there are
-        # no containers configured
+        # The daemon quits if there are no containers configured on startup
         if 'containers' not in self.conf or not self.conf['containers']:
             return
         self.log('debug', 'Entering the poll loop')
-        while True:
+        while not self._stopping:
+            if self._load_conf:
+                self.reload()
             start = time.time()
             self.run_once()
-            elapsed = time.time() - start
-            if elapsed < self.poll_interval:
-                time.sleep(self.poll_interval - elapsed)
+            self._wait(start)
+        if not self.bulk:
+            self._stop()
+        self.log('info', 'Stopped the crawler')
+
+    def _sleep(self, timeout, watch=False):
+        """
+        Sleeps for up to timeout seconds, waking up early if the crawler is
+        stopped or reloaded. With watch set, also wakes up when the watched
+        databases change and returns their keys.
+        """
+        deadline = time.time() + timeout
+        while not self._stopping and not self._load_conf:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            interval = min(remaining, self.WAKE_INTERVAL)
+            if watch:
+                changed = self.watcher.wait(interval)
+                if changed:
+                    return changed
+            else:
+                time.sleep(interval)
+        return set()
+
+    def _wait(self, start):
+        # Sleep at least until the next poll interval, or longer if all of the
+        # containers are idle and are being polled less frequently. With the
+        # database watcher, idle containers are woken up when they change.
+        now = time.time()
+        if now < start + self.poll_interval:
+            self._sleep(start + self.poll_interval - now)
+        containers = self._containers
+        changed = self.watcher.read_events() if self.watcher else set()
+        next_poll = self.scheduler.next_poll(containers)
+        timeout = next_poll - time.time() if next_poll is not None else 0
+        if not changed and timeout > 0:
+            changed = self._sleep(timeout, watch=bool(self.watcher))
+        for key in changed:
+            self.scheduler.wake(key)
+
+    def _start_profile(self):
+        if self._profile_cycles <= 0:
+            return False
+        self._profile_cycles -= 1
+        try:
+            self.profiler.start_cycle()
+        except OSError as e:
+            self.log('error', 'Failed to start profiling: %r' % e)
+            return False
+        return True
 
     def run_once(self):
-        for container_settings in self.conf['containers']:
+        profiling = self._start_profile()
+        self._check_ring()
+        self._containers = self.get_containers()
+        schedule = self.scheduler.schedule(self._containers)
+        for container_settings, chunks in schedule:
+            if self._stopping:
+                break
+            self.stats.start_container(container_settings,
+                                       chunks * self.items_chunk)
+            start = time.time()
             try:
-                self.handle_container(container_settings)
+                if profiling:
+                    with self.profiler.profile(container_settings):
+                        rows, backlog = self.handle_container(
+                            container_settings, chunks)
+                else:
+                    rows, backlog = self.handle_container(
+                        container_settings, chunks)
+                self.scheduler.update(container_settings, rows, backlog)
+                self.stats.container_done(container_settings, rows, backlog,
+                                          time.time() - start)
             except Exception as e:
+                self.stats.container_failed(container_settings, e)
                 account = container_settings.get('account', 'N/A')
                 container = container_settings.get('container', 'N/A')
                 self.log('error', "Failed to process %s/%s with %s: %s" % (
                     account, container, self.handler_class, repr(e)))
-                self.log('error', traceback.format_exc(e))
+                self.log('error', traceback.format_exc())
+        if profiling:
+            self.profiler.end_cycle()
+        self.stats.poll_done()
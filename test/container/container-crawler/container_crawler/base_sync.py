@@ -31,8 +31,11 @@ use = egg:swift#proxy_logging
 use = egg:swift#catch_errors
 """.lstrip()
 
-    def __init__(self, status_dir, settings):
+    def __init__(self, status_dir, settings, per_account=False):
         self._status_dir = status_dir
+        # Set if the container was discovered from an account mapping, as
+        # opposed to being configured explicitly.
+        self._per_account = per_account
         self._account = settings['account']
         self._container = settings['container']
         ic_config = ConfigString(self.INTERNAL_CLIENT_CONFIG)
@@ -49,3 +52,37 @@ use = egg:swift#catch_errors
 
     def save_last_row(self, row_id, db_id):
         raise NotImplementedError
+
+    def handle_empty_container(self, rows):
+        """
+        Called when the container has no objects and the given number of rows
+        past the checkpoint, e.g. after the container was deleted or emptied.
+        Returns True if the handler removed all of the entries of the
+        container at once, in which case the rows are skipped and the
+        checkpoint is moved to the last row.
+        """
+        return False
+
+    def is_stopping(self):
+        """
+        Returns True once the crawler is stopping, so that the long operations
+        of the handler (e.g. waiting for a task) can return early. The crawler
+        replaces it with its own check when it creates the handler.
+        """
+        return False
+
+    def get_lagging(self, db_id):
+        """
+        Returns the list of the handlers of the parts of the handler (e.g. the
+        targets of a fan-out) that are behind the checkpoint returned by
+        get_last_row() and catch up separately, each from its own checkpoint.
+        The default implementation returns an empty list.
+        """
+        return []
+
+    def close(self):
+        """
+        Called once the crawler is done with the handler (at the end of the
+        poll of the container), to release its resources.
+        """
+        pass
@@ -0,0 +1,53 @@
+import itertools
+
+
+"""
+    Discovers the containers of an account whose databases are local to this
+    node.
+
+    The account listing is walked incrementally: every call to discover()
+    lists at most batch_size containers after the marker left by the previous
+    call. Containers are added as soon as they are listed. Once the end of the
+    listing is reached, the containers that were not listed during the pass
+    (deleted, or no longer local after a ring change) are removed and the next
+    pass starts from the beginning of the account.
+"""
+class AccountDiscovery(object):
+    def __init__(self, settings, list_containers, is_local, batch_size=1000):
+        """
+        :param settings: the account settings; every discovered container uses
+                         a copy of the settings with the "container" key set.
+        :param list_containers: callable that takes the account and a marker
+                                and returns an iterator of container names.
+        :param is_local: callable that takes the account and the container
+                         and returns True if the container DB is local.
+        """
+        self.settings = settings
+        self.account = settings['account']
+        self.batch_size = batch_size
+        self._list_containers = list_containers
+        self._is_local = is_local
+        self.marker = ''
+        self.containers = {}
+        self._listed = set()
+
+    def discover(self):
+        names = list(itertools.islice(
+            self._list_containers(self.account, self.marker),
+            self.batch_size))
+        for name in names:
+            if not self._is_local(self.account, name):
+                self.containers.pop(name, None)
+                continue
+            self._listed.add(name)
+            if name not in self.containers:
+                self.containers[name] = dict(self.settings, container=name)
+
+        if len(names) < self.batch_size:
+            for name in set(self.containers.keys()) - self._listed:
+                del self.containers[name]
+            self._listed = set()
+            self.marker = ''
+        else:
+            self.marker = names[-1]
+        return [self.containers[name] for name in sorted(self.containers)]
@@ -0,0 +1,88 @@
+import contextlib
+import cProfile
+import os
+import pstats
+import shutil
+import time
+
+from urllib.parse import quote
+
+
+"""
+    Profiles the cycles (polls) of the crawler with cProfile. Every profiled
+    cycle is written to its own directory under profile_dir, with a profile
+    dump (.prof, which can be loaded with pstats or snakeviz) and a listing of
+    the top functions (.txt) for every container processed in the cycle, and
+    a summary.txt of the top functions across the containers.
+
+    Only the last keep cycles are retained.
+"""
+class CycleProfiler(object):
+    CYCLE_PREFIX = 'cycle-'
+
+    def __init__(self, profile_dir, keep=10, top=30, log=None):
+        self.profile_dir = profile_dir
+        self.keep = keep
+        self.top = top
+        self.log = log or (lambda level, message: None)
+        self.cycle_dir = None
+
+    def start_cycle(self, now=None):
+        now = now or time.time()
+        self.cycle_dir = os.path.join(
+            self.profile_dir, '%s%s.%06d' % (
+                self.CYCLE_PREFIX,
+                time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+                int(now * 10**6) % 10**6))
+        os.makedirs(self.cycle_dir)
+
+    @contextlib.contextmanager
+    def profile(self, settings):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            self._dump(profile, settings)
+
+    def _write_stats(self, stats, path, sort):
+        with open(path, 'w') as f:
+            stats.stream = f
+            stats.sort_stats(*sort).print_stats(self.top)
+
+    def _dump(self, profile, settings):
+        name = quote('%s/%s' % (settings.get('account'),
+                                settings.get('container')), safe='')
+        path = os.path.join(self.cycle_dir, name)
+        try:
+            profile.dump_stats(path + '.prof')
+            self._write_stats(pstats.Stats(profile), path + '.txt',
+                              ('cumulative', 'tottime'))
+        except Exception as e:
+            self.log('error', 'Failed to write the profile of %s: %r' % (
+                name, e))
+
+    def end_cycle(self):
+        """
+        Writes the summary of the cycle and removes the oldest cycles.
+        """
+        try:
+            dumps = sorted(os.path.join(self.cycle_dir, entry)
+                           for entry in os.listdir(self.cycle_dir)
+                           if entry.endswith('.prof'))
+            if dumps:
+                self._write_stats(
+                    pstats.Stats(*dumps),
+                    os.path.join(self.cycle_dir, 'summary.txt'),
+                    ('tottime', 'cumulative'))
+            self.log('info', 'Wrote the profile of the cycle to %s' %
+                     self.cycle_dir)
+            cycles = sorted(entry for entry in os.listdir(self.profile_dir)
+                            if entry.startswith(self.CYCLE_PREFIX))
+            for entry in cycles[:max(0, len(cycles) - self.keep)]:
+                shutil.rmtree(os.path.join(self.profile_dir, entry),
+                              ignore_errors=True)
+        except Exception as e:
+            self.log('error', 'Failed to write the profile summary: %r' % e)
+        self.cycle_dir = None
@@ -0,0 +1,109 @@
+import math
+import time
+
+
+class ContainerState(object):
+    def __init__(self):
+        # Rows in the container DB past the checkpoint, as observed at the end
+        # of the last poll. None until the container is polled.
+        self.backlog = None
+        self.idle_interval = 0
+        self.next_poll = 0
+
+
+"""
+    Decides which containers the crawler should poll on each pass and how many
+    chunks each one is allowed to process.
+
+    Containers that are behind (as estimated by the broker's max ROWID minus
+    the checkpoint on the previous poll) are polled first and get more chunks,
+    scaled by their "priority" setting. A container whose backlog exceeds its
+    "max_lag" setting gets the maximum number of chunks. Every container that
+    is due gets at least one chunk, so that hot containers cannot starve cold
+    ones. Containers that had no new rows are polled with an exponentially
+    increasing interval, up to max_idle_interval.
+"""
+class ContainerScheduler(object):
+    def __init__(self, items_chunk, poll_interval, max_chunks=4,
+                 max_idle_interval=30):
+        self.items_chunk = items_chunk
+        self.poll_interval = poll_interval
+        self.max_chunks = max_chunks
+        self.max_idle_interval = max(max_idle_interval, poll_interval)
+        self.states = {}
+
+    @staticmethod
+    def key(settings):
+        return (settings.get('account'), settings.get('container'))
+
+    def _state(self, settings):
+        return self.states.setdefault(self.key(settings), ContainerState())
+
+    def _is_lagging(self, settings, state):
+        max_lag = settings.get('max_lag')
+        return max_lag is not None and state.backlog is not None and \
+            state.backlog > max_lag
+
+    def get_chunks(self, settings):
+        state = self._state(settings)
+        if self._is_lagging(settings, state):
+            return self.max_chunks
+        if not state.backlog:
+            return 1
+        priority = settings.get('priority', 1)
+        chunks = int(math.ceil(
+            priority * float(state.backlog) / self.items_chunk))
+        return max(1, min(self.max_chunks, chunks))
+
+    def schedule(self, containers, now=None):
+        """
+        Returns the list of (settings, chunks) tuples for the containers that
+        are due to be polled, in the order in which they should be processed.
+        """
+        if now is None:
+            now = time.time()
+
+        def _sort_key(entry):
+            settings, state = entry
+            return (not self._is_lagging(settings, state),
+                    -settings.get('priority', 1) * (state.backlog or 0))
+
+        due = [(settings, self._state(settings)) for settings in containers
+               if self._state(settings).next_poll <= now]
+        # sorted() is stable, so containers with the same score are processed
+        # in the configuration order.
+        return [(settings, self.get_chunks(settings))
+                for settings, _ in sorted(due, key=_sort_key)]
+
+    def update(self, settings, rows, backlog, now=None):
+        """
+        Records the outcome of polling a container: the number of rows that
+        were processed and the remaining backlog.
+        """
+        if now is None:
+            now = time.time()
+        state = self._state(settings)
+        state.backlog = backlog
+        if rows or backlog:
+            state.idle_interval = 0
+            state.next_poll = now
+            return
+        state.idle_interval = min(
+            self.max_idle_interval,
+            max(self.poll_interval, state.idle_interval * 2))
+        state.next_poll = now + state.idle_interval
+
+    def wake(self, key):
+        """
+        Makes the container due immediately, e.g. if its database changed.
+        """
+        if key in self.states:
+            self.states[key].next_poll = 0
+
+    def next_poll(self, containers):
+        """
+        Returns the earliest time at which any of the containers is due.
+        """
+        if not containers:
+            return None
+        return min(self._state(settings).next_poll for settings in containers)
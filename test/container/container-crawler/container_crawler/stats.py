@@ -0,0 +1,99 @@
+import time
+
+
+class ContainerStats(object):
+    def __init__(self):
+        # The last row that was checkpointed
+        self.checkpoint = None
+        # Rows in the container DB past the checkpoint, as of the last poll
+        self.backlog = None
+        # The maximum number of rows the container may process on a poll
+        self.chunk_rows = 0
+        self.rows = 0
+        self.rows_per_second = 0.0
+        # The rows of emptied containers that were skipped, rather than
+        # processed, after the handler removed all of their entries at once
+        self.skipped_rows = 0
+        self.last_success = None
+        self.last_failure = None
+        self.last_error = None
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+
+"""
+    Tracks the progress of the crawler and of every container it processes,
+    for monitoring. The crawler updates the stats as it polls the containers.
+"""
+class CrawlerStats(object):
+    def __init__(self):
+        self.started = time.time()
+        # The last time the crawler completed a poll or saved a checkpoint
+        self.last_activity = self.started
+        self.last_poll = None
+        self.polls = 0
+        # The "account/container" that is being processed
+        self.current = None
+        self.containers = {}
+
+    @staticmethod
+    def key(settings):
+        return '%s/%s' % (settings.get('account'), settings.get('container'))
+
+    def get(self, settings):
+        return self.containers.setdefault(self.key(settings),
+                                          ContainerStats())
+
+    def start_container(self, settings, chunk_rows):
+        self.current = self.key(settings)
+        self.get(settings).chunk_rows = chunk_rows
+
+    def set_checkpoint(self, settings, row, now=None):
+        self.get(settings).checkpoint = row
+        self.record_activity(now)
+
+    def record_activity(self, now=None):
+        self.last_activity = now or time.time()
+
+    def container_done(self, settings, rows, backlog, duration, now=None):
+        stats = self.get(settings)
+        stats.rows += rows
+        stats.backlog = backlog
+        stats.rows_per_second = rows / duration if duration > 0 else 0.0
+        stats.last_success = now or time.time()
+        self.current = None
+
+    def container_failed(self, settings, error, now=None):
+        stats = self.get(settings)
+        stats.last_failure = now or time.time()
+        stats.last_error = repr(error)
+        self.current = None
+
+    def poll_done(self, now=None):
+        self.polls += 1
+        self.last_poll = now or time.time()
+        self.last_activity = self.last_poll
+
+    def is_alive(self, timeout, now=None):
+        """
+        The crawler is alive if it completed a poll or saved a checkpoint in
+        the last timeout seconds.
+        """
+        return (now or time.time()) - self.last_activity < timeout
+
+    def is_ready(self):
+        """
+        The crawler is ready once it completed its first poll.
+        """
+        return self.polls > 0
+
+    def to_dict(self):
+        return {'started': self.started,
+                'last_activity': self.last_activity,
+                'last_poll': self.last_poll,
+                'polls': self.polls,
+                'current': self.current,
+                'containers': dict(
+                    (key, stats.to_dict())
+                    for key, stats in self.containers.items())}
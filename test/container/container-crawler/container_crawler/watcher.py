@@ -0,0 +1,123 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+    except OSError:
+        return None
+    if not hasattr(libc, 'inotify_init1'):
+        return None
+    return libc
+
+
+"""
+    Watches the container database directories with inotify. The crawler uses
+    the watcher to wake up when a database (or its pending file) changes, as
+    opposed to periodically polling idle containers.
+
+    The watcher is only available on Linux. Use DBWatcher.create(), which
+    returns None if inotify cannot be used.
+"""
+class DBWatcher(object):
+    def __init__(self, libc):
+        self._libc = libc
+        self._fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self._paths = {}
+        self._watches = {}
+
+    @classmethod
+    def create(cls):
+        libc = _load_libc()
+        if not libc:
+            return None
+        try:
+            return cls(libc)
+        except OSError:
+            return None
+
+    def watch(self, path, key):
+        """
+        Associates the key with changes in the directory. Returns False if the
+        directory cannot be watched (e.g. it does not exist yet).
+        """
+        if path in self._paths:
+            self._watches[self._paths[path]][1].add(key)
+            return True
+        wd = self._libc.inotify_add_watch(
+            self._fd, path.encode('utf-8'), WATCH_MASK)
+        if wd < 0:
+            return False
+        self._paths[path] = wd
+        self._watches[wd] = (path, set([key]))
+        return True
+
+    def keys(self):
+        keys = set()
+        for _, watch_keys in self._watches.values():
+            keys.update(watch_keys)
+        return keys
+
+    def wait(self, timeout):
+        """
+        Waits for changes for at most timeout seconds. Returns the set of keys
+        associated with the directories that changed.
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+        return self.read_events()
+
+    def read_events(self):
+        """
+        Returns the set of keys associated with the directories that changed,
+        without blocking.
+        """
+        changed = set()
+        # NOTE: checking for pending events with select, as opposed to reading
+        # until EAGAIN, as the eventlet version of os.read() blocks instead.
+        while select.select([self._fd], [], [], 0)[0]:
+            data = os.read(self._fd, 65536)
+            offset = 0
+            while offset + EVENT_HEADER.size <= len(data):
+                wd, mask, _, name_len = EVENT_HEADER.unpack_from(data, offset)
+                offset += EVENT_HEADER.size + name_len
+                if mask & IN_Q_OVERFLOW:
+                    # Events were dropped: treat everything as changed.
+                    changed.update(self.keys())
+                    continue
+                if wd not in self._watches:
+                    continue
+                path, keys = self._watches[wd]
+                changed.update(keys)
+                if mask & IN_IGNORED:
+                    # The directory was removed; it will be watched again once
+                    # the crawler encounters it.
+                    del self._watches[wd]
+                    del self._paths[path]
+        return changed
+
+    def close(self):
+        if self._fd >= 0:
+            os.close(self._fd)
+            self._fd = -1
@@ -1,3 +1,4 @@
+import json
 import mock
 import container_crawler
 import unittest
@@ -22,6 +23,7 @@ class TestContainerCrawler(unittest.TestCase):
         for nodes in range(1, 7):
             for node_id in range(0, nodes):
                 mock_handler = mock.Mock()
+                mock_handler.get_lagging.return_value = []
                 self.crawler.handler_class = mock.Mock()
                 self.crawler.handler_class.return_value = mock_handler
                 handle_calls = filter(lambda x: x % nodes == node_id,
@@ -35,12 +37,23 @@ class TestContainerCrawler(unittest.TestCase):
                 self.assertEqual(expected,
                                  mock_handler.handle.call_args_list)
 
+    @mock.patch('container_crawler.whataremyips')
+    def test_local_ips(self, mock_ips):
+        container_crawler.get_local_ips.cache_clear()
+        self.addCleanup(container_crawler.get_local_ips.cache_clear)
+        mock_ips.return_value = ['127.0.0.1']
+        self.assertEqual(['127.0.0.1'], self.crawler.myips)
+        # The addresses are looked up once per process
+        self.assertEqual(['127.0.0.1'], self.crawler.myips)
+        mock_ips.assert_called_once_with('0.0.0.0')
+
     def test_bulk_handling(self):
         self.crawler.bulk = True
 
         total_rows = 20
         items = [{'ROWID': x} for x in range(0, total_rows)]
         mock_handler = mock.Mock()
+        mock_handler.get_lagging.return_value = []
         self.crawler.handler_class = mock.Mock()
         mock_handler.handle.return_value = []
         self.crawler.handler_class.return_value = mock_handler
@@ -50,18 +63,642 @@ class TestContainerCrawler(unittest.TestCase):
                    ]
         self.assertEqual(expected, mock_handler.handle.call_args_list)
 
+    def test_iter_items(self):
+        self.crawler.items_chunk = 10
+        self.crawler.items_batch = 4
+        rows = [{'ROWID': x} for x in range(1, 26)]
+        broker = mock.Mock()
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+
+        batches = list(self.crawler.iter_items(broker, 5))
+        self.assertEqual([[6, 7, 8, 9], [10, 11, 12, 13], [14, 15]],
+                         [[row['ROWID'] for row in batch]
+                          for batch in batches])
+        self.assertEqual([mock.call(5, 4), mock.call(9, 4), mock.call(13, 2)],
+                         broker.get_items_since.call_args_list)
+
+    def test_iter_items_stops_on_short_batch(self):
+        self.crawler.items_chunk = 10
+        self.crawler.items_batch = 4
+        broker = mock.Mock()
+        broker.get_items_since.return_value = [{'ROWID': 1}, {'ROWID': 2}]
+
+        batches = list(self.crawler.iter_items(broker, 0))
+        self.assertEqual([[{'ROWID': 1}, {'ROWID': 2}]], batches)
+        broker.get_items_since.assert_called_once_with(0, 4)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_saves_every_batch(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        self.crawler.items_chunk = 4
+        self.crawler.items_batch = 2
+        rows = [{'ROWID': x} for x in range(1, 5)]
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id'}
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        handler.get_last_row.return_value = 0
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+
+        broker.get_max_row.return_value = 10
+
+        self.assertEqual((4, 6), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        self.assertEqual([mock.call(2, 'db-id'), mock.call(4, 'db-id')],
+                         handler.save_last_row.call_args_list)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_lagging(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        self.crawler.items_chunk = 4
+        self.crawler.items_batch = 4
+        rows = [{'ROWID': x} for x in range(1, 11)]
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id'}
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+        broker.get_max_row.return_value = 10
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
+        lagging = mock.Mock()
+        lagging.get_last_row.return_value = 2
+        handler = mock.Mock()
+        handler.get_lagging.return_value = [lagging]
+        handler.get_last_row.return_value = 6
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+
+        # The lagging part catches up separately, up to chunks rows
+        self.assertEqual((8, 4), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        handler.save_last_row.assert_called_once_with(10, 'db-id')
+        lagging.save_last_row.assert_called_once_with(6, 'db-id')
+        self.assertEqual([{'ROWID': x} for x in range(3, 7)],
+                         [row for call in lagging.handle.call_args_list
+                          for row in call[0][0]])
+
+        # A failure is retried on a later poll
+        self.crawler.logger = mock.Mock()
+        lagging.reset_mock()
+        lagging.handle.side_effect = RuntimeError('oops')
+        self.assertEqual((4, 8), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        lagging.save_last_row.assert_not_called()
+        self.assertEqual(1, self.crawler.logger.error.call_count)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_empty(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        rows = [{'ROWID': x} for x in range(1, 13)]
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id', 'object_count': 0}
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+        broker.get_max_row.return_value = 10
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        handler.get_last_row.return_value = 2
+        handler.handle_empty_container.return_value = True
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+
+        # The rows up to the last row are skipped; the rows added after the
+        # check are processed
+        broker.get_max_row.side_effect = [10, 12]
+        self.assertEqual((2, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        handler.handle_empty_container.assert_called_once_with(8)
+        # The handler checks whether the crawler is stopping
+        self.assertFalse(handler.is_stopping())
+        self.crawler.stop()
+        self.assertTrue(handler.is_stopping())
+        # The skipped rows are not counted as processed
+        self.assertEqual(8, self.crawler.stats.get(
+            {'account': 'AUTH_account', 'container': 'container'}
+        ).skipped_rows)
+        self.assertEqual([mock.call(10, 'db-id'), mock.call(12, 'db-id')],
+                         handler.save_last_row.call_args_list)
+        broker.get_items_since.assert_called_once_with(10, 1000)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_empty_not_removed(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        rows = [{'ROWID': x} for x in range(1, 5)]
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id', 'object_count': 0}
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+        broker.get_max_row.return_value = 4
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        handler.get_last_row.return_value = 0
+        handler.handle_empty_container.return_value = False
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+
+        self.assertEqual((4, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        handler.save_last_row.assert_called_once_with(4, 'db-id')
+
+        # Objects were created after the database info was read
+        handler.reset_mock()
+        handler.get_last_row.return_value = 0
+        broker.get_info.side_effect = [{'id': 'db-id', 'object_count': 0},
+                                       {'id': 'db-id', 'object_count': 1}]
+        self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'})
+        self.assertFalse(handler.handle_empty_container.called)
+
+    def _setup_replicas(self):
+        self.crawler.bulk = True
+        self.crawler.items_chunk = 10
+        nodes = [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'},
+                 {'ip': '127.0.0.2', 'port': 6001, 'device': 'sdb'},
+                 {'ip': '127.0.0.1', 'port': 6001, 'device': 'sdc'}]
+        self.mock_ring.get_nodes.return_value = ('part', nodes)
+        self.brokers = {}
+        for device, max_row in [('sda', 6), ('sdc', 8)]:
+            rows = [{'ROWID': i} for i in range(1, max_row + 1)]
+            broker = mock.Mock()
+            broker.get_info.return_value = {'id': device + '-id',
+                                            'max_row': max_row}
+            broker.get_items_since.side_effect = \
+                lambda start, count, rows=rows: rows[start:start + count]
+            broker.get_max_row.return_value = max_row
+            broker.get_shard_ranges.return_value = []
+            self.brokers[device] = broker
+        self.crawler.get_broker = mock.Mock(
+            side_effect=lambda account, container, part, node:
+            self.brokers[node['device']])
+        self.crawler.get_db_path = mock.Mock(
+            side_effect=lambda account, container, part, node:
+            '/nonexistent/%s.db' % node['device'])
+        self.handler = mock.Mock()
+        self.handler.get_lagging.return_value = []
+        self.handler.get_last_row.side_effect = \
+            lambda db_id: {'sda-id': 5}.get(db_id, 0)
+        self.crawler.handler_class = mock.Mock(return_value=self.handler)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_picks_replica(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_replicas()
+
+        # The replica with a checkpoint has fewer rows than the other one
+        self.assertEqual((8, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        self.handler.save_last_row.assert_called_once_with(8, 'sdc-id')
+        self.assertFalse(self.brokers['sda'].get_items_since.called)
+
+        # Without checkpoints, the replica with the most rows is crawled
+        self.handler.reset_mock()
+        self.handler.get_last_row.side_effect = None
+        self.handler.get_last_row.return_value = 0
+        self.assertEqual((8, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        self.handler.save_last_row.assert_called_once_with(8, 'sdc-id')
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_sticky_replica(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_replicas()
+        checkpoints = {'sda-id': 5}
+        self.handler.get_last_row.side_effect = \
+            lambda db_id: checkpoints.get(db_id, 0)
+        self.handler.save_last_row.side_effect = \
+            lambda row, db_id: checkpoints.__setitem__(db_id, row)
+        settings = {'account': 'AUTH_account', 'container': 'container'}
+
+        def add_rows(max_row, put_timestamp='1500000000.00000'):
+            # Both replicas get the same rows
+            rows = [{'ROWID': i} for i in range(1, max_row + 1)]
+            for broker in self.brokers.values():
+                broker.get_info.return_value.update(
+                    max_row=max_row, put_timestamp=put_timestamp)
+                broker.get_max_row.return_value = max_row
+                broker.get_items_since.side_effect = \
+                    lambda start, count: rows[start:start + count]
+
+        add_rows(8)
+        self.assertEqual((3, 0), self.crawler.handle_container(settings))
+        add_rows(10)
+        self.assertEqual((2, 0), self.crawler.handle_container(settings))
+        self.assertEqual([mock.call(8, 'sda-id'), mock.call(10, 'sda-id')],
+                         self.handler.save_last_row.call_args_list)
+        self.assertFalse(self.brokers['sdc'].get_items_since.called)
+
+        # The crawled replica falls behind: the other one is crawled
+        self.handler.reset_mock()
+        add_rows(12)
+        self.brokers['sda'].get_info.return_value['put_timestamp'] = \
+            '1400000000.00000'
+        self.assertEqual((10, 2), self.crawler.handle_container(settings))
+        self.handler.save_last_row.assert_called_once_with(10, 'sdc-id')
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_idle_replicas(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_replicas()
+        self.handler.get_last_row.side_effect = \
+            lambda db_id: {'sda-id': 6, 'sdc-id': 8}[db_id]
+        settings = {'account': 'AUTH_account', 'container': 'container'}
+        signatures = {'/nonexistent/sda.db': ((1, 4096, 1000.0), None),
+                      '/nonexistent/sdc.db': ((2, 4096, 1000.0), None)}
+
+        with mock.patch.object(self.crawler, '_get_db_signature',
+                               side_effect=signatures.get):
+            self.assertEqual((0, 0), self.crawler.handle_container(settings))
+            self.assertEqual((0, 0), self.crawler.handle_container(settings))
+            self.assertEqual(1, self.crawler.handler_class.call_count)
+
+            # A replica that is not crawled gets new rows
+            signatures['/nonexistent/sdc.db'] = ((2, 4096, 1001.0), None)
+            self.brokers['sdc'].get_info.return_value['max_row'] = 10
+            self.brokers['sdc'].get_max_row.return_value = 10
+            self.brokers['sdc'].get_items_since.side_effect = \
+                lambda start, count: [{'ROWID': i} for i in range(9, 11)]
+            self.assertEqual((2, 0), self.crawler.handle_container(settings))
+            self.handler.save_last_row.assert_called_once_with(10, 'sdc-id')
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_fails_over(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_replicas()
+        self.crawler.logger = mock.Mock()
+        self.crawler.items_batch = 4
+        self.brokers['sda'].get_info.return_value['max_row'] = 10
+        self.brokers['sda'].get_items_since.side_effect = [
+            [{'ROWID': i} for i in range(6, 10)],
+            container_crawler.DatabaseConnectionError(
+                '/nonexistent/sda.db', 'disk error')]
+
+        self.assertEqual((8, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        # The batch read before the failure is kept
+        self.assertEqual([mock.call(9, 'sda-id'), mock.call(4, 'sdc-id'),
+                          mock.call(8, 'sdc-id')],
+                         self.handler.save_last_row.call_args_list)
+        self.assertEqual(1, self.crawler.logger.warning.call_count)
+
+        # A replica that cannot be opened is skipped
+        self.handler.reset_mock()
+        self.brokers['sda'].get_info.side_effect = \
+            container_crawler.DatabaseConnectionError(
+                '/nonexistent/sda.db', 'disk error')
+        self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'})
+        self.assertEqual('sdc-id', self.handler.save_last_row.call_args[0][1])
+
+    def test_process_items_local_replicas(self):
+        self.crawler.bulk = True
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        items = [{'ROWID': x} for x in range(1, 7)]
+
+        self.crawler.process_items(handler, items, 3, frozenset([0, 2]))
+        self.assertEqual(
+            [mock.call([{'ROWID': x} for x in (2, 3, 5, 6)]),
+             mock.call([{'ROWID': 1}, {'ROWID': 4}])],
+            [mock.call(list(call[0][0]))
+             for call in handler.handle.call_args_list])
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_get_local_broker(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_replicas()
+        self.assertEqual(
+            (self.brokers['sdc'], {'id': 'sdc-id', 'max_row': 8}),
+            self.crawler.get_local_broker('AUTH_account', 'container'))
+
+        self.brokers['sdc'].get_info.side_effect = \
+            container_crawler.DatabaseConnectionError(
+                '/nonexistent/sdc.db', 'disk error')
+        self.assertIs(self.brokers['sda'], self.crawler.get_local_broker(
+            'AUTH_account', 'container')[0])
+
+    def _setup_sharded(self, root_local=True):
+        self.crawler.bulk = True
+        self.crawler.items_chunk = 10
+        self.shard_ranges = [
+            container_crawler.ShardRange(
+                '.shards_AUTH_account/container-%d' % i, '1500000000.00000',
+                lower=lower, upper=upper)
+            for i, (lower, upper) in enumerate([('', 'm'), ('m', '')])]
+        nodes = {'container': [{'ip': '127.0.0.1', 'port': 6001,
+                                'device': 'sda'}],
+                 'container-0': [{'ip': '127.0.0.2', 'port': 6001,
+                                  'device': 'sda'},
+                                 {'ip': '127.0.0.1', 'port': 6001,
+                                  'device': 'sdb'}],
+                 'container-1': [{'ip': '127.0.0.1', 'port': 6001,
+                                  'device': 'sdc'}]}
+        self.mock_ring.get_nodes.side_effect = \
+            lambda account, container: ('part', nodes[container])
+        self.brokers = {}
+        for name, rows in [('container', []),
+                           ('container-0', [{'ROWID': i}
+                                            for i in range(1, 4)]),
+                           ('container-1', [{'ROWID': i}
+                                            for i in range(1, 16)])]:
+            broker = mock.Mock()
+            broker.get_info.return_value = {'id': name + '-id'}
+            broker.get_items_since.side_effect = \
+                lambda start, count, rows=rows: rows[start:start + count]
+            broker.get_max_row.return_value = len(rows)
+            broker.get_shard_ranges.return_value = self.shard_ranges
+            self.brokers[name] = broker
+        if not root_local:
+            nodes['container'][0]['ip'] = '127.0.0.2'
+        self.crawler.get_broker = mock.Mock(
+            side_effect=lambda account, container, part, node:
+            self.brokers[container])
+        self.crawler.get_db_path = mock.Mock(
+            side_effect=lambda account, container, part, node:
+            '/nonexistent/%s.db' % container)
+        self.handler = mock.Mock()
+        self.handler.get_lagging.return_value = []
+        self.handler.get_last_row.side_effect = \
+            lambda db_id: {'container-1-id': 5}.get(db_id, 0)
+        self.crawler.handler_class = mock.Mock(return_value=self.handler)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_sharded_container(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_sharded()
+
+        self.assertEqual((13, 0), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        self.assertEqual(
+            [mock.call(3, 'container-0-id'), mock.call(15, 'container-1-id')],
+            sorted(self.handler.save_last_row.call_args_list,
+                   key=lambda call: call[0][1]))
+        self.brokers['container-0'].get_items_since.assert_called_once_with(
+            0, 10)
+        self.brokers['container-1'].get_items_since.assert_called_once_with(
+            5, 10)
+        # The shards are crawled as the replica at their index in the ring
+        handled = [list(call[0][0])
+                   for call in self.handler.handle.call_args_list]
+        self.assertIn([{'ROWID': 1}, {'ROWID': 3}], handled)
+        self.assertIn([{'ROWID': 2}], handled)
+        # Every handler is closed once the container is crawled
+        self.assertEqual(self.crawler.handler_class.call_count,
+                         self.handler.close.call_count)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_sharded_container_failed_shard(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_sharded()
+        self.brokers['container-0'].get_items_since.side_effect = \
+            RuntimeError('oops')
+
+        with self.assertRaises(RuntimeError):
+            self.crawler.handle_container(
+                {'account': 'AUTH_account', 'container': 'container'})
+        self.handler.save_last_row.assert_called_once_with(
+            15, 'container-1-id')
+        self.assertEqual(self.crawler.handler_class.call_count,
+                         self.handler.close.call_count)
+
+    @mock.patch('container_crawler.InternalClient')
+    @mock.patch('container_crawler.is_local_device')
+    def test_shard_ranges_from_swift(self, local_mock, client_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        self._setup_sharded(root_local=False)
+        client = client_mock.return_value
+        client.make_path.return_value = '/v1/AUTH_account/container'
+        head_resp = mock.Mock(headers={'X-Backend-Sharding-State': 'sharded'})
+        get_resp = mock.Mock(headers={'X-Backend-Record-Type': 'shard'})
+        get_resp.body = json.dumps(
+            [dict(shard_range) for shard_range in self.shard_ranges])
+        client.make_request.side_effect = \
+            lambda method, *args, **kwargs: \
+            head_resp if method == 'HEAD' else get_resp
+        settings = {'account': 'AUTH_account', 'container': 'container'}
+
+        self.assertEqual((13, 0), self.crawler.handle_container(settings))
+        self.assertEqual(
+            [mock.call('HEAD', '/v1/AUTH_account/container', {}, (2,)),
+             mock.call('GET', '/v1/AUTH_account/container',
+                       {'X-Backend-Record-Type': 'shard'}, (2,),
+                       params={'format': 'json'})],
+            client.make_request.call_args_list)
+        self.assertFalse(self.brokers['container'].get_info.called)
+
+        # The shard ranges are cached
+        self.crawler.handle_container(settings)
+        self.assertEqual(2, client.make_request.call_count)
+
+        # The shard ranges of unsharded containers are not requested
+        self.crawler._shard_ranges = {}
+        client.make_request.reset_mock()
+        head_resp.headers = {'X-Backend-Sharding-State': 'unsharded'}
+        self.assertEqual([], self.crawler.get_shard_ranges(settings))
+        client.make_request.assert_called_once_with(
+            'HEAD', '/v1/AUTH_account/container', {}, (2,))
+
+        # Unsharded containers return the object listing
+        self.crawler._shard_ranges = {}
+        head_resp.headers = {'X-Backend-Sharding-State': 'sharding'}
+        get_resp.headers = {'X-Backend-Record-Type': 'object'}
+        self.assertEqual([], self.crawler.get_shard_ranges(settings))
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_stop_completes_batch(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        self.crawler.items_chunk = 4
+        self.crawler.items_batch = 2
+        rows = [{'ROWID': x} for x in range(1, 5)]
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id'}
+        broker.get_items_since.side_effect = \
+            lambda start, count: rows[start:start + count]
+        broker.get_max_row.return_value = 4
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        handler.get_last_row.return_value = 0
+        # The crawler is stopped while the first sub-batch is handled
+        handler.handle.side_effect = lambda rows: self.crawler.stop()
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+
+        self.assertEqual((2, 2), self.crawler.handle_container(
+            {'account': 'AUTH_account', 'container': 'container'}))
+        handler.save_last_row.assert_called_once_with(2, 'db-id')
+        broker.get_items_since.assert_called_once_with(0, 2)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_handle_container_skips_idle_db(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.bulk = True
+        broker = mock.Mock()
+        broker.get_shard_ranges.return_value = []
+        broker.get_info.return_value = {'id': 'db-id'}
+        broker.get_items_since.return_value = []
+        broker.get_max_row.return_value = 42
+        self.crawler.get_broker = mock.Mock(return_value=broker)
+        self.crawler.get_db_path = mock.Mock(return_value='/path/hash.db')
+        handler = mock.Mock()
+        handler.get_lagging.return_value = []
+        handler.get_last_row.return_value = 42
+        self.crawler.handler_class = mock.Mock(return_value=handler)
+        settings = {'account': 'AUTH_account', 'container': 'container'}
+
+        signature = ((1, 4096, 1000.0), None)
+        with mock.patch.object(self.crawler, '_get_db_signature') as sig_mock:
+            sig_mock.return_value = signature
+            self.assertEqual((0, 0), self.crawler.handle_container(settings))
+            self.assertEqual((0, 0), self.crawler.handle_container(settings))
+            self.crawler.handler_class.assert_called_once_with(
+                '/var/scratch', settings)
+            broker.get_info.assert_called_once_with()
+
+            # Changing the database or the settings requires polling again
+            sig_mock.return_value = ((1, 4096, 1001.0), None)
+            self.crawler.handle_container(settings)
+            self.assertEqual(2, broker.get_info.call_count)
+            new_settings = dict(settings, index='new-index')
+            self.crawler.handle_container(new_settings)
+            self.assertEqual(3, broker.get_info.call_count)
+
+    @mock.patch('container_crawler.is_local_device')
+    def test_local_nodes_cached(self, local_mock):
+        local_mock.side_effect = lambda ips, _, ip, port: ip == '127.0.0.1'
+        nodes = [{'ip': '127.0.0.2', 'port': 6001, 'device': 'sda'},
+                 {'ip': '127.0.0.1', 'port': 6001, 'device': 'sdb'}]
+        self.mock_ring.get_nodes.return_value = ('part', nodes)
+        self.crawler.get_db_path = mock.Mock(return_value='/path/hash.db')
+
+        expected = ('part', 2, [(1, nodes[1], '/path/hash.db')])
+        for _ in range(2):
+            self.assertEqual(expected, self.crawler.get_local_nodes(
+                'AUTH_account', 'container'))
+        self.mock_ring.get_nodes.assert_called_once_with(
+            'AUTH_account', 'container')
+        self.assertEqual(2, local_mock.call_count)
+        self.crawler.get_db_path.assert_called_once_with(
+            'AUTH_account', 'container', 'part', nodes[1])
+
+    @mock.patch('container_crawler.Ring')
+    @mock.patch('container_crawler.os.path.getmtime')
+    def test_ring_reload(self, mtime_mock, ring_mock):
+        self.crawler._ring_mtime = 1000.0
+        self.crawler._local_nodes[('AUTH_account', 'container')] = \
+            ('part', 1, [])
+        self.crawler._brokers['/path/hash.db'] = ((1, 1), mock.Mock())
+
+        mtime_mock.return_value = 1000.0
+        self.crawler._check_ring()
+        self.assertFalse(ring_mock.called)
+        self.assertEqual(1, len(self.crawler._local_nodes))
+        self.assertEqual(1, len(self.crawler._brokers))
+
+        mtime_mock.return_value = 1001.0
+        self.crawler._check_ring()
+        ring_mock.assert_called_once_with('/etc/swift', ring_name='container')
+        self.assertIs(ring_mock.return_value, self.crawler.container_ring)
+        self.assertEqual({}, self.crawler._local_nodes)
+        self.assertEqual({}, self.crawler._brokers)
+        self.assertEqual(1001.0, self.crawler._ring_mtime)
+
+        # A ring that cannot be loaded is retried on the next poll
+        ring_mock.side_effect = RuntimeError('oops')
+        mtime_mock.return_value = 1002.0
+        self.crawler._check_ring()
+        self.assertEqual(1001.0, self.crawler._ring_mtime)
+
+    @mock.patch('container_crawler.os.stat')
+    def test_brokers_reused(self, stat_mock):
+        stat_mock.return_value = mock.Mock(st_ino=1, st_mtime_ns=1000)
+        self.crawler.get_broker = mock.Mock(
+            side_effect=lambda *args: mock.Mock())
+        self.crawler.broker_cache_size = 2
+        node = {'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}
+
+        def get_broker(container):
+            return self.crawler._get_cached_broker(
+                'AUTH_account', container, 'part', node,
+                '/path/%s/hash.db' % container)
+
+        broker = get_broker('a')
+        self.assertIs(broker, get_broker('a'))
+        self.assertEqual(1, self.crawler.get_broker.call_count)
+
+        # The files of the database directory changed
+        stat_mock.return_value = mock.Mock(st_ino=1, st_mtime_ns=2000)
+        new_broker = get_broker('a')
+        self.assertIsNot(broker, new_broker)
+
+        # The least recently used brokers are dropped
+        get_broker('b')
+        self.assertIs(new_broker, get_broker('a'))
+        get_broker('c')
+        self.assertEqual(['/path/a/hash.db', '/path/c/hash.db'],
+                         list(self.crawler._brokers))
+
+    @mock.patch('container_crawler.time')
+    def test_wait_wakes_changed_containers(self, time_mock):
+        containers = [{'account': 'foo', 'container': 'bar'}]
+        self.crawler._containers = containers
+        self.crawler.scheduler.update(containers[0], 0, 0, now=10)
+        time_mock.time.return_value = 10
+        self.crawler.watcher = mock.Mock()
+        self.crawler.watcher.read_events.return_value = set()
+        self.crawler.watcher.wait.return_value = set([('foo', 'bar')])
+
+        self.crawler._wait(10 - self.crawler.poll_interval)
+        time_mock.sleep.assert_not_called()
+        self.crawler.watcher.wait.assert_called_once_with(
+            self.crawler.WAKE_INTERVAL)
+        self.assertEqual([(containers[0], 1)],
+                         self.crawler.scheduler.schedule(containers, now=10))
+
     def test_bulk_errors(self):
         self.mock_ring.get_nodes.return_value = ['part', []]
         self.crawler.bulk = True
 
         mock_handler = mock.Mock()
+        mock_handler.get_lagging.return_value = []
         mock_handler.handle.side_effect = RuntimeError('error')
 
         with self.assertRaises(RuntimeError):
             self.crawler.process_items(mock_handler, [], 1, 0)
 
-    def test_failed_handler_class_constructor(self):
-        self.mock_ring.get_nodes.return_value = ['part', []]
+    @mock.patch('container_crawler.is_local_device')
+    def test_failed_handler_class_constructor(self, local_mock):
+        local_mock.return_value = True
+        self.mock_ring.get_nodes.return_value = [
+            'part', [{'ip': '127.0.0.1', 'port': 6001, 'device': 'sda'}]]
+        self.crawler.get_db_path = mock.Mock(return_value='/nonexistent.db')
 
         self.crawler.handler_class = mock.Mock()
         self.crawler.handler_class.side_effect = RuntimeError('oops')
@@ -80,6 +717,7 @@ class TestContainerCrawler(unittest.TestCase):
 
         for node_id in (0, 1):
             mock_handler = mock.Mock()
+            mock_handler.get_lagging.return_value = []
             mock_handler.handle.side_effect = RuntimeError('oops')
 
             with self.assertRaises(RuntimeError):
@@ -98,6 +736,7 @@ class TestContainerCrawler(unittest.TestCase):
 
         for node_id in (0, 1):
             mock_handler = mock.Mock()
+            mock_handler.get_lagging.return_value = []
             mock_handler.handle.side_effect = RuntimeError('oops')
 
             # only fail the verify calls
@@ -120,6 +759,54 @@ class TestContainerCrawler(unittest.TestCase):
             self.assertEqual(expected,
                              mock_handler.handle.call_args_list)
 
+    @mock.patch('container_crawler.time')
+    def test_run_always_stops(self, time_mock):
+        time_mock.time.return_value = 10
+        self.crawler.conf['containers'] = [
+            {'account': 'foo', 'container': 'bar'},
+            {'account': 'foo', 'container': 'baz'}]
+        self.crawler.handle_container = mock.Mock(return_value=(0, 0))
+        self.crawler.handle_container.side_effect = \
+            lambda *args: self.crawler.stop() or (0, 0)
+
+        self.crawler.run_always()
+        # No further containers are processed and the crawler does not sleep
+        self.assertEqual(1, self.crawler.handle_container.call_count)
+        time_mock.sleep.assert_not_called()
+
+    @mock.patch('container_crawler.time')
+    def test_reload(self, time_mock):
+        time_mock.time.return_value = 10
+        containers = [{'account': 'foo', 'container': 'bar'}]
+        self.crawler.conf['containers'] = containers
+        self.crawler.scheduler.update(containers[0], 0, 0, now=10)
+        new_conf = dict(self.conf, items_chunk=500, poll_interval=1,
+                        containers=containers + [
+                            {'account': 'foo', 'container': 'baz'}])
+        self.crawler.request_reload(lambda: new_conf)
+        self.crawler.run_once = mock.Mock(
+            side_effect=lambda: self.crawler.stop())
+
+        self.crawler.run_always()
+        self.assertIs(new_conf, self.crawler.conf)
+        self.assertEqual(500, self.crawler.items_chunk)
+        self.assertEqual(500, self.crawler.scheduler.items_chunk)
+        self.assertEqual(1, self.crawler.poll_interval)
+        # The scheduling state is preserved
+        self.assertEqual(
+            5, self.crawler.scheduler.states[('foo', 'bar')].idle_interval)
+
+    def test_reload_failure(self):
+        conf = self.crawler.conf
+
+        def _load_conf():
+            raise ValueError('bad config')
+
+        self.crawler.request_reload(_load_conf)
+        self.crawler.reload()
+        self.assertIs(conf, self.crawler.conf)
+        self.assertIsNone(self.crawler._load_conf)
+
     @mock.patch('container_crawler.time')
     def test_exit_if_no_containers(self, time_mock):
         time_mock.sleep.side_effect = RuntimeError('Should not sleep')
@@ -143,7 +830,7 @@ class TestContainerCrawler(unittest.TestCase):
         self.crawler.handle_container.side_effect = RuntimeError('oops')
         self.crawler.run_once()
 
-        expected_handle_calls = [mock.call(conf) for conf in containers]
+        expected_handle_calls = [mock.call(conf, 1) for conf in containers]
         self.assertEqual(expected_handle_calls,
                          self.crawler.handle_container.call_args_list)
         expected_logger_calls = [
@@ -159,8 +846,71 @@ class TestContainerCrawler(unittest.TestCase):
         self.assertEqual(expected_logger_calls,
                          self.crawler.logger.error.call_args_list)
 
+    def test_run_once_profile(self):
+        containers = [{'account': 'foo', 'container': 'bar'},
+                      {'account': 'foo', 'container': 'baz'}]
+        self.crawler.conf['containers'] = containers
+        self.crawler.handle_container = mock.Mock(return_value=(0, 0))
+        self.crawler.scheduler = mock.Mock()
+        self.crawler.scheduler.schedule.return_value = [
+            (settings, 1) for settings in containers]
+        self.crawler.profiler = mock.MagicMock()
+
+        self.crawler.run_once()
+        self.assertEqual([], self.crawler.profiler.mock_calls)
+
+        self.crawler.request_profile(2)
+        for _ in range(3):
+            self.crawler.run_once()
+        self.assertEqual(
+            [mock.call.start_cycle(),
+             mock.call.profile(containers[0]),
+             mock.call.profile(containers[1]),
+             mock.call.end_cycle()] * 2,
+            [call for call in self.crawler.profiler.mock_calls
+             if not call[0].startswith('profile().')])
+
+    @mock.patch('container_crawler.Ring')
+    def test_profile_config(self, mock_ring):
+        self.conf['profile'] = True
+        crawler = container_crawler.ContainerCrawler(self.conf, None)
+        self.assertEqual(3, crawler._profile_cycles)
+        self.assertEqual('/var/scratch/.profiles',
+                         crawler.profiler.profile_dir)
+
+        # Reloading the same options does not profile again
+        crawler._profile_cycles = 0
+        crawler.request_reload(lambda: dict(self.conf))
+        crawler.reload()
+        self.assertEqual(0, crawler._profile_cycles)
+
+        self.conf['profile_cycles'] = 5
+        self.conf['profile_dir'] = '/profiles'
+        crawler.request_reload(lambda: self.conf)
+        crawler.reload()
+        self.assertEqual(5, crawler._profile_cycles)
+        self.assertEqual('/profiles', crawler.profiler.profile_dir)
+
+    def test_run_once_stats(self):
+        containers = [{'account': 'foo', 'container': 'bar'},
+                      {'account': 'foo', 'container': 'baz'}]
+        self.crawler.conf['containers'] = containers
+        self.crawler.handle_container = mock.Mock(
+            side_effect=[(10, 5), RuntimeError('oops')])
+        self.crawler.run_once()
+
+        stats = self.crawler.stats
+        self.assertEqual(1, stats.polls)
+        self.assertEqual(10, stats.get(containers[0]).rows)
+        self.assertEqual(5, stats.get(containers[0]).backlog)
+        self.assertEqual(1000, stats.get(containers[0]).chunk_rows)
+        self.assertIsNotNone(stats.get(containers[0]).last_success)
+        self.assertIsNotNone(stats.get(containers[1]).last_failure)
+        self.assertEqual("RuntimeError('oops')",
+                         stats.get(containers[1]).last_error)
+
     def test_processes_every_container(self):
-        self.crawler.handle_container = mock.Mock()
+        self.crawler.handle_container = mock.Mock(return_value=(0, 0))
         self.crawler.conf['containers'] = [
             {'account': 'foo',
              'container': 'foo'},
@@ -169,7 +919,48 @@ class TestContainerCrawler(unittest.TestCase):
         ]
 
         self.crawler.run_once()
-        expected_calls = [mock.call(container)
+        expected_calls = [mock.call(container, 1)
                           for container in self.crawler.conf['containers']]
         self.assertEquals(expected_calls,
                           self.crawler.handle_container.call_args_list)
+
+    def test_discovers_account_containers(self):
+        self.crawler.handle_container = mock.Mock(return_value=(0, 0))
+        account_settings = {'account': 'AUTH_test', 'per_account': True}
+        self.crawler.conf['containers'] = [
+            {'account': 'foo', 'container': 'foo'}, account_settings]
+        self.crawler._list_containers = mock.Mock(
+            return_value=iter(['bar', 'baz']))
+        self.crawler.is_local_container = mock.Mock(
+            side_effect=lambda account, container: container == 'baz')
+
+        self.crawler.run_once()
+        self.assertEqual(
+            [mock.call({'account': 'foo', 'container': 'foo'}, 1),
+             mock.call(dict(account_settings, container='baz'), 1)],
+            self.crawler.handle_container.call_args_list)
+
+    def test_per_account_handler(self):
+        self.crawler.handler_class = mock.Mock()
+        settings = {'account': 'AUTH_test', 'container': 'foo',
+                    'per_account': True}
+        self.crawler._create_handler(settings)
+        self.crawler.handler_class.assert_called_once_with(
+            '/var/scratch', settings, per_account=True)
+
+    def test_processes_lagging_containers_first(self):
+        self.crawler.handle_container = mock.Mock(return_value=(0, 0))
+        containers = [
+            {'account': 'foo', 'container': 'idle'},
+            {'account': 'foo', 'container': 'busy', 'max_lag': 10}
+        ]
+        self.crawler.conf['containers'] = containers
+        self.crawler.scheduler.update(containers[0], 0, 0, now=0)
+        self.crawler.scheduler.update(containers[1], 1000, 5000, now=0)
+
+        with mock.patch('container_crawler.scheduler.time.time') as time_mock:
+            time_mock.return_value = 1
+            self.crawler.run_once()
+        self.assertEqual(
+            [mock.call(containers[1], self.crawler.scheduler.max_chunks)],
+            self.crawler.handle_container.call_args_list)
@@ -0,0 +1,59 @@
+import mock
+import unittest
+
+from container_crawler.discovery import AccountDiscovery
+
+
+class TestAccountDiscovery(unittest.TestCase):
+    def setUp(self):
+        self.listing = ['c%02d' % i for i in range(10)]
+        self.local = set(self.listing)
+        self.list_mock = mock.Mock(side_effect=self._list)
+        self.settings = {'account': 'AUTH_test', 'per_account': True,
+                         'index': 'index-{container}'}
+        self.discovery = AccountDiscovery(
+            self.settings, self.list_mock,
+            lambda account, container: container in self.local,
+            batch_size=4)
+
+    def _list(self, account, marker):
+        return iter([name for name in self.listing if name > marker])
+
+    def _names(self, containers):
+        return [settings['container'] for settings in containers]
+
+    def test_incremental_discovery(self):
+        self.assertEqual(self.listing[:4],
+                         self._names(self.discovery.discover()))
+        self.assertEqual(self.listing[:8],
+                         self._names(self.discovery.discover()))
+        self.assertEqual(self.listing,
+                         self._names(self.discovery.discover()))
+        self.assertEqual([mock.call('AUTH_test', ''),
+                          mock.call('AUTH_test', 'c03'),
+                          mock.call('AUTH_test', 'c07')],
+                         self.list_mock.call_args_list)
+        self.assertEqual('', self.discovery.marker)
+
+        containers = self.discovery.discover()
+        self.assertEqual(dict(self.settings, container='c00'), containers[0])
+
+    def test_only_local_containers(self):
+        self.local = set(['c01', 'c05', 'c09'])
+        for _ in range(3):
+            containers = self.discovery.discover()
+        self.assertEqual(['c01', 'c05', 'c09'], self._names(containers))
+
+    def test_removed_containers(self):
+        for _ in range(3):
+            self.discovery.discover()
+        self.listing.remove('c02')
+        self.listing.remove('c09')
+        self.local.remove('c05')
+
+        self.assertIn('c05', self._names(self.discovery.discover()))
+        # Containers that are no longer local are removed once listed
+        self.assertNotIn('c05', self._names(self.discovery.discover()))
+        # Deleted containers are removed once the pass is complete
+        self.assertEqual(['c00', 'c01', 'c03', 'c04', 'c06', 'c07', 'c08'],
+                         self._names(self.discovery.discover()))
@@ -0,0 +1,60 @@
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from container_crawler.profiler import CycleProfiler
+
+
+class TestCycleProfiler(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.log = mock.Mock()
+        self.profiler = CycleProfiler(self.tempdir, keep=2, top=5,
+                                      log=self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _profile_cycle(self, now, containers):
+        self.profiler.start_cycle(now)
+        cycle_dir = self.profiler.cycle_dir
+        for container in containers:
+            with self.profiler.profile({'account': 'AUTH_test',
+                                        'container': container}):
+                sorted(range(1000), key=lambda x: -x)
+        self.profiler.end_cycle()
+        return cycle_dir
+
+    def test_profile_cycle(self):
+        cycle_dir = self._profile_cycle(1500000000.5, ['foo', 'b/ar'])
+
+        self.assertEqual('cycle-20170714T024000.500000',
+                         os.path.basename(cycle_dir))
+        self.assertEqual(
+            ['AUTH_test%2Fb%2Far.prof', 'AUTH_test%2Fb%2Far.txt',
+             'AUTH_test%2Ffoo.prof', 'AUTH_test%2Ffoo.txt', 'summary.txt'],
+            sorted(os.listdir(cycle_dir)))
+        with open(os.path.join(cycle_dir, 'summary.txt')) as f:
+            summary = f.read()
+        self.assertIn('<lambda>', summary)
+        self.assertIsNone(self.profiler.cycle_dir)
+        self.assertFalse(self.log.mock_calls[0][1][0] == 'error')
+
+    def test_rotation(self):
+        cycles = [self._profile_cycle(1500000000 + i, ['foo'])
+                  for i in range(4)]
+        self.assertEqual(sorted(os.path.basename(path)
+                                for path in cycles[2:]),
+                         sorted(os.listdir(self.tempdir)))
+
+    def test_dump_failure(self):
+        self.profiler.start_cycle()
+        shutil.rmtree(self.profiler.cycle_dir)
+        with self.profiler.profile({'account': 'a', 'container': 'c'}):
+            pass
+        self.log.assert_called_once_with(
+            'error', mock.ANY)
+        self.assertTrue(self.log.call_args[0][1].startswith(
+            'Failed to write the profile of a%2Fc'))
@@ -0,0 +1,57 @@
+import unittest
+
+from container_crawler.scheduler import ContainerScheduler
+
+
+class TestContainerScheduler(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = ContainerScheduler(
+            100, 5, max_chunks=4, max_idle_interval=40)
+        self.containers = [{'account': 'a', 'container': 'c%d' % i}
+                           for i in range(3)]
+
+    def test_unknown_containers_are_due(self):
+        self.assertEqual([(settings, 1) for settings in self.containers],
+                         self.scheduler.schedule(self.containers, now=0))
+
+    def test_backlog_ordering_and_chunks(self):
+        self.scheduler.update(self.containers[0], 100, 50, now=0)
+        self.scheduler.update(self.containers[1], 100, 250, now=0)
+        self.scheduler.update(self.containers[2], 100, 10000, now=0)
+
+        self.assertEqual([(self.containers[2], 4),
+                          (self.containers[1], 3),
+                          (self.containers[0], 1)],
+                         self.scheduler.schedule(self.containers, now=1))
+
+    def test_priority(self):
+        self.containers[0]['priority'] = 4
+        self.scheduler.update(self.containers[0], 100, 50, now=0)
+        self.scheduler.update(self.containers[1], 100, 150, now=0)
+
+        self.assertEqual([(self.containers[0], 2),
+                          (self.containers[1], 2),
+                          (self.containers[2], 1)],
+                         self.scheduler.schedule(self.containers, now=1))
+
+    def test_max_lag(self):
+        self.containers[2]['max_lag'] = 10
+        self.scheduler.update(self.containers[1], 100, 300, now=0)
+        self.scheduler.update(self.containers[2], 100, 20, now=0)
+
+        schedule = self.scheduler.schedule(self.containers, now=1)
+        self.assertEqual((self.containers[2], 4), schedule[0])
+
+    def test_idle_backoff(self):
+        settings = self.containers[0]
+        intervals = []
+        for _ in range(5):
+            self.scheduler.update(settings, 0, 0, now=100)
+            intervals.append(self.scheduler.next_poll([settings]) - 100)
+        self.assertEqual([5, 10, 20, 40, 40], intervals)
+        self.assertEqual([], self.scheduler.schedule([settings], now=139))
+        self.assertEqual([(settings, 1)],
+                         self.scheduler.schedule([settings], now=140))
+
+        self.scheduler.update(settings, 10, 0, now=140)
+        self.assertEqual(140, self.scheduler.next_poll([settings]))
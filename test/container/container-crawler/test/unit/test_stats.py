@@ -0,0 +1,45 @@
+import unittest
+
+from container_crawler.stats import CrawlerStats
+
+
+class TestCrawlerStats(unittest.TestCase):
+    def setUp(self):
+        self.stats = CrawlerStats()
+        self.settings = {'account': 'AUTH_test', 'container': 'test'}
+
+    def test_container_progress(self):
+        self.stats.start_container(self.settings, 2000)
+        self.assertEqual('AUTH_test/test', self.stats.current)
+        self.stats.set_checkpoint(self.settings, 500, now=100)
+        self.stats.container_done(self.settings, 500, 1500, 2.0, now=101)
+
+        container = self.stats.to_dict()['containers']['AUTH_test/test']
+        self.assertIsNone(self.stats.current)
+        self.assertEqual(500, container['checkpoint'])
+        self.assertEqual(1500, container['backlog'])
+        self.assertEqual(2000, container['chunk_rows'])
+        self.assertEqual(500, container['rows'])
+        self.assertEqual(250.0, container['rows_per_second'])
+        self.assertEqual(101, container['last_success'])
+        self.assertIsNone(container['last_failure'])
+
+    def test_container_failure(self):
+        self.stats.start_container(self.settings, 1000)
+        self.stats.container_failed(self.settings, RuntimeError('oops'),
+                                    now=100)
+        container = self.stats.get(self.settings)
+        self.assertEqual(100, container.last_failure)
+        self.assertEqual("RuntimeError('oops')", container.last_error)
+        self.assertIsNone(self.stats.current)
+
+    def test_liveness_and_readiness(self):
+        self.stats.last_activity = 100
+        self.assertFalse(self.stats.is_ready())
+        self.assertTrue(self.stats.is_alive(60, now=150))
+        self.assertFalse(self.stats.is_alive(60, now=170))
+
+        self.stats.poll_done(now=200)
+        self.assertTrue(self.stats.is_ready())
+        self.assertTrue(self.stats.is_alive(60, now=250))
+        self.assertEqual(1, self.stats.polls)
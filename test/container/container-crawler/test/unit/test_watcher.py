@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from container_crawler.watcher import DBWatcher
+
+
+class TestDBWatcher(unittest.TestCase):
+    def setUp(self):
+        self.watcher = DBWatcher.create()
+        if not self.watcher:
+            raise unittest.SkipTest('inotify is not available')
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_wait_for_changes(self):
+        dirs = [os.path.join(self.tempdir, name) for name in ('foo', 'bar')]
+        for path in dirs:
+            os.mkdir(path)
+        self.assertTrue(self.watcher.watch(dirs[0], ('AUTH_a', 'foo')))
+        self.assertTrue(self.watcher.watch(dirs[1], ('AUTH_a', 'bar')))
+
+        self.assertEqual(set(), self.watcher.wait(0))
+        with open(os.path.join(dirs[1], 'hash.db.pending'), 'a') as f:
+            f.write(':update')
+        self.assertEqual(set([('AUTH_a', 'bar')]), self.watcher.wait(1))
+        self.assertEqual(set(), self.watcher.wait(0))
+
+    def test_watch_missing_directory(self):
+        self.assertFalse(self.watcher.watch(
+            os.path.join(self.tempdir, 'missing'), ('AUTH_a', 'foo')))
+
+    def test_removed_directory(self):
+        path = os.path.join(self.tempdir, 'foo')
+        os.mkdir(path)
+        self.watcher.watch(path, ('AUTH_a', 'foo'))
+        os.rmdir(path)
+        self.assertEqual(set([('AUTH_a', 'foo')]), self.watcher.wait(1))
+        self.assertEqual(set(), self.watcher.keys())
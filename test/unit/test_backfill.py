@@ -0,0 +1,104 @@
+import mock
+import unittest
+
+from swift_metadata_sync import backfill
+
+
+class TestBackfill(unittest.TestCase):
+    def setUp(self):
+        self.settings = {'account': 'AUTH_test',
+                         'container': 'test',
+                         'index': 'test-index',
+                         'es_hosts': 'es.example.com'}
+        self.crawler = mock.Mock()
+        self.crawler.items_chunk = 3
+        self.crawler.status_dir = '/status/dir'
+        self.rows = [{'ROWID': i, 'name': 'object_%d' % i,
+                      'deleted': i % 5 == 0, 'created_at': 0}
+                     for i in range(1, 21)]
+        self.broker = mock.Mock()
+        self.broker.get_max_row.return_value = 20
+        self.broker.get_items_since.side_effect = \
+            lambda start, count: self.rows[start:start + count]
+        self.crawler.get_local_broker.return_value = (
+            self.broker, {'id': 'db-id'})
+
+    def test_split_rows(self):
+        self.assertEqual([(0, 4), (4, 8), (8, 10)],
+                         backfill.Backfill.split_rows(10, 3))
+        self.assertEqual([(0, 1), (1, 2)],
+                         backfill.Backfill.split_rows(2, 16))
+        self.assertEqual([], backfill.Backfill.split_rows(0, 4))
+
+    @mock.patch('swift_metadata_sync.backfill.elasticsearch.client')
+    @mock.patch('swift_metadata_sync.backfill.MetadataSync')
+    def test_backfill(self, sync_mock, client_mock):
+        handler = sync_mock.return_value
+        handler._index = 'test-index'
+        handler._rollover = None
+        handler._get_document_id.side_effect = lambda row: row['name']
+        handler._create_index_op.side_effect = \
+            lambda doc_id, row, client: doc_id
+        handler._bulk_index.return_value = []
+        handler._check_errors.side_effect = None
+        index_client = client_mock.IndicesClient.return_value
+        index_client.get_settings.return_value = {'test-index-1': {
+            'settings': {'index': {'number_of_replicas': '2'}}}}
+
+        indexed = backfill.Backfill(
+            self.crawler, self.settings, workers=2, bulk_size=100).run()
+
+        self.assertEqual(16, indexed)
+        indexed_docs = [doc for call in handler._bulk_index.call_args_list
+                        for doc in call[0][0]]
+        self.assertEqual(
+            sorted(row['name'] for row in self.rows if not row['deleted']),
+            sorted(indexed_docs))
+        for call in handler._bulk_index.call_args_list:
+            self.assertEqual({'chunk_size': 100}, call[1])
+        # No staleness checks against the new index
+        handler._get_stale_rows.assert_not_called()
+        self.assertEqual(
+            [mock.call(index='test-index', body={'index': {
+                'refresh_interval': '-1', 'number_of_replicas': 0}}),
+             mock.call(index='test-index', body={'index': {
+                 'refresh_interval': None, 'number_of_replicas': '2'}})],
+            index_client.put_settings.call_args_list)
+        handler.save_last_row.assert_called_once_with(20, 'db-id')
+
+    @mock.patch('swift_metadata_sync.backfill.elasticsearch.client')
+    @mock.patch('swift_metadata_sync.backfill.MetadataSync')
+    def test_backfill_errors(self, sync_mock, client_mock):
+        handler = sync_mock.return_value
+        handler._rollover = None
+        handler._bulk_index.return_value = ['failed']
+        handler._check_errors.side_effect = RuntimeError('failed')
+        index_client = client_mock.IndicesClient.return_value
+        index_client.get_settings.return_value = {}
+
+        with self.assertRaises(RuntimeError):
+            backfill.Backfill(self.crawler, self.settings).run()
+        # The settings are restored, but the checkpoint is not moved
+        self.assertEqual(2, index_client.put_settings.call_count)
+        handler.save_last_row.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.backfill.elasticsearch.client')
+    @mock.patch('swift_metadata_sync.backfill.MetadataSync')
+    def test_backfill_rollover(self, sync_mock, client_mock):
+        handler = sync_mock.return_value
+        handler._index = 'alias'
+        handler._rollover = {'max_docs': 1000}
+        handler._get_document_id.side_effect = lambda row: row['name']
+        handler._create_index_op.side_effect = \
+            lambda doc_id, row, client: {'_id': doc_id, '_index': 'alias'}
+        handler._route_ops.side_effect = lambda ops: [
+            dict(op, _index='alias-000001') for op in ops]
+        handler._bulk_index.return_value = []
+        handler._check_errors.side_effect = None
+        client_mock.IndicesClient.return_value.get_settings.return_value = {}
+
+        backfill.Backfill(self.crawler, self.settings, workers=1).run()
+        indexes = set(op['_index']
+                      for call in handler._bulk_index.call_args_list
+                      for op in call[0][0])
+        self.assertEqual(set(['alias-000001']), indexes)
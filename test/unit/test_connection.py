@@ -0,0 +1,78 @@
+import gzip
+import mock
+import unittest
+
+from swift_metadata_sync import connection
+
+
+class TestCompressedHttpConnection(unittest.TestCase):
+    def setUp(self):
+        self.conn = connection.CompressedHttpConnection(maxsize=4)
+        self.urllib3_pool = self.conn.pool._pool
+        self.pool = mock.Mock()
+        self.conn.pool._pool = self.pool
+
+    def test_connection_pool(self):
+        self.assertEqual('gzip,deflate', self.conn.headers['accept-encoding'])
+        self.assertEqual(4, self.urllib3_pool.pool.maxsize)
+
+    def test_compress_body(self):
+        self.pool.urlopen.return_value.status = 200
+        self.pool.urlopen.return_value.data = b'{}'
+        self.conn.perform_request('POST', '/_bulk', body=b'{"index": {}}\n')
+
+        args, kwargs = self.pool.urlopen.call_args
+        self.assertEqual(b'{"index": {}}\n', gzip.decompress(args[2]))
+        self.assertEqual('gzip', kwargs['headers']['content-encoding'])
+        # The shared headers of the connection are not modified
+        self.assertNotIn('content-encoding', self.conn.headers)
+
+    def test_no_body(self):
+        self.pool.urlopen.return_value.status = 200
+        self.pool.urlopen.return_value.data = b'{}'
+        self.conn.perform_request('GET', '/')
+
+        args, kwargs = self.pool.urlopen.call_args
+        self.assertIsNone(args[2])
+        self.assertNotIn('content-encoding', kwargs['headers'])
+
+
+class TestClientRegistry(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.dict(connection._CLIENTS, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('swift_metadata_sync.connection.elasticsearch.Elasticsearch')
+    def test_shared_client(self, mock_es):
+        mock_es.side_effect = lambda *args, **kwargs: mock.Mock()
+        client = connection.get_client(['es1', 'es2'], pool_size=4)
+        self.assertIs(client, connection.get_client(['es1', 'es2'],
+                                                    pool_size=4))
+        mock_es.assert_called_once_with(
+            ['es1', 'es2'], maxsize=4, timeout=10, dead_timeout=60,
+            selector_class=connection.RoundRobinSelector,
+            connection_class=connection.CompressedHttpConnection)
+
+        # Other clusters or options use their own client
+        self.assertIsNot(client, connection.get_client(['es3'], pool_size=4))
+        self.assertIsNot(client, connection.get_client(['es1', 'es2'],
+                                                       pool_size=8))
+        self.assertEqual(3, len(connection._CLIENTS))
+
+    def test_round_robin(self):
+        client = connection.create_client(['es1:9200', 'es2:9200'],
+                                          timeout=5, dead_timeout=30)
+        pool = client.transport.connection_pool
+        self.assertIsInstance(pool.selector, connection.RoundRobinSelector)
+        self.assertEqual(30, pool.dead_timeout)
+        self.assertEqual([5, 5], [conn.timeout for conn in pool.connections])
+        hosts = set(pool.get_connection().host for _ in range(2))
+        self.assertEqual(set(['http://es1:9200', 'http://es2:9200']), hosts)
+
+    @mock.patch('swift_metadata_sync.connection.elasticsearch.Elasticsearch')
+    def test_failed_client(self, mock_es):
+        mock_es.side_effect = RuntimeError('Unable to sniff hosts')
+        with self.assertRaises(RuntimeError):
+            connection.get_client(['es1'], sniff=True)
+        self.assertEqual({}, connection._CLIENTS)
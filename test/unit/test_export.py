@@ -0,0 +1,219 @@
+import gzip
+import json
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import export
+
+
+class TestExport(unittest.TestCase):
+    def setUp(self):
+        self.settings = {'account': 'AUTH_test',
+                         'container': 'test',
+                         'index': 'test-index',
+                         'es_hosts': 'es.example.com'}
+        self.crawler = mock.Mock()
+        self.crawler.items_chunk = 3
+        self.crawler.status_dir = '/status/dir'
+        self.rows = [{'ROWID': i, 'name': 'object_%d' % i,
+                      'deleted': i % 5 == 0, 'created_at': 0}
+                     for i in range(1, 13)]
+        self.broker = mock.Mock()
+        self.broker.db_file = '/srv/node/sda/containers/db.db'
+        self.broker.get_max_row.return_value = 10
+        self.broker.get_items_since.side_effect = \
+            lambda start, count: self.rows[start:start + count]
+        self.crawler.get_local_broker.return_value = (
+            self.broker, {'id': 'db-id'})
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def _read_file(self, name):
+        with gzip.open(os.path.join(self.path, name), 'rb') as f:
+            return [json.loads(line.decode('utf-8')) for line in f]
+
+    @mock.patch('swift_metadata_sync.export.MetadataSync')
+    def test_export(self, sync_mock):
+        handler = sync_mock.return_value
+        handler._index = 'test-index'
+        handler._get_document_id.side_effect = lambda row: row['name']
+        handler._create_index_op.side_effect = \
+            lambda doc_id, row, client: {'_op_type': 'index',
+                                         '_id': doc_id,
+                                         '_index': 'test-index',
+                                         '_type': 'object',
+                                         '_source': {'x-swift-object': doc_id},
+                                         'pipeline': 'test-pipeline'}
+
+        manifest = export.Exporter(
+            self.crawler, self.settings, self.path, workers=2,
+            max_file_size=300).run()
+
+        sync_mock.assert_called_once_with(
+            '/status/dir', self.settings, connect=False)
+        self.assertEqual('db-id', manifest['db_id'])
+        self.assertEqual('/srv/node/sda/containers/db.db',
+                         manifest['db_path'])
+        self.assertEqual(10, manifest['max_row'])
+        self.assertEqual('test-index', manifest['index'])
+        with open(os.path.join(self.path, export.MANIFEST)) as f:
+            self.assertEqual(manifest, json.load(f))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.path, export.MANIFEST + '.tmp')))
+
+        # The files are rotated once they exceed the size limit
+        self.assertGreater(len(manifest['files']), 1)
+        lines = []
+        for entry in manifest['files']:
+            file_lines = self._read_file(entry['name'])
+            self.assertEqual(2 * entry['documents'], len(file_lines))
+            lines += file_lines
+        # Only the live rows up to the max row at the start are exported
+        expected = ['object_%d' % i for i in range(1, 11) if i % 5]
+        self.assertEqual(expected, [line['x-swift-object']
+                                    for line in lines[1::2]])
+        self.assertEqual(
+            {'index': {'_id': 'object_1', '_index': 'test-index',
+                       '_type': 'object', 'pipeline': 'test-pipeline'}},
+            lines[0])
+
+    @mock.patch('swift_metadata_sync.export.MetadataSync')
+    def test_export_deleted_objects(self, sync_mock):
+        handler = sync_mock.return_value
+        handler._index = 'test-index'
+        handler._get_document_id.side_effect = lambda row: row['name']
+
+        def _create_index_op(doc_id, row, client):
+            if doc_id == 'object_2':
+                raise export.UnexpectedResponse(
+                    'Unexpected response: 404 Not Found',
+                    mock.Mock(status_int=404))
+            return {'_op_type': 'index', '_id': doc_id,
+                    '_index': 'test-index', '_type': 'object',
+                    '_source': {'x-swift-object': doc_id}}
+        handler._create_index_op.side_effect = _create_index_op
+
+        manifest = export.Exporter(self.crawler, self.settings,
+                                   self.path).run()
+        lines = []
+        for entry in manifest['files']:
+            lines += self._read_file(entry['name'])
+        self.assertEqual(['object_%d' % i for i in (1, 3, 4, 6, 7, 8, 9)],
+                         [line['x-swift-object'] for line in lines[1::2]])
+
+        # Other errors abort the export
+        handler._create_index_op.side_effect = export.UnexpectedResponse(
+            'Unexpected response: 503 Service Unavailable',
+            mock.Mock(status_int=503))
+        with self.assertRaises(export.UnexpectedResponse):
+            export.Exporter(self.crawler, self.settings, self.path).run()
+
+    @mock.patch('swift_metadata_sync.export.ContainerBroker')
+    @mock.patch('swift_metadata_sync.export.MetadataSync')
+    def test_load(self, sync_mock, broker_mock):
+        writer = export.BulkFileWriter(self.path, 1000)
+        for i in range(3):
+            writer.write({'index': {'_id': 'id-%d' % i,
+                                    '_index': 'old-index',
+                                    '_type': 'object'}},
+                         {'x-swift-object': 'object_%d' % i})
+        writer.close()
+        db_path = os.path.join(self.path, 'db.db')
+        open(db_path, 'w').close()
+        with open(os.path.join(self.path, export.MANIFEST), 'w') as f:
+            json.dump({'db_id': 'db-id', 'db_path': db_path, 'max_row': 42,
+                       'files': writer.files}, f)
+        broker_mock.return_value.get_info.return_value = {'id': 'db-id'}
+
+        handler = sync_mock.return_value
+        handler._index = 'new-index'
+        handler._rollover = None
+        handler._es_conn.bulk.return_value = {'errors': False, 'items': []}
+        handler._check_errors.side_effect = None
+
+        export.Loader('/status/dir', self.settings, self.path,
+                      bulk_size=2).run()
+
+        self.assertEqual(2, handler._es_conn.bulk.call_count)
+        docs = []
+        for call in handler._es_conn.bulk.call_args_list:
+            body = call[1]['body'].splitlines()
+            for action, source in zip(body[::2], body[1::2]):
+                self.assertEqual('new-index',
+                                 json.loads(action)['index']['_index'])
+                docs.append(json.loads(source)['x-swift-object'])
+        self.assertEqual(['object_0', 'object_1', 'object_2'], docs)
+        handler._check_errors.assert_called_once_with([])
+        broker_mock.assert_called_once_with(db_path)
+        handler.save_last_row.assert_called_once_with(42, 'db-id')
+
+        # The checkpoint is only set on the node of the exported database
+        handler.reset_mock()
+        handler._es_conn.bulk.return_value = {'errors': False, 'items': []}
+        broker_mock.return_value.get_info.return_value = {'id': 'other-id'}
+        export.Loader('/status/dir', self.settings, self.path).run()
+        handler.save_last_row.assert_not_called()
+
+        os.unlink(db_path)
+        export.Loader('/status/dir', self.settings, self.path).run()
+        handler.save_last_row.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.export.MetadataSync')
+    def test_load_errors(self, sync_mock):
+        writer = export.BulkFileWriter(self.path, 1000)
+        writer.write({'index': {'_id': 'id-0', '_index': 'old-index',
+                                '_type': 'object'}},
+                     {'x-swift-object': 'object_0'})
+        writer.close()
+        with open(os.path.join(self.path, export.MANIFEST), 'w') as f:
+            json.dump({'db_id': 'db-id', 'max_row': 1,
+                       'files': writer.files}, f)
+
+        handler = sync_mock.return_value
+        handler._index = 'new-index'
+        handler._rollover = None
+        handler._es_conn.bulk.return_value = {
+            'errors': True,
+            'items': [{'index': {'_id': 'id-0', 'status': 400,
+                                 'error': 'failed'}}]}
+        handler._extract_error.return_value = 'failed'
+        handler._check_errors.side_effect = RuntimeError('failed')
+
+        with self.assertRaises(RuntimeError):
+            export.Loader('/status/dir', self.settings, self.path).run()
+        handler._check_errors.assert_called_once_with(['id-0: failed'])
+        handler.save_last_row.assert_not_called()
+
+    @mock.patch('swift_metadata_sync.export.MetadataSync')
+    def test_load_rollover(self, sync_mock):
+        writer = export.BulkFileWriter(self.path, 1000)
+        for i in range(2):
+            writer.write({'index': {'_id': 'id-%d' % i,
+                                    '_index': 'old-index',
+                                    '_type': 'object'}},
+                         {'x-swift-object': 'object_%d' % i})
+        writer.close()
+        with open(os.path.join(self.path, export.MANIFEST), 'w') as f:
+            json.dump({'db_id': 'db-id', 'max_row': 2,
+                       'files': writer.files}, f)
+
+        handler = sync_mock.return_value
+        handler._index = 'alias'
+        handler._rollover = {'max_docs': 1000}
+        # id-0 is in an older index of the alias
+        handler._route_ops.side_effect = lambda ops: [
+            dict(op, _index='alias-000001') if op['_id'] == 'id-0' else op
+            for op in ops]
+        handler._es_conn.bulk.return_value = {'errors': False, 'items': []}
+        handler._check_errors.side_effect = None
+
+        export.Loader('/status/dir', self.settings, self.path).run()
+        body = handler._es_conn.bulk.call_args[1]['body'].splitlines()
+        self.assertEqual(['alias-000001', 'alias'],
+                         [json.loads(action)['index']['_index']
+                          for action in body[::2]])
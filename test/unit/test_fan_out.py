@@ -0,0 +1,300 @@
+import eventlet
+import mock
+import unittest
+
+from swift_metadata_sync import fan_out
+
+
+class TestSharedMetadataClient(unittest.TestCase):
+    def test_shared_requests(self):
+        client = mock.Mock()
+
+        def _head(account, container, obj, headers=None):
+            eventlet.sleep(0)
+            return {'name': obj}
+        client.get_object_metadata.side_effect = _head
+        shared = fan_out.SharedMetadataClient(client)
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(
+            lambda obj: shared.get_object_metadata('a', 'c', obj),
+            ['foo', 'foo', 'bar', 'foo']))
+        self.assertEqual([{'name': 'foo'}, {'name': 'foo'}, {'name': 'bar'},
+                          {'name': 'foo'}], results)
+        self.assertEqual(
+            [mock.call('a', 'c', 'foo', headers=None),
+             mock.call('a', 'c', 'bar', headers=None)],
+            client.get_object_metadata.call_args_list)
+
+    def test_failed_request(self):
+        client = mock.Mock()
+
+        def _head(account, container, obj, headers=None):
+            eventlet.sleep(0)
+            if client.get_object_metadata.call_count == 1:
+                raise RuntimeError('oops')
+            return {'name': obj}
+        client.get_object_metadata.side_effect = _head
+        shared = fan_out.SharedMetadataClient(client)
+
+        def _get(obj):
+            try:
+                return shared.get_object_metadata('a', 'c', obj)
+            except RuntimeError:
+                return None
+
+        pool = eventlet.GreenPool()
+        results = list(pool.imap(_get, ['foo', 'foo', 'foo']))
+        self.assertEqual([None, {'name': 'foo'}, {'name': 'foo'}], results)
+        self.assertEqual(2, client.get_object_metadata.call_count)
+
+
+class TestFanOutSync(unittest.TestCase):
+    def setUp(self):
+        self.settings = {
+            'account': 'AUTH_test',
+            'container': 'test',
+            'es_hosts': 'es.example.com',
+            'index': 'test-index',
+            'targets': [{},
+                        {'name': 'archive', 'es_hosts': 'archive.example.com',
+                         'pipeline': 'archive'}]}
+        self.targets = {}
+
+        def _create_target(status_dir, settings, per_account, connect=True):
+            target = mock.Mock()
+            target.settings = settings
+            target.status_dir = status_dir
+            target.connect = connect
+            self.targets[settings.get('name', settings['index'])] = target
+            return target
+
+        patcher = mock.patch('swift_metadata_sync.fan_out.MetadataSync',
+                             side_effect=_create_target)
+        self.sync_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.rows = [{'ROWID': i, 'name': 'object-%d' % i, 'deleted': False}
+                     for i in range(1, 6)]
+        fan_out.FanOutSync._failed_targets.clear()
+        self.addCleanup(fan_out.FanOutSync._failed_targets.clear)
+
+    def _create(self):
+        with mock.patch('container_crawler.base_sync.InternalClient'):
+            return fan_out.FanOutSync('/status', self.settings)
+
+    def test_target_settings(self):
+        self._create()
+        self.assertEqual(['archive', 'test-index'], sorted(self.targets))
+        self.assertEqual(
+            {'account': 'AUTH_test', 'container': 'test',
+             'es_hosts': 'es.example.com', 'index': 'test-index'},
+            self.targets['test-index'].settings)
+        self.assertEqual(
+            {'account': 'AUTH_test', 'container': 'test',
+             'es_hosts': 'archive.example.com', 'index': 'test-index',
+             'name': 'archive', 'pipeline': 'archive'},
+            self.targets['archive'].settings)
+        self.assertEqual('/status/.targets/test-index',
+                         self.targets['test-index'].status_dir)
+        self.assertEqual('/status/.targets/archive',
+                         self.targets['archive'].status_dir)
+
+    def test_duplicate_names(self):
+        self.settings['targets'] = [{}, {'es_hosts': 'archive.example.com'}]
+        with self.assertRaises(ValueError):
+            self._create()
+
+    def test_independent_checkpoints(self):
+        sync = self._create()
+        self.targets['test-index'].get_last_row.return_value = 4
+        self.targets['archive'].get_last_row.return_value = 4
+        self.assertEqual(4, sync.get_last_row('db-id'))
+        self.assertEqual([], sync.get_lagging('db-id'))
+
+        sync.handle(iter(self.rows[4:]))
+        for target in self.targets.values():
+            target.handle_internal.assert_called_once_with(
+                self.rows[4:], mock.ANY)
+        # The targets share the HEAD requests
+        self.assertIs(
+            self.targets['test-index'].handle_internal.call_args[0][1],
+            self.targets['archive'].handle_internal.call_args[0][1])
+
+        sync.save_last_row(5, 'db-id')
+        for target in self.targets.values():
+            target.save_last_row.assert_called_once_with(5, 'db-id')
+
+    def test_lagging_target(self):
+        sync = self._create()
+        self.targets['test-index'].get_last_row.return_value = 4
+        self.targets['archive'].get_last_row.return_value = 2
+        # The crawler resumes from the highest checkpoint
+        self.assertEqual(4, sync.get_last_row('db-id'))
+        sync.handle(iter(self.rows[4:]))
+        sync.save_last_row(5, 'db-id')
+        self.targets['test-index'].handle_internal.assert_called_once_with(
+            self.rows[4:], mock.ANY)
+        self.targets['test-index'].save_last_row.assert_called_once_with(
+            5, 'db-id')
+        self.assertFalse(self.targets['archive'].handle_internal.called)
+        self.assertFalse(self.targets['archive'].save_last_row.called)
+
+        # The target that is behind catches up from its own checkpoint
+        lagging, = sync.get_lagging('db-id')
+        self.assertEqual(2, lagging.get_last_row('db-id'))
+        lagging.handle(iter(self.rows[2:5]))
+        lagging.save_last_row(5, 'db-id')
+        self.targets['archive'].handle_internal.assert_called_once_with(
+            self.rows[2:5], mock.ANY)
+        self.targets['archive'].save_last_row.assert_called_once_with(
+            5, 'db-id')
+
+        self.targets['archive'].handle_internal.side_effect = RuntimeError(
+            'oops')
+        with self.assertRaises(RuntimeError):
+            lagging.handle(iter(self.rows))
+        self.assertIn('/status/.targets/archive',
+                      fan_out.FanOutSync._failed_targets)
+
+    def test_failed_target(self):
+        sync = self._create()
+        for target in self.targets.values():
+            target.get_last_row.return_value = 0
+        sync.get_last_row('db-id')
+        self.targets['archive'].handle_internal.side_effect = RuntimeError(
+            'oops')
+
+        sync.handle(self.rows[:3])
+        sync.save_last_row(3, 'db-id')
+        sync.handle(self.rows[3:])
+        sync.save_last_row(5, 'db-id')
+
+        self.assertEqual(2, self.targets['test-index'].handle_internal
+                         .call_count)
+        self.assertEqual([mock.call(3, 'db-id'), mock.call(5, 'db-id')],
+                         self.targets['test-index'].save_last_row
+                         .call_args_list)
+        self.targets['archive'].handle_internal.assert_called_once_with(
+            self.rows[:3], mock.ANY)
+        self.assertFalse(self.targets['archive'].save_last_row.called)
+
+        self.targets['test-index'].handle_internal.side_effect = \
+            RuntimeError('oops')
+        with self.assertRaises(RuntimeError):
+            sync.handle(self.rows[3:])
+
+    def test_slow_target(self):
+        self.settings['target_timeout'] = 0.01
+        sync = self._create()
+        self.targets['archive'].handle_internal.side_effect = \
+            lambda rows, client: eventlet.sleep(1)
+        for target in self.targets.values():
+            target.get_last_row.return_value = 0
+        sync.get_last_row('db-id')
+        sync.handle(self.rows)
+        sync.save_last_row(5, 'db-id')
+        self.targets['test-index'].save_last_row.assert_called_once_with(
+            5, 'db-id')
+        self.assertFalse(self.targets['archive'].save_last_row.called)
+
+    def test_failed_connection(self):
+        def _create_target(status_dir, settings, per_account, connect=True):
+            if connect and settings.get('name') == 'archive':
+                raise RuntimeError('connection refused')
+            target = mock.Mock()
+            target.connect = connect
+            self.targets[settings.get('name', settings['index'])] = target
+            return target
+        self.sync_mock.side_effect = _create_target
+
+        sync = self._create()
+        self.assertFalse(self.targets['archive'].connect)
+        self.targets['archive'].get_last_row.return_value = 1
+        self.targets['test-index'].get_last_row.return_value = 3
+        # The crawler does not resume from the checkpoint of a failed target
+        self.assertEqual(3, sync.get_last_row('db-id'))
+        sync.handle(self.rows)
+        self.assertFalse(self.targets['archive'].handle_internal.called)
+        self.targets['test-index'].handle_internal.assert_called_once_with(
+            self.rows[3:], mock.ANY)
+
+    @mock.patch('swift_metadata_sync.fan_out.time')
+    def test_failed_target_behind(self, time_mock):
+        time_mock.time.return_value = 1000
+        sync = self._create()
+        self.targets['test-index'].get_last_row.return_value = 1000
+        self.targets['archive'].get_last_row.return_value = 0
+        self.targets['archive'].handle_internal.side_effect = RuntimeError(
+            'cluster unavailable')
+        rows = [{'ROWID': i, 'name': 'object-%d' % i, 'deleted': False}
+                for i in range(1, 1201)]
+
+        # The first poll resumes from the checkpoint of the healthy target,
+        # and the other one fails to catch up
+        self.assertEqual(1000, sync.get_last_row('db-id'))
+        sync.handle(rows[1000:1100])
+        sync.save_last_row(1100, 'db-id')
+        self.targets['test-index'].save_last_row.assert_called_once_with(
+            1100, 'db-id')
+        lagging, = sync.get_lagging('db-id')
+        with self.assertRaises(RuntimeError):
+            lagging.handle(rows[:100])
+        self.assertFalse(self.targets['archive'].save_last_row.called)
+
+        # The next polls skip the failed target and resume from the healthy
+        # target's checkpoint
+        time_mock.time.return_value = 1030
+        sync = self._create()
+        self.targets['test-index'].get_last_row.return_value = 1000
+        self.targets['archive'].get_last_row.return_value = 0
+        self.assertEqual(1000, sync.get_last_row('db-id'))
+        sync.handle(rows[1000:1100])
+        sync.save_last_row(1100, 'db-id')
+        self.targets['test-index'].handle_internal.assert_called_once_with(
+            rows[1000:1100], mock.ANY)
+        self.targets['test-index'].save_last_row.assert_called_once_with(
+            1100, 'db-id')
+        self.assertFalse(self.targets['archive'].handle_internal.called)
+        self.assertFalse(self.targets['archive'].connect)
+
+        # The failed target is retried after the interval
+        time_mock.time.return_value = 1061
+        sync = self._create()
+        self.assertTrue(self.targets['archive'].connect)
+        self.targets['test-index'].get_last_row.return_value = 1100
+        self.targets['archive'].get_last_row.return_value = 0
+        # The retried target does not move the crawl back to its checkpoint
+        self.assertEqual(1100, sync.get_last_row('db-id'))
+        self.assertEqual(1, len(sync.get_lagging('db-id')))
+
+    def test_handle_empty_container(self):
+        sync = self._create()
+        for target in self.targets.values():
+            target.handle_empty_container.return_value = True
+        self.assertTrue(sync.handle_empty_container(20000))
+
+        self.targets['archive'].handle_empty_container.return_value = False
+        self.assertFalse(sync.handle_empty_container(20000))
+        self.targets['test-index'].handle_empty_container\
+            .assert_called_with(20000)
+
+    @mock.patch('swift_metadata_sync.fan_out.FanOutSync')
+    def test_create_handler(self, fan_out_mock):
+        self.assertEqual(
+            fan_out_mock.return_value,
+            fan_out.create_handler('/status', self.settings))
+        del self.settings['targets']
+        self.sync_mock.side_effect = None
+        self.assertEqual(
+            self.sync_mock.return_value,
+            fan_out.create_handler('/status', self.settings, True))
+        self.sync_mock.assert_called_once_with('/status', self.settings, True,
+                                               lazy=True)
+
+        self.settings['queue'] = True
+        with mock.patch('swift_metadata_sync.fan_out.QueuedSync') as \
+                queued_mock:
+            self.assertEqual(
+                queued_mock.return_value,
+                fan_out.create_handler('/status', self.settings))
+        queued_mock.assert_called_once_with('/status', self.settings, False)
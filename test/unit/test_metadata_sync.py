@@ -2,9 +2,13 @@ import email
 import hashlib
 import json
 import mock
+import os
+import shutil
+import stat
+import tempfile
 import unittest
 
-from swift_metadata_sync import metadata_sync
+from swift_metadata_sync import connection, metadata_sync
 
 
 class TestMetadataSync(unittest.TestCase):
@@ -55,6 +59,12 @@ class TestMetadataSync(unittest.TestCase):
         self.es_mock = mock.Mock()
         self.es_mock.info.return_value = {'version': {'number': '2.2.0'}}
         mock_es.return_value = self.es_mock
+        # Every handler creates its client, rather than sharing it
+        patcher = mock.patch(
+            'swift_metadata_sync.metadata_sync.get_client',
+            new=connection.create_client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
         self.sync = metadata_sync.MetadataSync(self.status_dir,
                                                self.sync_conf)
@@ -69,6 +79,170 @@ class TestMetadataSync(unittest.TestCase):
         self.assertFalse(self.sync._parse_json)
         self.assertEqual(None, self.sync._pipeline)
 
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_lazy_connection(self, mock_verify_mapping, mock_es):
+        mock_es.return_value = self.es_mock
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf,
+                                          lazy=True)
+        mock_es.assert_not_called()
+        self.assertIsNone(sync._es_conn)
+        # The checkpoints do not require the cluster
+        self.assertEqual(0, sync.get_last_row('db-id'))
+        mock_es.assert_not_called()
+
+        row = {'name': 'foo', 'deleted': True,
+               'created_at': '1528323859.12345'}
+        with mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.'
+                        'helpers.bulk', return_value=(0, [])):
+            sync.handle_internal([row], None)
+            mock_es.assert_called_once()
+            mock_verify_mapping.assert_called_once_with()
+            self.assertEqual((2, 2, 0), sync._server_version)
+
+            # The handler connects once
+            sync.handle_internal([row], None)
+            mock_es.assert_called_once()
+
+    @mock.patch('swift_metadata_sync.metadata_sync.FAST_JSON', new=False)
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_connection_options(self, mock_verify_mapping, mock_es):
+        mock_es.return_value = self.es_mock
+        metadata_sync.MetadataSync(self.status_dir, self.sync_conf,
+                                   concurrency=8)
+        mock_es.assert_called_once_with(
+            self.es_hosts, maxsize=8, timeout=10, dead_timeout=60,
+            selector_class=connection.RoundRobinSelector,
+            connection_class=connection.CompressedHttpConnection)
+
+        mock_es.reset_mock()
+        metadata_sync.MetadataSync(
+            self.status_dir, dict(self.sync_conf, es_compress=False))
+        mock_es.assert_called_once_with(
+            self.es_hosts, maxsize=4, timeout=10, dead_timeout=60,
+            selector_class=connection.RoundRobinSelector)
+
+        mock_es.reset_mock()
+        metadata_sync.MetadataSync(
+            self.status_dir, dict(self.sync_conf, es_compress=False,
+                                  es_pool_size=16, es_timeout=30,
+                                  es_sniff=True, es_sniff_interval=120,
+                                  es_dead_timeout=10))
+        mock_es.assert_called_once_with(
+            self.es_hosts, maxsize=16, timeout=30, dead_timeout=10,
+            selector_class=connection.RoundRobinSelector,
+            sniff_on_start=True, sniff_on_connection_fail=True,
+            sniffer_timeout=120, sniff_timeout=connection.SNIFF_TIMEOUT)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.FAST_JSON', new=True)
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_fast_json_serializer(self, mock_verify_mapping, mock_es):
+        mock_es.return_value = self.es_mock
+        metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        self.assertIsInstance(mock_es.call_args[1]['serializer'],
+                              connection.FastJSONSerializer)
+
+    def test_create_es_doc(self):
+        meta = {'x-timestamp': '1528323859.12345',
+                'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT',
+                'content-length': '42',
+                'content-type': 'text/plain',
+                'etag': 'deadbeef',
+                'accept-ranges': 'bytes',
+                'x-object-meta-color': 'blue',
+                'x-object-meta-content-type': 'user type',
+                'x-object-meta-doc': b'{"a": 1}'}
+        self.assertEqual(
+            {'x-timestamp': 1528323859123,
+             'last-modified': 1528323859000,
+             'x-swift-account': 'account',
+             'x-swift-container': 'container',
+             'x-swift-object': 'key',
+             'content-length': '42',
+             # The user metadata overrides the headers
+             'content-type': 'user type',
+             'etag': 'deadbeef',
+             'color': 'blue',
+             'doc': {'a': 1}},
+            metadata_sync.MetadataSync._create_es_doc(
+                meta, 'account', 'container', 'key', parse_json=True))
+
+        projection = metadata_sync.MetadataProjection(
+            exclude=['content-*'], exclude_fields=['etag'], max_size=3)
+        self.assertEqual(
+            {'x-timestamp': 1528323859123,
+             'last-modified': 1528323859000,
+             'x-swift-account': 'account',
+             'x-swift-container': 'container',
+             'x-swift-object': 'key',
+             'content-length': '42',
+             'content-type': 'text/plain',
+             'color': 'blu',
+             'doc': b'{"a'},
+            metadata_sync.MetadataSync._create_es_doc(
+                meta, 'account', 'container', 'key', projection=projection))
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_per_account_index(self, mock_verify_mapping, mock_es):
+        mock_es.return_value = self.es_mock
+        sync_conf = dict(self.sync_conf, container='photos',
+                         index='swift-{container}')
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf,
+                                          per_account=True)
+        self.assertEqual('swift-photos', sync._index)
+
+        sync = metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertEqual('swift-{container}', sync._index)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.MetadataSync._verify_mapping')
+    def test_per_account_index_escaped(self, mock_verify_mapping, mock_es):
+        mock_es.return_value = self.es_mock
+
+        def index_name(container, index='swift-{container}'):
+            sync_conf = dict(self.sync_conf, container=container, index=index)
+            return metadata_sync.MetadataSync(
+                self.status_dir, sync_conf, per_account=True)._index
+
+        def digest(container):
+            return hashlib.sha1(container.encode('utf-8')).hexdigest()[:8]
+
+        self.assertEqual('swift-my_photos_2019-' + digest('My Photos/2019'),
+                         index_name('My Photos/2019'))
+        self.assertEqual('swift-a_b_c_d-' + digest('a*b?c#d'),
+                         index_name('a*b?c#d'))
+        self.assertNotEqual(index_name('a b'), index_name('a_b'))
+        # The names that differ in case do not share an index
+        self.assertEqual('swift-photos-' + digest('Photos'),
+                         index_name('Photos'))
+        self.assertEqual(3, len(set([index_name('photos'),
+                                     index_name('Photos'),
+                                     index_name('PHOTOS')])))
+        # The names may not start with _, - or +
+        self.assertEqual('photos-' + digest('_photos'),
+                         index_name('_photos', '{container}'))
+        self.assertEqual(digest('+'), index_name('+', '{container}'))
+        self.assertEqual('swift-_photos', index_name('_photos'))
+        # The names are truncated to 255 bytes
+        long_name = u'\u00e9' * 200
+        name = index_name(long_name)
+        self.assertLessEqual(len(name.encode('utf-8')), 255)
+        self.assertTrue(name.startswith(u'swift-\u00e9'))
+        self.assertTrue(name.endswith('-' + digest(long_name)))
+
     @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
     def test_get_last_row_nonexistent(self, exists_mock):
         exists_mock.return_value = False
@@ -107,56 +281,49 @@ class TestMetadataSync(unittest.TestCase):
         open_mock.return_value = self.FakeFile('')
         self.assertEqual(0, self.sync.get_last_row('db_id'))
 
-    @mock.patch('swift_metadata_sync.metadata_sync.os.mkdir')
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_dir_does_not_exist(self, exists_mock, open_mock,
-                                              mkdir_mock):
-        exists_mock.return_value = False
-        fake_file = self.FakeFile('')
-        open_mock.return_value = fake_file
+    def _set_status_dir(self):
+        status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, status_dir)
+        self.sync._status_account_dir = os.path.join(
+            status_dir, self.test_account)
+        self.sync._status_file = os.path.join(
+            self.sync._status_account_dir, self.test_container)
+
+    def _read_status(self):
+        # The temporary files are renamed over the status file
+        self.assertEqual([self.test_container],
+                         os.listdir(self.sync._status_account_dir))
+        with open(self.sync._status_file) as f:
+            return json.load(f)
+
+    def test_save_last_row_dir_does_not_exist(self):
+        self._set_status_dir()
         self.sync.save_last_row(42, 'db-id')
 
-        mkdir_mock.assert_called_once_with(self.sync._status_account_dir)
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
+        status = self._read_status()
         self.assertIn('db-id', status)
         self.assertEqual(42, status['db-id']['last_row'])
         self.assertEqual(self.test_index, status['db-id']['index'])
 
-    @mock.patch('swift_metadata_sync.metadata_sync.os.mkdir')
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_does_not_exist(self, exists_mock, open_mock,
-                                          mkdir_mock):
-        def fake_exists(path):
-            if path.endswith(self.sync._account):
-                return True
-            return False
-
-        fake_file = self.FakeFile('')
-        exists_mock.side_effect = fake_exists
-        open_mock.return_value = fake_file
+    def test_save_last_row_does_not_exist(self):
+        self._set_status_dir()
+        os.mkdir(self.sync._status_account_dir)
         self.sync.save_last_row(42, 'db-id')
 
-        mkdir_mock.assert_not_called()
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
+        status = self._read_status()
         self.assertIn('db-id', status)
         self.assertEqual(42, status['db-id']['last_row'])
         self.assertEqual(self.test_index, status['db-id']['index'])
 
-    @mock.patch('__builtin__.open')
-    @mock.patch('swift_metadata_sync.metadata_sync.os.path.exists')
-    def test_save_last_row_new_db_id(self, exists_mock, open_mock):
+    def test_save_last_row_new_db_id(self):
+        self._set_status_dir()
+        os.mkdir(self.sync._status_account_dir)
         old_status = {'old_id': {'last_row': 1, 'index': self.test_index}}
-        fake_file = self.FakeFile(json.dumps(old_status))
-        exists_mock.return_value = True
-        open_mock.return_value = fake_file
+        with open(self.sync._status_file, 'w') as f:
+            json.dump(old_status, f)
 
         self.sync.save_last_row(42, 'new-id')
-        self.assertTrue(fake_file.closed)
-        status = json.loads(fake_file.data)
+        status = self._read_status()
         self.assertIn('new-id', status)
         self.assertIn('old_id', status)
         self.assertEqual(42, status['new-id']['last_row'])
@@ -164,6 +331,29 @@ class TestMetadataSync(unittest.TestCase):
         self.assertEqual(1, status['old_id']['last_row'])
         self.assertEqual(self.test_index, status['old_id']['index'])
 
+    def test_save_last_row_mode(self):
+        self._set_status_dir()
+        umask = os.umask(0o022)
+        try:
+            self.sync.save_last_row(42, 'db-id')
+        finally:
+            os.umask(umask)
+        self.assertEqual(0o644, stat.S_IMODE(
+            os.stat(self.sync._status_file).st_mode))
+
+    def test_save_last_row_failure(self):
+        self._set_status_dir()
+        os.mkdir(self.sync._status_account_dir)
+        with open(self.sync._status_file, 'w') as f:
+            json.dump({'db-id': {'last_row': 1, 'index': self.test_index}}, f)
+
+        with mock.patch('swift_metadata_sync.metadata_sync.os.fsync',
+                        side_effect=OSError('failed')):
+            with self.assertRaises(OSError):
+                self.sync.save_last_row(42, 'db-id')
+        # The previous checkpoint is left intact
+        self.assertEqual(1, self._read_status()['db-id']['last_row'])
+
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete(self, helpers_mock):
         rows = [{'name': 'row %d' % i, 'deleted': True} for i in range(0, 10)]
@@ -177,10 +367,9 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        helpers_mock.bulk.assert_called_once_with(
+            self.sync._es_conn, expected_delete_ops, raise_on_error=False,
+            raise_on_exception=False, filter_path=self.sync.BULK_FILTER_PATH)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete_errors(self, helpers_mock):
@@ -200,10 +389,9 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        helpers_mock.bulk.assert_called_once_with(
+            self.sync._es_conn, expected_delete_ops, raise_on_error=False,
+            raise_on_exception=False, filter_path=self.sync.BULK_FILTER_PATH)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_delete_skip_404(self, helpers_mock):
@@ -221,10 +409,41 @@ class TestMetadataSync(unittest.TestCase):
             '_index': self.test_index,
             '_type': metadata_sync.MetadataSync.DOC_TYPE
         } for row in rows]
-        helpers_mock.bulk.assert_called_once_with(self.sync._es_conn,
-                                                  expected_delete_ops,
-                                                  raise_on_error=False,
-                                                  raise_on_exception=False)
+        helpers_mock.bulk.assert_called_once_with(
+            self.sync._es_conn, expected_delete_ops, raise_on_error=False,
+            raise_on_exception=False, filter_path=self.sync.BULK_FILTER_PATH)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_delete_conflicts(self, helpers_mock):
+        ops = [{'_op_type': 'delete', '_id': 'id', '_index': self.test_index,
+                '_type': metadata_sync.MetadataSync.DOC_TYPE, '_version': 1}]
+        helpers_mock.bulk.return_value = (0, [{
+            'delete': {'_id': 'id', 'status': 409,
+                       'error': {'type': 'version_conflict_engine_exception'}}
+        }])
+
+        self.assertEqual([], self.sync._bulk_delete(ops,
+                                                    ignore_conflicts=True))
+        self.assertEqual(1, len(self.sync._bulk_delete(ops)))
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_bulk_index_rejected(self, helpers_mock):
+        ops = [{'_op_type': 'index', '_id': 'id-%d' % i,
+                '_index': self.test_index, '_source': {}} for i in range(3)]
+        helpers_mock.bulk.return_value = (0, [
+            {'index': {'_id': 'id-0', 'status': 400,
+                       'error': {'type': 'mapper_parsing_exception'}}},
+            {'index': {'_id': 'id-1', 'status': 429,
+                       'error': {'type': 'es_rejected_execution_exception'}}},
+            {'index': {'_id': 'id-2', 'status': 'N/A',
+                       'exception': 'ConnectionError'}}])
+
+        # Only the client errors that fail again if retried are rejected
+        rejected = []
+        self.assertEqual(2, len(self.sync._bulk_index(ops,
+                                                      rejected=rejected)))
+        self.assertEqual([('id-0', '400')], rejected)
+        self.assertEqual(3, len(self.sync._bulk_index(ops)))
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_update_and_new_docs(self, helpers_mock):
@@ -273,12 +492,14 @@ class TestMetadataSync(unittest.TestCase):
         } for i in range(1, 10, 2)]
         helpers_mock.bulk.assert_called_once_with(
             self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            filter_path=self.sync.BULK_FILTER_PATH)
         self.sync._es_conn.mget.assert_called_once_with(
             body=mock.ANY,
             index=self.test_index,
             refresh=True,
-            _source=['x-timestamp'])
+            _source=['x-timestamp'],
+            filter_path=self.sync.MGET_FILTER_PATH)
         call = self.sync._es_conn.mget.mock_calls[0]
         self.assertIn('body', call[2])
         self.assertIn('ids', call[2]['body'])
@@ -332,14 +553,16 @@ class TestMetadataSync(unittest.TestCase):
         }]
         helpers_mock.bulk.assert_called_once_with(
             self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            filter_path=self.sync.BULK_FILTER_PATH)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
                     self.test_account, self.test_container, 'object')]},
             index=self.test_index,
             refresh=True,
-            _source=['x-timestamp'])
+            _source=['x-timestamp'],
+            filter_path=self.sync.MGET_FILTER_PATH)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     def test_handle_unicode_object_name(self, helpers_mock):
@@ -383,14 +606,16 @@ class TestMetadataSync(unittest.TestCase):
         }]
         helpers_mock.bulk.assert_called_once_with(
             self.sync._es_conn, expected_ops, raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            filter_path=self.sync.BULK_FILTER_PATH)
         self.sync._es_conn.mget.assert_called_once_with(
             body={'ids': [
                 self.compute_id(
                     self.test_account, self.test_container, rows[0]['name'])]},
             index=self.test_index,
             refresh=True,
-            _source=['x-timestamp'])
+            _source=['x-timestamp'],
+            filter_path=self.sync.MGET_FILTER_PATH)
 
     @mock.patch(
         'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
@@ -489,6 +714,73 @@ class TestMetadataSync(unittest.TestCase):
             index=self.test_index, doc_type=swift_type,
             body={'properties': expected_mapping})
 
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_verify_mapping_cache(self, es_mock, index_mock, helpers_mock):
+        swift_type = metadata_sync.MetadataSync.DOC_TYPE
+        es_mock.return_value = self.es_mock
+        index_conn = index_mock.return_value
+        index_conn.get_mapping.return_value = {
+            self.test_index: {'mappings': {swift_type: {
+                'properties': metadata_sync.MetadataSync.DOC_MAPPING}}}}
+
+        # The handlers of the cluster verify the mapping once
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        index_conn.get_mapping.assert_called_once_with(
+            index=self.test_index, doc_type=swift_type)
+        index_conn.put_mapping.assert_not_called()
+
+        # A new version of the mapping is verified again
+        sync_conf = dict(self.sync_conf,
+                         metadata_mapping={'color': {'type': 'string',
+                                                     'index': 'not_analyzed'}})
+        metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        metadata_sync.MetadataSync(self.status_dir, sync_conf)
+        self.assertEqual(2, index_conn.get_mapping.call_count)
+        index_conn.put_mapping.assert_called_once_with(
+            index=self.test_index, doc_type=swift_type,
+            body={'properties': {'color': {'type': 'string',
+                                           'index': 'not_analyzed'}}})
+
+        # Mapping errors cause the mapping to be verified again
+        helpers_mock.bulk.return_value = (0, [{'index': {
+            '_id': 'foo', 'status': 400,
+            'error': {'type': 'mapper_parsing_exception',
+                      'root_cause': 'failed to parse'}}}])
+        self.assertEqual(1, len(sync._bulk_index([{'_id': 'foo'}])))
+        metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        self.assertEqual(3, index_conn.get_mapping.call_count)
+
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_server_version_cache(self, es_mock, index_mock):
+        swift_type = metadata_sync.MetadataSync.DOC_TYPE
+        es_conn = mock.Mock()
+        es_conn.info.return_value = {'version': {'number': '5.4.0'}}
+        es_mock.return_value = es_conn
+        index_conn = index_mock.return_value
+        index_conn.get_mapping.return_value = {
+            self.test_index: {'mappings': {swift_type: {
+                'properties': metadata_sync.MetadataSync.DOC_MAPPING}}}}
+
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        es_conn.info.assert_called_once_with()
+        self.assertEqual((5, 4, 0), sync._server_version)
+
+        # Once the mapping is verified, connecting sends no requests
+        es_conn.reset_mock()
+        index_conn.reset_mock()
+        sync = metadata_sync.MetadataSync(self.status_dir, self.sync_conf)
+        self.assertEqual([], es_conn.mock_calls)
+        self.assertEqual([], index_conn.mock_calls)
+        self.assertEqual((5, 4, 0), sync._server_version)
+
     def test_unicode_document_id(self):
         row = {'name': u'monkey-\U0001f435'.encode('utf-8')}
         doc_id = self.sync._get_document_id(row)
@@ -496,6 +788,17 @@ class TestMetadataSync(unittest.TestCase):
             self.test_account, self.test_container, u'monkey-\U0001f435'),
             doc_id)
 
+    def test_document_id_prefix(self):
+        name = u'monkey-\U0001f435'
+        expected = hashlib.sha256(u'/'.join(
+            [self.test_account, self.test_container, name]).encode(
+                'utf-8')).hexdigest()
+        self.assertEqual(expected, self.sync._get_document_id({'name': name}))
+        self.assertEqual(expected, self.sync._get_document_id(
+            {'name': name.encode('utf-8')}))
+        # The hash of the prefix is not changed by the names
+        self.assertEqual(expected, self.sync._get_document_id({'name': name}))
+
     # For delete and index failures, we should extract the reason if
     # possible or return the status if not possible.
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
@@ -628,7 +931,8 @@ class TestMetadataSync(unittest.TestCase):
                          'x-swift-container': self.test_container,
                          'x-swift-object': obj}}],
                 raise_on_error=False,
-                raise_on_exception=False)
+                raise_on_exception=False,
+                filter_path=self.sync.BULK_FILTER_PATH)
 
     @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
     @mock.patch(
@@ -670,4 +974,252 @@ class TestMetadataSync(unittest.TestCase):
               },
               'pipeline': 'test-pipeline'}],
             raise_on_error=False,
-            raise_on_exception=False)
+            raise_on_exception=False,
+            filter_path=self.sync.BULK_FILTER_PATH)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.time.sleep')
+    def test_handle_empty_container(self, sleep_mock):
+        self.sync._server_version = metadata_sync.parse_version('5.4.0')
+        self.es_mock.delete_by_query.return_value = {'task': 'node:1'}
+        self.es_mock.tasks.get.side_effect = [
+            {'completed': False},
+            {'completed': True, 'response': {'deleted': 20000,
+                                             'failures': []}}]
+
+        self.assertTrue(self.sync.handle_empty_container(20000))
+        self.es_mock.delete_by_query.assert_called_once_with(
+            index=self.test_index, doc_type=self.sync.DOC_TYPE,
+            body={'query': {'bool': {'filter': [
+                {'term': {'x-swift-account.keyword': self.test_account}},
+                {'term': {'x-swift-container.keyword':
+                          self.test_container}}]}}},
+            conflicts='proceed', refresh=True, wait_for_completion=False,
+            slices=5, requests_per_second=-1)
+        self.assertEqual([mock.call(task_id='node:1')] * 2,
+                         self.es_mock.tasks.get.call_args_list)
+        sleep_mock.assert_called_once_with(self.sync.TASK_POLL_INTERVAL)
+
+    @mock.patch.dict(metadata_sync.MetadataSync._delete_tasks, clear=True)
+    @mock.patch('swift_metadata_sync.metadata_sync.time.sleep')
+    def test_handle_empty_container_stopped(self, sleep_mock):
+        self.sync._server_version = metadata_sync.parse_version('5.4.0')
+        self.es_mock.delete_by_query.return_value = {'task': 'node:1'}
+        self.es_mock.tasks.get.return_value = {'completed': False}
+        stopping = [False, True]
+        self.sync.is_stopping = lambda: stopping.pop(0)
+
+        # The crawler stops while the task is running
+        self.assertFalse(self.sync.handle_empty_container(20000))
+        self.assertEqual(1, sleep_mock.call_count)
+        self.assertEqual(2, self.es_mock.tasks.get.call_count)
+
+        # The next poll waits for the same task
+        self.es_mock.tasks.get.reset_mock()
+        self.es_mock.tasks.get.return_value = {
+            'completed': True, 'response': {'deleted': 20000,
+                                            'failures': []}}
+        self.sync.is_stopping = lambda: False
+        self.assertTrue(self.sync.handle_empty_container(20000))
+        self.es_mock.delete_by_query.assert_called_once()
+        self.es_mock.tasks.get.assert_called_once_with(task_id='node:1')
+
+    def test_handle_empty_container_skipped(self):
+        # Below the threshold
+        self.sync._server_version = metadata_sync.parse_version('5.4.0')
+        self.assertFalse(self.sync.handle_empty_container(100))
+        # Elasticsearch 2.x does not support delete-by-query
+        self.sync._server_version = metadata_sync.parse_version('2.2.0')
+        self.assertFalse(self.sync.handle_empty_container(20000))
+        # Disabled
+        self.sync._server_version = metadata_sync.parse_version('5.4.0')
+        self.sync._delete_by_query_threshold = 0
+        self.assertFalse(self.sync.handle_empty_container(20000))
+        self.assertFalse(self.es_mock.delete_by_query.called)
+
+    def test_handle_empty_container_failures(self):
+        self.sync._server_version = metadata_sync.parse_version('5.4.0')
+        self.es_mock.delete_by_query.return_value = {'task': 'node:1'}
+        self.es_mock.tasks.get.return_value = {
+            'completed': True,
+            'response': {'deleted': 10, 'failures': [{'cause': 'oops'}]}}
+        self.assertFalse(self.sync.handle_empty_container(20000))
+
+        self.es_mock.delete_by_query.side_effect = \
+            metadata_sync.elasticsearch.TransportError(500, 'oops')
+        self.assertFalse(self.sync.handle_empty_container(20000))
+
+    @mock.patch.dict(metadata_sync.MetadataSync._write_indexes, clear=True)
+    @mock.patch.dict(metadata_sync.MetadataSync._rollover_checks, clear=True)
+    @mock.patch('swift_metadata_sync.metadata_sync.time.time')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.client.IndicesClient')
+    @mock.patch(
+        'swift_metadata_sync.metadata_sync.elasticsearch.Elasticsearch')
+    def test_verify_rollover(self, es_mock, index_mock, time_mock):
+        time_mock.return_value = 1000
+        es_mock.return_value.info.return_value = {
+            'version': {'number': '5.4.0'}}
+        index_conn = index_mock.return_value
+        index_conn.exists_alias.return_value = False
+        conf = dict(self.sync_conf, rollover={'max_docs': 1000000})
+
+        sync = metadata_sync.MetadataSync(self.status_dir, conf)
+        self.assertFalse(index_conn.get_mapping.called)
+        template = index_conn.put_template.call_args[1]
+        self.assertEqual(self.test_index, template['name'])
+        self.assertEqual('%s-*' % self.test_index,
+                         template['body']['template'])
+        self.assertEqual(
+            {'type': 'keyword'},
+            template['body']['mappings'][sync.DOC_TYPE]['properties']['etag'])
+        index_conn.create.assert_called_once_with(
+            index='%s-000001' % self.test_index,
+            body={'aliases': {self.test_index: {}}})
+        self.assertFalse(index_conn.rollover.called)
+        self.assertEqual(
+            {(repr(self.es_hosts), self.test_index):
+             '%s-000001' % self.test_index}, sync._write_indexes)
+
+        # The index may be created concurrently, but other errors are raised
+        for error, raised in [('resource_already_exists_exception', False),
+                              ('index_already_exists_exception', False),
+                              ('illegal_argument_exception', True)]:
+            metadata_sync.MetadataSync._rollover_checks.clear()
+            index_conn.create.side_effect = \
+                metadata_sync.elasticsearch.TransportError(400, error)
+            if raised:
+                with self.assertRaises(
+                        metadata_sync.elasticsearch.TransportError):
+                    metadata_sync.MetadataSync(self.status_dir, conf)
+            else:
+                metadata_sync.MetadataSync(self.status_dir, conf)
+
+        # The alias is only checked every rollover_interval seconds
+        metadata_sync.MetadataSync._rollover_checks.clear()
+        index_conn.create.side_effect = None
+        metadata_sync.MetadataSync(self.status_dir, conf)
+        index_conn.reset_mock()
+        index_conn.exists_alias.return_value = True
+        time_mock.return_value = 1299
+        metadata_sync.MetadataSync(self.status_dir, conf)
+        self.assertEqual([], index_conn.mock_calls)
+
+        time_mock.return_value = 1300
+        index_conn.rollover.return_value = {
+            'rolled_over': True, 'old_index': '%s-000001' % self.test_index,
+            'new_index': '%s-000002' % self.test_index}
+        metadata_sync.MetadataSync(self.status_dir, conf)
+        index_conn.rollover.assert_called_once_with(
+            alias=self.test_index, body={'conditions': {'max_docs': 1000000}})
+        self.assertFalse(index_conn.create.called)
+        self.assertEqual(
+            '%s-000002' % self.test_index,
+            sync._write_indexes[(repr(self.es_hosts), self.test_index)])
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_handle_rollover(self, helpers_mock):
+        self.sync._rollover = {'max_age': '7d'}
+        old_index = '%s-000001' % self.test_index
+        rows = [{'name': 'deleted', 'deleted': True},
+                {'name': 'deleted-missing', 'deleted': True},
+                {'name': 'stale', 'deleted': False,
+                 'created_at': '1500000000.00000'},
+                {'name': 'current', 'deleted': False,
+                 'created_at': '1500000000.00000'},
+                {'name': 'new', 'deleted': False,
+                 'created_at': '1500000000.00000'}]
+        ids = dict((row['name'], self.sync._get_document_id(row))
+                   for row in rows)
+        hits = {ids['deleted']: old_index, ids['stale']: old_index,
+                ids['current']: old_index}
+        timestamps = {ids['current']: 1500000000000}
+
+        def _search(index, doc_type, body, filter_path):
+            self.assertEqual(self.test_index, index)
+            return {'hits': {'hits': [
+                {'_id': doc_id, '_index': hits[doc_id],
+                 '_source': {'x-timestamp': timestamps.get(doc_id, 0)}}
+                for doc_id in body['query']['ids']['values']
+                if doc_id in hits]}}
+        self.es_mock.search.side_effect = _search
+        helpers_mock.bulk.return_value = (None, [])
+        internal_client = mock.Mock()
+        internal_client.get_object_metadata.return_value = {
+            'x-timestamp': '1500000000.00000',
+            'last-modified': 'Fri, 14 Jul 2017 02:40:00 GMT'}
+
+        self.sync.handle_internal(rows, internal_client)
+        self.assertFalse(self.es_mock.mget.called)
+        self.assertFalse(self.es_mock.indices.refresh.called)
+        delete_ops, index_ops = [call[0][1] for call in
+                                 helpers_mock.bulk.call_args_list]
+        # Deletes are sent to the backing index, or skipped if the document
+        # is not in the alias
+        self.assertEqual([(ids['deleted'], old_index)],
+                         [(op['_id'], op['_index']) for op in delete_ops])
+        # Existing documents are updated in their index, while new documents
+        # are written through the alias
+        self.assertEqual([(ids['stale'], old_index),
+                          (ids['new'], self.test_index)],
+                         [(op['_id'], op['_index']) for op in index_ops])
+
+        # The write index is refreshed before searching for the documents
+        # that were written through the alias
+        self.sync._write_indexes[(repr(self.es_hosts), self.test_index)] = \
+            '%s-000002' % self.test_index
+        self.addCleanup(self.sync._write_indexes.clear)
+        self.sync.handle_internal(rows[:1], internal_client)
+        self.assertFalse(self.es_mock.indices.refresh.called)
+        self.sync.handle_internal(rows[4:], internal_client)
+        self.es_mock.indices.refresh.assert_called_once_with(
+            index='%s-000002' % self.test_index)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers')
+    def test_routing(self, helpers_mock):
+        routing_key = hashlib.sha256(
+            ('%s/%s/' % (self.test_account, self.test_container)).encode(
+                'utf-8')).hexdigest()[:16]
+        rows = [{'name': 'deleted', 'deleted': True},
+                {'name': 'new', 'deleted': False,
+                 'created_at': '1500000000.00000'}]
+        ids = [self.sync._get_document_id(row) for row in rows]
+        self.es_mock.mget.return_value = {
+            'docs': [{'_id': ids[1], 'found': False}]}
+        helpers_mock.bulk.return_value = (None, [])
+        internal_client = mock.Mock()
+        internal_client.get_object_metadata.return_value = {
+            'x-timestamp': '1500000000.00000',
+            'last-modified': 'Fri, 14 Jul 2017 02:40:00 GMT'}
+
+        for routing, expected in [
+                ('container', [routing_key, routing_key]),
+                ('partition', ['%s-%d' % (routing_key, int(doc_id[:8], 16) % 4)
+                               for doc_id in ids])]:
+            self.sync._routing = routing
+            self.sync._routing_partitions = 4
+            self.es_mock.reset_mock()
+            helpers_mock.reset_mock()
+            self.sync.handle_internal(rows, internal_client)
+
+            delete_ops, index_ops = [call[0][1] for call in
+                                     helpers_mock.bulk.call_args_list]
+            self.assertEqual(expected[0], delete_ops[0]['_routing'])
+            self.assertEqual(expected[1], index_ops[0]['_routing'])
+            self.assertEqual(
+                {'docs': [{'_id': ids[1], '_routing': expected[1]}]},
+                self.es_mock.mget.call_args[1]['body'])
+
+        self.assertEqual(','.join('%s-%d' % (routing_key, i)
+                                  for i in range(4)),
+                         self.sync.get_container_routing())
+        self.sync._routing = 'container'
+        self.assertEqual(routing_key, self.sync.get_container_routing())
+        self.sync._routing = None
+        self.assertIsNone(self.sync.get_container_routing())
+        self.assertEqual({}, self.sync._routing_params())
+
+    def test_unknown_routing(self):
+        with self.assertRaises(ValueError):
+            metadata_sync.MetadataSync(
+                self.status_dir, dict(self.sync_conf, routing='shard'),
+                connect=False)
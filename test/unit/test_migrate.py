@@ -0,0 +1,113 @@
+import mock
+import unittest
+
+from swift_metadata_sync import migrate
+from swift_metadata_sync.metadata_sync import MetadataSync
+from swift_metadata_sync.utils import parse_version
+
+
+class TestRoutingMigration(unittest.TestCase):
+    def setUp(self):
+        self.settings = {'account': 'AUTH_test',
+                         'container': 'test',
+                         'index': 'test-index',
+                         'es_hosts': 'es.example.com',
+                         'routing': 'container'}
+        self.hits = [
+            # Routed by the ID
+            {'_id': 'id-a', '_index': 'test-index', '_version': 1,
+             '_source': {'a': 1}},
+            # Already moved
+            {'_id': 'id-b', '_index': 'test-index', '_routing': 'key',
+             '_source': {'b': 1}},
+            # Routed with a previous routing
+            {'_id': 'id-c', '_index': 'test-index-000001', '_version': 3,
+             '_routing': 'key-3', '_source': {'c': 1}}]
+
+    def _setup_handler(self, sync_mock):
+        handler = sync_mock.return_value
+        handler._server_version = parse_version('5.4.0')
+        handler._account = 'AUTH_test'
+        handler._container = 'test'
+        handler._index = 'test-index'
+        handler._routing = 'container'
+        handler.DOC_TYPE = 'object'
+        handler._get_routing.return_value = 'key'
+        handler._bulk_index.return_value = []
+        handler._bulk_delete.return_value = []
+        handler._check_errors.side_effect = \
+            MetadataSync._check_errors.__get__(handler)
+        return handler
+
+    @mock.patch('swift_metadata_sync.migrate.elasticsearch.helpers.scan')
+    @mock.patch('swift_metadata_sync.migrate.MetadataSync')
+    def test_migrate(self, sync_mock, scan_mock):
+        handler = self._setup_handler(sync_mock)
+        scan_mock.return_value = iter(self.hits)
+
+        migration = migrate.RoutingMigration('/status/dir', self.settings,
+                                             bulk_size=1)
+        self.assertEqual(2, migration.run())
+        self.assertEqual(
+            {'bool': {'filter': [
+                {'term': {'x-swift-account.keyword': 'AUTH_test'}},
+                {'term': {'x-swift-container.keyword': 'test'}}]}},
+            scan_mock.call_args[1]['query']['query'])
+        self.assertTrue(scan_mock.call_args[1]['version'])
+        self.assertEqual(
+            [mock.call([{'_op_type': 'index', '_index': 'test-index',
+                         '_type': 'object', '_id': 'id-a',
+                         '_source': {'a': 1}, '_routing': 'key'}]),
+             mock.call([{'_op_type': 'index', '_index': 'test-index-000001',
+                         '_type': 'object', '_id': 'id-c',
+                         '_source': {'c': 1}, '_routing': 'key'}])],
+            handler._bulk_index.call_args_list)
+        self.assertEqual(
+            [mock.call([{'_op_type': 'delete', '_index': 'test-index',
+                         '_type': 'object', '_id': 'id-a', '_version': 1}],
+                       ignore_conflicts=True),
+             mock.call([{'_op_type': 'delete', '_index': 'test-index-000001',
+                         '_type': 'object', '_id': 'id-c',
+                         '_routing': 'key-3', '_version': 3}],
+                       ignore_conflicts=True)],
+            handler._bulk_delete.call_args_list)
+
+    @mock.patch('swift_metadata_sync.migrate.elasticsearch.helpers.scan')
+    @mock.patch('swift_metadata_sync.migrate.MetadataSync')
+    def test_failed_copy(self, sync_mock, scan_mock):
+        handler = self._setup_handler(sync_mock)
+        handler._bulk_index.return_value = ['id-a: 500']
+        scan_mock.return_value = iter(self.hits)
+
+        migration = migrate.RoutingMigration('/status/dir', self.settings)
+        with self.assertRaises(RuntimeError):
+            migration.run()
+        # The documents are not deleted from their previous shards
+        self.assertFalse(handler._bulk_delete.called)
+
+    @mock.patch('swift_metadata_sync.metadata_sync.elasticsearch.helpers.bulk')
+    @mock.patch('swift_metadata_sync.migrate.elasticsearch.helpers.scan')
+    @mock.patch('swift_metadata_sync.migrate.MetadataSync')
+    def test_same_shard(self, sync_mock, scan_mock, bulk_mock):
+        handler = self._setup_handler(sync_mock)
+        handler._bulk_delete.side_effect = \
+            lambda ops, **kwargs: MetadataSync._bulk_delete(
+                handler, ops, **kwargs)
+        handler._rollover = None
+        handler._es_conn = mock.Mock()
+        handler.BULK_FILTER_PATH = MetadataSync.BULK_FILTER_PATH
+        scan_mock.return_value = iter(self.hits[:1])
+        # Both routings map to the same shard: the copy replaced the document
+        # (as version 2), which fails the delete of version 1.
+        bulk_mock.return_value = (0, [{'delete': {
+            '_id': 'id-a', 'status': 409,
+            'error': {'type': 'version_conflict_engine_exception'}}}])
+
+        migration = migrate.RoutingMigration('/status/dir', self.settings)
+        self.assertEqual(1, migration.run())
+        bulk_mock.assert_called_once_with(
+            handler._es_conn,
+            [{'_op_type': 'delete', '_index': 'test-index', '_type': 'object',
+              '_id': 'id-a', '_version': 1}],
+            raise_on_error=False, raise_on_exception=False,
+            filter_path=MetadataSync.BULK_FILTER_PATH)
@@ -0,0 +1,50 @@
+import unittest
+
+from swift_metadata_sync.projection import MetadataProjection
+
+
+class TestMetadataProjection(unittest.TestCase):
+    def test_from_settings(self):
+        self.assertIsNone(MetadataProjection.from_settings({'index': 'foo'}))
+        projection = MetadataProjection.from_settings(
+            {'metadata_exclude': ['x-*'], 'metadata_max_size': 10})
+        self.assertEqual(10, projection.max_size)
+        self.assertFalse(projection.includes('x-internal'))
+
+    def test_includes(self):
+        projection = MetadataProjection(include=['color', 'Tag-*'],
+                                        exclude=['tag-private*'])
+        self.assertTrue(projection.includes('color'))
+        self.assertTrue(projection.includes('tag-1'))
+        self.assertFalse(projection.includes('tag-private-1'))
+        self.assertFalse(projection.includes('colors'))
+        self.assertFalse(projection.includes('size'))
+
+        projection = MetadataProjection(exclude=['x-*'])
+        self.assertTrue(projection.includes('color'))
+        self.assertFalse(projection.includes('x-internal'))
+
+    def test_truncate(self):
+        projection = MetadataProjection(max_size=4)
+        self.assertEqual('abcd', projection.truncate('abcdef'))
+        self.assertEqual('abc', projection.truncate('abc'))
+        self.assertEqual(42, projection.truncate(42))
+
+    def test_parse(self):
+        projection = MetadataProjection(max_size=4, json_max_depth=2,
+                                        json_max_fields=4)
+        self.assertEqual({'a': 'abcd', 'b': [{'c': 1}, {'c': 2}]},
+                         projection.parse(b'{"a": "abcdef", '
+                                          b'"b": [{"c": 1}, {"c": 2}]}'))
+        self.assertEqual('not ', projection.parse('not json'))
+        # The values over the limits are not parsed
+        self.assertEqual('{"a"', projection.parse('{"a": {"b": {"c": 1}}}'))
+        self.assertEqual(
+            '{"a": {"b": {"c": 1}}}', MetadataProjection(
+                json_max_depth=2).parse('{"a": {"b": {"c": 1}}}'))
+        self.assertEqual(
+            '{"a": 1, "b": 2, "c": 3}', MetadataProjection(
+                json_max_fields=2).parse('{"a": 1, "b": 2, "c": 3}'))
+        self.assertEqual(
+            {'a': {'b': 1}}, MetadataProjection(json_max_depth=2).parse(
+                '{"a": {"b": 1}}'))
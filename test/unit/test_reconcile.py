@@ -0,0 +1,112 @@
+from io import StringIO
+import json
+import mock
+import unittest
+
+from swift.common.utils import Timestamp
+from swift_metadata_sync import reconcile
+from swift_metadata_sync.utils import parse_version
+
+
+class TestReconciler(unittest.TestCase):
+    def setUp(self):
+        self.settings = {'account': 'AUTH_test',
+                         'container': 'test',
+                         'index': 'test-index',
+                         'es_hosts': 'es.example.com'}
+        self.crawler = mock.Mock()
+        self.crawler.status_dir = '/status/dir'
+        self.broker = mock.Mock()
+        self.broker.storage_policy_index = 0
+        self.crawler.get_local_broker.return_value = (
+            self.broker, {'id': 'db-id'})
+
+    def test_diff(self):
+        objects = [('a', 1000), ('b', 2000), ('d', 4000), ('e', 5000)]
+        docs = [('b', 'id-b', 1000), ('c', 'id-c', 3000), ('d', 'id-d', 4000),
+                ('f', 'id-f', 6000)]
+        reconciler = reconcile.Reconciler(self.crawler, self.settings)
+        self.assertEqual(
+            [('missing', 'a', None),
+             ('stale', 'b', 'id-b'),
+             ('orphaned', 'c', 'id-c'),
+             ('missing', 'e', None),
+             ('orphaned', 'f', 'id-f')],
+            list(reconciler.diff(objects, docs)))
+
+    def test_iter_container(self):
+        listing = [(u'obj-%d' % i, Timestamp(i).internal, 0, 'text/plain',
+                    'etag') for i in range(1, 6)]
+        self.broker.list_objects_iter.side_effect = \
+            lambda limit, marker, *args, **kwargs: \
+            [entry for entry in listing if entry[0] > marker][:limit]
+        reconciler = reconcile.Reconciler(self.crawler, self.settings,
+                                          page_size=2)
+        self.assertEqual([(u'obj-%d' % i, i * 1000) for i in range(1, 6)],
+                         list(reconciler.iter_container(self.broker)))
+        self.assertEqual(4, self.broker.list_objects_iter.call_count)
+
+    def test_iter_index(self):
+        handler = mock.Mock()
+        handler._account = 'AUTH_test'
+        handler._container = 'test'
+        handler._index = 'test-index'
+        handler._routing_params.return_value = {}
+        pages = [
+            {'hits': {'hits': [
+                {'_id': 'id-a', 'sort': ['a'],
+                 '_source': {'x-swift-object': 'a', 'x-timestamp': 1}},
+                {'_id': 'id-b', 'sort': ['b'],
+                 '_source': {'x-swift-object': 'b', 'x-timestamp': 2}}]}},
+            {}
+        ]
+        bodies = []
+
+        def _search(**kwargs):
+            bodies.append(dict(kwargs['body']))
+            return pages.pop(0)
+
+        handler._es_conn.search.side_effect = _search
+        reconciler = reconcile.Reconciler(self.crawler, self.settings)
+        self.assertEqual([('a', 'id-a', 1), ('b', 'id-b', 2)],
+                         list(reconciler.iter_index(handler)))
+        self.assertNotIn('search_after', bodies[0])
+        self.assertEqual(['b'], bodies[1]['search_after'])
+        self.assertEqual([{'x-swift-object.keyword': 'asc'}],
+                         bodies[0]['sort'])
+
+    @mock.patch('swift_metadata_sync.reconcile.MetadataSync')
+    def test_repair(self, sync_mock):
+        handler = sync_mock.return_value
+        handler._server_version = parse_version('5.4.0')
+        handler._index = 'test-index'
+        handler.DOC_TYPE = 'object'
+        handler._rollover = None
+        handler._get_document_id.side_effect = \
+            lambda row: 'id-%s' % row['name']
+        handler._create_index_op.side_effect = \
+            lambda doc_id, row, client: doc_id
+        handler._bulk_index.return_value = []
+        handler._bulk_delete.return_value = []
+        handler._create_delete_op.side_effect = lambda doc_id: {
+            '_op_type': 'delete', '_id': doc_id, '_index': 'test-index',
+            '_type': 'object'}
+        output = StringIO()
+        reconciler = reconcile.Reconciler(
+            self.crawler, self.settings, repair=True, output=output)
+        reconciler.iter_container = mock.Mock(
+            return_value=iter([('a', 1000), ('b', 2000)]))
+        reconciler.iter_index = mock.Mock(
+            return_value=iter([('b', 'id-b', 1000), ('c', 'id-c', 3000)]))
+
+        counts = reconciler.run()
+        self.assertEqual({'missing': 1, 'stale': 1, 'orphaned': 1}, counts)
+        handler._bulk_index.assert_called_once_with(['id-a', 'id-b'])
+        handler._bulk_delete.assert_called_once_with(
+            [{'_op_type': 'delete', '_id': 'id-c', '_index': 'test-index',
+              '_type': 'object'}])
+        self.assertEqual(
+            [{'type': 'missing', 'name': 'a', 'id': None},
+             {'type': 'stale', 'name': 'b', 'id': 'id-b'},
+             {'type': 'orphaned', 'name': 'c', 'id': 'id-c'}],
+            [json.loads(line) for line in output.getvalue().splitlines()])
@@ -0,0 +1,45 @@
+import json
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+
+class TestStartup(unittest.TestCase):
+    # The modules that are only imported by the commands that use them
+    DEFERRED_MODULES = ['distutils',
+                        'swift_metadata_sync.backfill',
+                        'swift_metadata_sync.export',
+                        'swift_metadata_sync.migrate',
+                        'swift_metadata_sync.reconcile',
+                        'swift_metadata_sync.stats_server']
+    # A coarse bound on the import of the daemon (about 0.5 s), which only
+    # catches the large regressions (test/bench/startup.py measures it)
+    MAX_IMPORT_TIME = 3.0
+
+    def _run(self, code):
+        # The modules are imported by a new interpreter, as the tests import
+        # all of them
+        return subprocess.run(
+            [sys.executable, '-W', 'ignore', '-c', code],
+            env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)),
+            stdout=subprocess.PIPE, universal_newlines=True, check=True)
+
+    def test_deferred_imports(self):
+        result = self._run('import json, sys; '
+                           'import swift_metadata_sync.__main__; '
+                           'print(json.dumps(sorted(sys.modules)))')
+        modules = set(json.loads(result.stdout.splitlines()[-1]))
+        # The handlers are created on the first poll, so the client modules
+        # are imported at startup
+        self.assertIn('swift_metadata_sync.metadata_sync', modules)
+        self.assertEqual(set(), modules & set(self.DEFERRED_MODULES))
+
+    def test_import_time(self):
+        times = []
+        for _ in range(3):
+            start = time.time()
+            self._run('import swift_metadata_sync.__main__')
+            times.append(time.time() - start)
+        self.assertLess(min(times), self.MAX_IMPORT_TIME)
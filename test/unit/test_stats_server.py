@@ -0,0 +1,73 @@
+import json
+import mock
+import unittest
+
+from container_crawler.stats import CrawlerStats
+from swift_metadata_sync import stats_server
+
+
+class TestStatsServer(unittest.TestCase):
+    def setUp(self):
+        self.crawler = mock.Mock()
+        self.crawler.stats = CrawlerStats()
+        self.server = stats_server.StatsServer(self.crawler,
+                                               liveness_timeout=60)
+        self.settings = {'account': 'AUTH_test', 'container': 'te"st'}
+
+    def _request(self, path):
+        start_response = mock.Mock()
+        body = b''.join(self.server.app({'PATH_INFO': path},
+                                        start_response))
+        return start_response.call_args[0][0], body.decode('utf-8')
+
+    def test_health(self):
+        self.assertEqual('200 OK', self._request('/health')[0])
+        self.crawler.stats.last_activity = 0
+        self.assertEqual('503 Service Unavailable',
+                         self._request('/health')[0])
+
+    def test_ready(self):
+        self.assertEqual('503 Service Unavailable',
+                         self._request('/ready')[0])
+        self.crawler.stats.poll_done()
+        self.assertEqual('200 OK', self._request('/ready')[0])
+
+    @mock.patch.dict('swift_metadata_sync.stats_server.REQUESTS_IN_FLIGHT',
+                     {'head': 2}, clear=True)
+    def test_stats(self):
+        self.crawler.stats.set_checkpoint(self.settings, 42)
+        status, body = self._request('/stats')
+        self.assertEqual('200 OK', status)
+        stats = json.loads(body)
+        self.assertEqual(42, stats['containers']['AUTH_test/te"st'][
+            'checkpoint'])
+        self.assertEqual({'head': 2}, stats['requests_in_flight'])
+        self.assertTrue(stats['alive'])
+        self.assertFalse(stats['ready'])
+
+    @mock.patch.dict('swift_metadata_sync.stats_server.REQUESTS_IN_FLIGHT',
+                     {'bulk': 1}, clear=True)
+    def test_metrics(self):
+        self.crawler.stats.start_container(self.settings, 1000)
+        self.crawler.stats.set_checkpoint(self.settings, 42)
+        self.crawler.stats.container_done(self.settings, 42, 8, 2.0)
+        self.crawler.stats.poll_done()
+        status, body = self._request('/metrics')
+        self.assertEqual('200 OK', status)
+        lines = body.splitlines()
+        self.assertIn('swift_metadata_sync_up 1', lines)
+        self.assertIn('swift_metadata_sync_polls_total 1', lines)
+        self.assertIn('# TYPE swift_metadata_sync_rows_total counter', lines)
+        self.assertIn('swift_metadata_sync_requests_in_flight{type="bulk"} 1',
+                      lines)
+        labels = '{account="AUTH_test",container="te\\"st"}'
+        self.assertIn('swift_metadata_sync_checkpoint%s 42' % labels, lines)
+        self.assertIn('swift_metadata_sync_backlog_rows%s 8' % labels, lines)
+        self.assertIn('swift_metadata_sync_rows_per_second%s 21.0' % labels,
+                      lines)
+        # Unset values are not reported
+        self.assertFalse([line for line in lines if line.startswith(
+            'swift_metadata_sync_last_failure_timestamp_seconds{')])
+
+    def test_not_found(self):
+        self.assertEqual('404 Not Found', self._request('/')[0])
@@ -0,0 +1,38 @@
+import email.utils
+import json
+import unittest
+
+from swift_metadata_sync import utils
+
+
+class TestUtils(unittest.TestCase):
+    def test_parse_http_date(self):
+        for timestamp in (0, 86399, 951782400, 1528323859, 4102444799):
+            date = email.utils.formatdate(timestamp, usegmt=True)
+            self.assertEqual(timestamp * 1000, utils.parse_http_date(date))
+
+    def test_parse_http_date_other_formats(self):
+        for date in ('Wednesday, 06-Jun-18 22:24:19 GMT',
+                     'Wed Jun  6 22:24:19 2018',
+                     'Wed, 06 Jun 2018 23:24:19 +0100',
+                     'Wed,  6 Jun 2018 22:24:19 GMT'):
+            self.assertEqual(1528323859000, utils.parse_http_date(date))
+
+
+@unittest.skipUnless(utils.FAST_JSON, 'orjson is not installed')
+class TestFastJSONSerializer(unittest.TestCase):
+    def setUp(self):
+        self.serializer = utils.FastJSONSerializer()
+
+    def test_dumps(self):
+        doc = {'x-swift-object': u'é', 'x-timestamp': 1, 'meta': [True]}
+        self.assertEqual(doc, json.loads(self.serializer.dumps(doc)))
+        self.assertEqual('{"raw": 1}', self.serializer.dumps('{"raw": 1}'))
+        # orjson only supports 64 bit integers
+        self.assertEqual('{"big": %d}' % 2**70,
+                         self.serializer.dumps({'big': 2**70}))
+
+    def test_loads(self):
+        self.assertEqual({'docs': []}, self.serializer.loads('{"docs": []}'))
+        self.assertEqual({'big': 2**70},
+                         self.serializer.loads('{"big": %d}' % 2**70))
@@ -0,0 +1,186 @@
+import mock
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from swift_metadata_sync import work_queue
+
+
+class TestWorkQueue(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.path = work_queue.get_queue_path(self.status_dir, 'AUTH_test',
+                                              'foo/bar')
+        self.queue = work_queue.WorkQueue(self.path)
+        self.addCleanup(self.queue.close)
+
+    def test_path(self):
+        self.assertEqual(
+            os.path.join(self.status_dir, '.queue', 'AUTH_test',
+                         'foo%2Fbar.db'), self.path)
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_fifo(self):
+        self.queue.put([{'_id': 'a'}, {'_id': 'b'}])
+        self.queue.put([{'_id': 'c'}])
+        self.assertEqual(3, len(self.queue))
+        entries = self.queue.get(2)
+        self.assertEqual([{'_id': 'a'}, {'_id': 'b'}],
+                         [op for _, op in entries])
+        self.queue.remove(entries[-1][0])
+        self.assertEqual([{'_id': 'c'}], [op for _, op in self.queue.get(2)])
+
+        # The queue persists across the handlers
+        queue = work_queue.WorkQueue(self.path)
+        self.assertEqual(1, len(queue))
+        queue.close()
+
+    def test_settings(self):
+        self.assertEqual((None, False), self.queue.get_settings())
+        self.queue.set_settings({'index': 'foo'}, True)
+        self.assertEqual(({'index': 'foo'}, True), self.queue.get_settings())
+
+        # The settings are only written if they changed
+        changes = self.queue._conn.total_changes
+        self.queue.set_settings({'index': 'foo'}, True)
+        self.assertEqual(changes, self.queue._conn.total_changes)
+        self.queue.set_settings({'index': 'foo'}, False)
+        self.assertEqual(changes + 1, self.queue._conn.total_changes)
+
+    def test_dead_letters(self):
+        self.queue.put([{'_id': 'a'}, {'_id': 'b'}])
+        self.queue.remove(2, [({'_id': 'b'}, 'mapper_parsing_exception')])
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual([({'_id': 'b'}, 'mapper_parsing_exception')],
+                         self.queue.get_dead(10))
+
+
+class TestQueuedSync(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.settings = {'account': 'AUTH_test',
+                         'container': 'test',
+                         'es_hosts': 'es.example.com',
+                         'index': 'test-index',
+                         'queue': True}
+
+    @mock.patch('swift_metadata_sync.metadata_sync.get_client')
+    def test_handle(self, mock_client):
+        with mock.patch('container_crawler.base_sync.InternalClient'):
+            sync = work_queue.QueuedSync(self.status_dir, self.settings)
+        sync._swift_client.get_object_metadata.return_value = {
+            'x-timestamp': '1528323859.12345',
+            'last-modified': 'Wed, 06 Jun 2018 22:24:19 GMT',
+            'content-length': '42',
+            'content-type': 'text/plain',
+            'etag': 'deadbeef'}
+        rows = [{'name': 'foo', 'deleted': False,
+                 'created_at': '1528323859.12345'},
+                {'name': 'bar', 'deleted': True,
+                 'created_at': '1528323859.12345'}]
+        sync.handle(iter(rows))
+        # The cluster is not used until the queue is drained
+        mock_client.assert_not_called()
+
+        queue = work_queue.WorkQueue(work_queue.get_queue_path(
+            self.status_dir, 'AUTH_test', 'test'))
+        ops = [op for _, op in queue.get(10)]
+        self.assertEqual((self.settings, False), queue.get_settings())
+        queue.close()
+        self.assertEqual(['index', 'delete'],
+                         [op['_op_type'] for op in ops])
+        self.assertEqual([sync._get_document_id(row) for row in rows],
+                         [op['_id'] for op in ops])
+        self.assertEqual('foo', ops[0]['_source']['x-swift-object'])
+        self.assertFalse(sync.handle_empty_container(20000))
+
+        # The crawler closes the queue with the handler
+        sync.close()
+        self.assertRaises(work_queue.sqlite3.ProgrammingError, len,
+                          sync._queue)
+
+
+class TestQueueIndexer(unittest.TestCase):
+    def setUp(self):
+        self.status_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.status_dir)
+        self.settings = {'account': 'AUTH_test', 'container': 'test',
+                         'index': 'test-index'}
+        self.queue = work_queue.WorkQueue(work_queue.get_queue_path(
+            self.status_dir, 'AUTH_test', 'test'))
+        self.addCleanup(self.queue.close)
+        self.queue.set_settings(self.settings)
+        self.indexer = work_queue.QueueIndexer(self.status_dir, bulk_size=3)
+
+        patcher = mock.patch('swift_metadata_sync.work_queue.MetadataSync')
+        self.sync_mock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.handler = self.sync_mock.return_value
+        self.handler._rollover = None
+        self.handler._bulk_delete.return_value = []
+        self.handler._bulk_index.return_value = []
+
+    def test_drain(self):
+        self.queue.put([{'_op_type': 'index', '_id': 'a', '_source': {}},
+                        {'_op_type': 'index', '_id': 'b', '_source': {}},
+                        {'_op_type': 'delete', '_id': 'a'},
+                        {'_op_type': 'index', '_id': 'c', '_source': {}}])
+        self.assertEqual(4, self.indexer.run_once())
+        self.assertEqual(0, len(self.queue))
+        self.sync_mock.assert_called_once_with(self.status_dir, self.settings,
+                                               False)
+        # Only the last operation of a document is sent
+        self.assertEqual(
+            [mock.call([{'_op_type': 'delete', '_id': 'a'}],
+                       rejected=mock.ANY)],
+            self.handler._bulk_delete.call_args_list)
+        self.assertEqual(
+            [mock.call([{'_op_type': 'index', '_id': 'b', '_source': {}}],
+                       rejected=mock.ANY),
+             mock.call([{'_op_type': 'index', '_id': 'c', '_source': {}}],
+                       rejected=mock.ANY)],
+            self.handler._bulk_index.call_args_list)
+
+    def test_failed_batch(self):
+        self.queue.put([{'_op_type': 'index', '_id': 'a', '_source': {}}])
+        self.handler._check_errors.side_effect = RuntimeError(
+            'Failed to process some entries')
+        self.assertEqual(0, self.indexer.run_once())
+        # The operations are kept for the next pass
+        self.assertEqual(1, len(self.queue))
+
+    def test_rejected_operations(self):
+        self.queue.put([{'_op_type': 'index', '_id': 'a', '_source': {}},
+                        {'_op_type': 'index', '_id': 'b', '_source': {}}])
+
+        def bulk_index(ops, rejected):
+            rejected.append(('b', 'mapper_parsing_exception'))
+            return []
+
+        self.handler._bulk_index.side_effect = bulk_index
+        self.assertEqual(2, self.indexer.run_once())
+        # The rejected operation does not block the queue
+        self.assertEqual(0, len(self.queue))
+        self.assertEqual([({'_op_type': 'index', '_id': 'b', '_source': {}},
+                           'mapper_parsing_exception')],
+                         self.queue.get_dead(10))
+
+    def test_unavailable_cluster(self):
+        self.queue.put([{'_op_type': 'delete', '_id': 'a'}])
+        self.sync_mock.side_effect = RuntimeError('Connection refused')
+        self.assertEqual(0, self.indexer.run_once())
+        self.assertEqual(1, len(self.queue))
+
+    def test_rollover(self):
+        self.handler._rollover = {'max_docs': 1000}
+        self.handler._route_ops.side_effect = lambda ops: [
+            dict(op, _index='test-index-000001') for op in ops]
+        self.queue.put([{'_op_type': 'index', '_id': 'a', '_index': 'alias',
+                         '_source': {}}])
+        self.assertEqual(1, self.indexer.run_once())
+        self.handler._bulk_index.assert_called_once_with(
+            [{'_op_type': 'index', '_id': 'a', '_index': 'test-index-000001',
+              '_source': {}}], rejected=[])